@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""bench_spawn.py: time from spawning a player to it running, old way and new
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Launches a stand-in player over and over: the way we used to (a
+# joined command string through /bin/sh with preexec_fn=os.setsid),
+# as a plain argv with preexec_fn=os.setsid, and through spawn.launch().
+# It times how long it takes from the spawn call until the stand-in
+# writes its first byte, i.e. until it is actually running.
+#
+# Usage: python bench_spawn.py [runs] [stand-in command...]
+#
+# The default stand-in is 'echo', given a player-like command line.
+#
+
+import os
+import sys
+import subprocess
+from time import time
+
+# local modules
+import spawn
+
+nullin = open(os.devnull, 'r')
+
+# what the stand-in gets on its command line, like a real player would
+PLAYER_ARGS = ['--no-osd', '--no-keys', '--refresh', '--aspect-mode', 'stretch',
+               '--layer', '1', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer1',
+               '--pos', '0.0', "/media/it's a film.mp4"]
+
+
+def launch_shell(argv):
+    """The old way: a quoted string through the shell"""
+    cmd = " ".join(argv[:-1]) + " '" + argv[-1].replace("'", "'\\''") + "'"
+    return subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid, stdin=nullin,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def launch_preexec(argv):
+    """No shell, but still calling setsid() from python in the child"""
+    return subprocess.Popen(argv, preexec_fn=os.setsid, stdin=nullin,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def time_launch(launch, argv):
+    """Seconds from spawn to the first byte of output"""
+    start = time()
+    process = launch(argv)
+    process.stdout.read(1)
+    elapsed = time() - start
+    process.communicate()
+    return elapsed
+
+
+def summary(times):
+    times = sorted(times)
+    count = len(times)
+    return {
+        'runs': count,
+        'mean_ms': 1000.0 * sum(times) / count,
+        'p50_ms': 1000.0 * times[count // 2],
+        'p95_ms': 1000.0 * times[min(int(count * 0.95), count - 1)],
+        'max_ms': 1000.0 * times[-1],
+    }
+
+
+def main(argv):
+    runs = int(argv[0]) if argv else 200
+    standin = argv[1:] or ['echo']
+    player_argv = standin + PLAYER_ARGS
+    variants = (('shell', launch_shell), ('preexec', launch_preexec),
+                ('spawn', spawn.launch))
+    results = {}
+    for name, launch in variants:
+        # one to warm up the page cache
+        time_launch(launch, player_argv)
+        results[name] = summary([time_launch(launch, player_argv) for _ in range(runs)])
+    for name, launch in variants:
+        r = results[name]
+        print "%-8s runs %4i  mean %7.3fms  p50 %7.3fms  p95 %7.3fms  max %7.3fms" % \
+                (name, r['runs'], r['mean_ms'], r['p50_ms'], r['p95_ms'], r['max_ms'])
+    print "spawn vs shell: %+.3fms per clip (mean)" % \
+            (results['spawn']['mean_ms'] - results['shell']['mean_ms'])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""benchmark.py: benchmark the sequencing loop against stand-in player and ffprobe
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Runs exhibitvideo.main()'s recipe loop for a fixed number of steps,
+# with fakeplayer.py standing in for omxplayer and fakeprobe.py for
+# ffprobe, over a generated catalog of empty media files. Reports, as
+# JSON:
+#
+#   throughput          clips per second
+#   gap, spawn latency  distributions, from the metrics module
+#   cpu per clip        ours and our children's
+#   threads, rss        at start, peak and end
+#   hangs               hung players, time to notice and to recover
+#
+# With --baseline, compares against an earlier run's JSON and exits
+# non-zero if throughput, gaps, cpu or memory growth got worse by more
+# than --tolerance.
+#
+# e.g.  python benchmark.py --steps 2000 --output new.json
+#       python benchmark.py --steps 2000 --baseline new.json
+#
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from time import sleep, time
+
+# nothing else yet: the other modules open the log file when imported,
+# and we want it somewhere else
+import config
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# how often the sampler looks at threads and memory
+SAMPLE_INTERVAL = 0.25
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the sequencing loop")
+    parser.add_argument('--steps', type=int, default=1000, help="recipe steps to run")
+    parser.add_argument('--films', type=int, default=200, help="films in the catalog")
+    parser.add_argument('--clip-length', type=float, default=0.05,
+                        help="seconds each clip is scheduled for")
+    parser.add_argument('--player-startup', type=float, default=0.0,
+                        help="stand-in player startup delay")
+    parser.add_argument('--player-runtime', type=float, default=60.0,
+                        help="how long the stand-in player plays before exiting")
+    parser.add_argument('--player-failure-rate', type=float, default=0.0)
+    parser.add_argument('--player-hang-rate', type=float, default=0.0)
+    parser.add_argument('--player-stubborn-rate', type=float, default=0.0,
+                        help="chance of a player ignoring SIGTERM and leaving a child")
+    parser.add_argument('--probe-delay', type=float, default=0.0,
+                        help="stand-in ffprobe delay")
+    parser.add_argument('--probe-failure-rate', type=float, default=0.0)
+    parser.add_argument('--no-cache', action='store_true', help="turn the media cache off")
+    parser.add_argument('--preroll', action='store_true')
+    parser.add_argument('--debug', type=int, default=0, help="debug level for the log")
+    parser.add_argument('--output', help="write results here as well as to stdout")
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="allowed fractional regression against the baseline")
+    return parser.parse_args(argv)
+
+
+def setup(args, workdir):
+    """Point config at the stand-ins and a generated catalog"""
+    config.logfile = os.path.join(workdir, 'exhibitvideo.log')
+    config.debug = args.debug
+    config.media_base = os.path.join(workdir, 'media')
+    config.media_cache_file = None if args.no_cache else os.path.join(workdir, 'cache.json')
+    config.metrics_file = os.path.join(workdir, 'metrics.json')
+    config.startup_snapshot = os.path.join(workdir, 'startup.json')
+    config.journal_file = os.path.join(workdir, 'journal.log')
+    config.segment_dir = None
+    config.metrics_interval = 3600
+    config.preroll = args.preroll
+    # swap the player for the stand-in, keeping the rest of each command
+    player = [sys.executable, os.path.join(here, 'fakeplayer.py')]
+    for kind in ('content', 'loop', 'transition'):
+        cmd = getattr(config, kind + '_cmd')
+        setattr(config, kind + '_cmd', player + cmd[1:])
+    config.omx_cmd = player + config.omx_cmd[1:]
+    config.ffprobe_cmd = [sys.executable, os.path.join(here, 'fakeprobe.py')]
+    os.environ['FAKEPLAYER_STARTUP_DELAY'] = str(args.player_startup)
+    os.environ['FAKEPLAYER_RUNTIME'] = str(args.player_runtime)
+    os.environ['FAKEPLAYER_FAILURE_RATE'] = str(args.player_failure_rate)
+    os.environ['FAKEPLAYER_HANG_RATE'] = str(args.player_hang_rate)
+    os.environ['FAKEPLAYER_STUBBORN_RATE'] = str(args.player_stubborn_rate)
+    os.environ['FAKEPROBE_DELAY'] = str(args.probe_delay)
+    os.environ['FAKEPROBE_FAILURE_RATE'] = str(args.probe_failure_rate)
+    # every clip plays for clip_length, whatever the recipe says
+    tags = []
+    for tag, length in config.recipedb:
+        if tag not in tags:
+            tags.append(tag)
+    config.recipedb = [(tag, args.clip_length) for tag, length in config.recipedb]
+    config.startup_clip_length = args.clip_length
+    # one empty file per film, tagged round robin, lengths left to ffprobe
+    os.makedirs(config.media_base)
+    films = []
+    for i in range(args.films):
+        filename = 'film%04i.mp4' % i
+        open(os.path.join(config.media_base, filename), 'w').close()
+        films.append({'file': filename, 'tags': [tags[i % len(tags)]]})
+    with open(os.path.join(config.media_base, config.filmdb), 'w') as fp:
+        json.dump(films, fp, indent=1)
+
+
+def rss_kb():
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class Sampler(threading.Thread):
+    """Keeps an eye on thread count and memory while we run"""
+
+    def __init__(self):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.done = threading.Event()
+        self.peak_threads = 0
+        self.peak_rss = 0
+
+    def sample(self):
+        # don't count ourselves
+        self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+        self.peak_rss = max(self.peak_rss, rss_kb())
+
+    def run(self):
+        while not self.done.is_set():
+            self.sample()
+            sleep(SAMPLE_INTERVAL)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=here, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # safe to import now that config is settled
+    import exhibitvideo
+    import metrics
+    threads_start = threading.active_count()
+    rss_start = rss_kb()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sampler = Sampler()
+    sampler.start()
+    start = time()
+    exhibitvideo.main(steps=args.steps)
+    elapsed = time() - start
+    sampler.done.set()
+    sampler.join()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = metrics.get_metrics().as_dict()
+    clips = stats['clips'] or 1
+    return {
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'params': vars(args),
+        'elapsed_seconds': elapsed,
+        'clips': stats['clips'],
+        'clips_per_second': stats['clips'] / elapsed,
+        'gap': stats['exhibitvideo_clip_gap_seconds'],
+        'spawn_latency': stats['exhibitvideo_spawn_latency_seconds'],
+        'overrun': stats['exhibitvideo_clip_overrun_seconds'],
+        'teardown': stats['exhibitvideo_teardown_seconds'],
+        'teardown_kills': stats['teardown_kills'],
+        'leaked_players': stats['leaked_players'],
+        'hangs': stats['hangs'],
+        'hang_detect': stats['exhibitvideo_hang_detect_seconds'],
+        'hang_recover': stats['exhibitvideo_hang_recover_seconds'],
+        'cpu_per_clip': {
+            'self': (usage.ru_utime + usage.ru_stime -
+                     usage_start.ru_utime - usage_start.ru_stime) / clips,
+            'children': (children.ru_utime + children.ru_stime -
+                         children_start.ru_utime - children_start.ru_stime) / clips,
+        },
+        'threads': {'start': threads_start, 'peak': sampler.peak_threads,
+                    'end': threading.active_count()},
+        'rss_kb': {'start': rss_start, 'peak': sampler.peak_rss, 'end': rss_kb(),
+                   'growth': rss_kb() - rss_start},
+    }
+
+
+def regressions(result, baseline, tolerance):
+    """List the ways result is worse than baseline"""
+    found = []
+    worse_if_lower = [('clips_per_second',)]
+    worse_if_higher = [('gap', 'p95'), ('gap', 'p99'), ('spawn_latency', 'p95'),
+                       ('cpu_per_clip', 'self'), ('rss_kb', 'growth'), ('threads', 'end')]
+
+    def get(d, path):
+        for key in path:
+            if not isinstance(d, dict) or d.get(key) is None:
+                return None
+            d = d[key]
+        return d
+
+    for path in worse_if_lower:
+        new, old = get(result, path), get(baseline, path)
+        if new is not None and old and new < old * (1 - tolerance):
+            found.append("%s dropped from %g to %g" % ('.'.join(path), old, new))
+    for path in worse_if_higher:
+        new, old = get(result, path), get(baseline, path)
+        if new is not None and old is not None and new > abs(old) * (1 + tolerance) + 1e-3:
+            found.append("%s rose from %g to %g" % ('.'.join(path), old, new))
+    return found
+
+
+def main(argv):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='exhibitvideo-bench-')
+    try:
+        setup(args, workdir)
+        result = run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        found = regressions(result, baseline, args.tolerance)
+        for problem in found:
+            sys.stderr.write("regression: %s\n" % problem)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+"""catalog.py: hot-reloadable film catalog, indexed by tag
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import threading
+from random import choice
+
+# local modules
+from common import *
+import config
+import video
+import filmdb
+import keyframes
+from timing import Latch
+
+
+class Catalog(object):
+    """Holds the film database and a tag->films index.
+
+    Call check() now and then (it is just a stat). When the db file has
+    changed, the file is re-read on a thread of its own and compared
+    entry by entry with what we have, and only the tag lists touched by
+    added, removed, retagged or disabled films are rebuilt. Films going
+    out go straight away; films coming in are probed first, so nobody
+    waits on ffprobe for them, and then put in. Each new index is
+    swapped in with a single assignment, so readers always see either
+    the old index or the new one, never something in between.
+
+    Films are keyed by their 'file' value. The index and its lists are
+    never modified once published; treat them as read-only.
+
+    With load=False nothing is read until reload() or
+    load_in_background(); ready is set once the first index is up (or
+    the db couldn't be read), prepared once its films are probed too."""
+
+    def __init__(self, filename=None, load=True):
+        if filename is None:
+            filename = config.media_base + '/' + config.filmdb
+        self.filename = filename
+        # (size, mtime) of the db file when we last read it
+        self._stamp = None
+        # file -> film dict, for every entry including disabled ones
+        self._films = {}
+        # files of entries whose media isn't there, kept out of the index
+        self._missing = set()
+        # tag -> list of enabled films
+        self._index = {}
+        # guards the index and what it's made from
+        self._lock = threading.Lock()
+        # only one reload at a time, and whether check() has one going
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+        self.ready = Latch()
+        self.prepared = Latch()
+        if load:
+            self.reload()
+            self.prepared.set()
+
+    def load_in_background(self):
+        """Load the db on a thread of its own, and return the thread"""
+        def load():
+            try:
+                self.reload()
+            finally:
+                self.ready.set()
+                self.prepared.set()
+        thread = threading.Thread(target=load, name='catalog-load')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def index(self):
+        """The current tag->films index"""
+        return self._index
+
+    def tags(self):
+        return list(self._index.keys())
+
+    def films(self, tag):
+        """Enabled films with this tag"""
+        return self._index.get(tag, [])
+
+    def choice(self, tag):
+        """A random enabled film with this tag, or None"""
+        films = self._index.get(tag)
+        if not films:
+            return None
+        return choice(films)
+
+    def film(self, name):
+        """The enabled film for this file, if its file is there, or None"""
+        film = self._films.get(name)
+        if film is None or not _enabled(film) or name in self._missing:
+            return None
+        return film
+
+    def __contains__(self, tag):
+        return tag in self._index
+
+    def __len__(self):
+        return len(self._films)
+
+    def changed(self):
+        """Has the db file changed since we last read it?"""
+        return _stamp(self.filename) != self._stamp
+
+    def check(self):
+        """Reload, in the background, if the db file has changed.
+        Returns True if a reload was started."""
+        # still loading for the first time; that will do
+        if not self.ready.is_set() or not self.changed():
+            return False
+        with self._lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+
+        def reload():
+            try:
+                self.reload()
+            finally:
+                self._reloading = False
+
+        thread = threading.Thread(target=reload, name='catalog-reload')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def reload(self):
+        """Re-read the db file and apply the differences to the index.
+        Returns True if anything changed. The first time, the index is
+        up before its films are probed, so playing can start; after
+        that, new films only go in once they are probed."""
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        first = not self.ready.is_set()
+        with self._lock:
+            stamp = _stamp(self.filename)
+            try:
+                film_list = video.read_film_file(self.filename)
+            except (IOError, ValueError) as e:
+                # curators may save a half-edited file; keep what we have
+                report("Couldn't read film database %s: %s" % (self.filename, str(e)))
+                self.ready.set()
+                return False
+            self._stamp = stamp
+            new_films = {}
+            for film in film_list:
+                if 'file' not in film:
+                    debug("Film without 'file' ignored: %s" % film)
+                    continue
+                if film['file'] in new_films:
+                    debug("Duplicate entry for %s, using the last one" % film['file'])
+                new_films[film['file']] = film
+            old_films = self._films
+            removed = [old_films[key] for key in old_films if key not in new_films]
+            added = []
+            for key, film in new_films.items():
+                old = old_films.get(key)
+                if old is None:
+                    added.append(film)
+                elif old != film:
+                    removed.append(old)
+                    added.append(film)
+                else:
+                    # keep the record the index already holds
+                    new_films[key] = old
+            if not added and not removed:
+                self.ready.set()
+                return False
+            # films whose file is gone stay out of rotation until it's back
+            present = []
+            for film in added:
+                if os.path.isfile(self._path(film['file'])):
+                    self._missing.discard(film['file'])
+                    present.append(film)
+                else:
+                    if _enabled(film):
+                        debug("File %s not found, not playing it" % film['file'])
+                    self._missing.add(film['file'])
+            self._missing.intersection_update(new_films)
+            self._index = _apply(self._index, removed, present if first else [])
+            self._films = new_films
+            report("Film database loaded: %i entries, %i removed, %i added, %i missing" %
+                   (len(new_films), len(removed), len(added), len(self._missing)))
+        if first:
+            # the index is up; films can be chosen while they are probed
+            self.ready.set()
+            self._prepare(added)
+            return True
+        self._prepare(added)
+        with self._lock:
+            # in they go, bar any whose file the watcher saw go meanwhile
+            present = [film for film in present if film['file'] not in self._missing]
+            self._index = _apply(self._index, [], present)
+        debug("%i new films probed and in rotation" % len(present))
+        return True
+
+    def media_changed(self, event, name):
+        """Called by the media watcher: take films whose file has gone
+        out of rotation, put them back when it returns, and get new and
+        changed files probed"""
+        if name == os.path.basename(self.filename):
+            self.check()
+            return
+        with self._lock:
+            film = self._films.get(name)
+            if event == 'removed':
+                if film is not None and name not in self._missing:
+                    self._missing.add(name)
+                    self._index = _apply(self._index, [film], [])
+                    report("%s is gone, taken out of rotation" % name)
+                return
+            if film is None:
+                report("New file %s is not in the film database" % name)
+            elif name in self._missing:
+                self._missing.discard(name)
+                self._index = _apply(self._index, [], [film])
+                report("%s is back in rotation" % name)
+        self._prepare([film or filmdb.Film(name)])
+
+    def _prepare(self, films):
+        """Warm the media cache for these films, so clips don't wait on
+        ffprobe at play time"""
+        video.probe_films(films)
+        keyframes.index_films(films)
+        video.precut_films(films)
+
+    def _path(self, name):
+        return os.path.join(os.path.dirname(self.filename), name)
+
+
+def _apply(index, removed, added):
+    """Return a new index with removed films taken out of their tag
+    lists and added films put in. Only the touched lists are copied."""
+    new_index = dict(index)
+    touched = {}
+    for film in removed:
+        if _enabled(film):
+            for tag in film['tags']:
+                if tag not in touched:
+                    touched[tag] = list(new_index.get(tag, []))
+                touched[tag] = [f for f in touched[tag] if f is not film]
+    for film in added:
+        if _enabled(film):
+            for tag in film['tags']:
+                if tag not in touched:
+                    touched[tag] = list(new_index.get(tag, []))
+                touched[tag].append(film)
+    for tag, films in touched.items():
+        if films:
+            new_index[tag] = films
+        else:
+            new_index.pop(tag, None)
+    return new_index
+
+
+def _enabled(film):
+    return 'tags' in film and not ('disabled' in film and film['disabled'])
+
+
+def _stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+"""channel.py: one screen's recipe, films and players, and running several
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A channel is everything one screen needs: a recipe, the films it may
+# choose from (a view of the shared catalog), the layers and player
+# numbers its clips take turns on, and the display they go to. All of
+# its playback state (where it is in the recipe, the clip showing, its
+# player pool) lives in the channel, so any number of them can run in
+# one process: two HDMI outputs on a Pi 4, or a background and an
+# overlay on separate layer ranges of one screen.
+#
+# Channels are set up from config.channels (one channel, from the old
+# settings, when that's None). play() runs them together: one channel
+# in the calling thread, as before; several with a thread each, which
+# spends nearly all its time asleep waiting for its clip to end.
+#
+# Only the first channel talks to a sync coordinator, if there is one.
+#
+
+import os
+import threading
+from collections import deque
+from random import choice
+
+# local modules
+from common import *
+import config
+import journal
+import metrics
+import playerpool
+import spawn
+import videothread
+from timing import Latch
+
+#
+# Constants
+#
+
+# how often play() wakes up while waiting on channel threads, so a
+# KeyboardInterrupt gets through
+JOIN_INTERVAL = 1.0
+
+
+class CatalogView(object):
+    """The films of a catalog carrying a given tag (all of them, for
+    None), indexed by tag like the catalog. The filtered index is
+    rebuilt only when the catalog publishes a new one."""
+
+    def __init__(self, catalog, require=None):
+        self.catalog = catalog
+        self.require = require
+        # (catalog index it was built from, filtered index)
+        self._view = (None, {})
+
+    def index(self):
+        index = self.catalog.index()
+        if self.require is None:
+            return index
+        source, view = self._view
+        if source is not index:
+            view = {}
+            for tag, films in index.items():
+                kept = [film for film in films if self.require in film['tags']]
+                if kept:
+                    view[tag] = kept
+            self._view = (index, view)
+        return view
+
+    def films(self, tag):
+        return self.index().get(tag, [])
+
+    def choice(self, tag, avoid=()):
+        """A random film with this tag, one whose file isn't in avoid if
+        there is one"""
+        films = self.index().get(tag)
+        if not films:
+            return None
+        if avoid:
+            avoid = set(avoid)
+            fresh = [film for film in films if film['file'] not in avoid]
+            if fresh:
+                return choice(fresh)
+        return choice(films)
+
+    def __contains__(self, tag):
+        return tag in self.index()
+
+
+class Channel(object):
+    """Plays a recipe on one screen (or one range of layers)"""
+
+    def __init__(self, name, catalog, recipe, slots, require=None, coordinator=None):
+        self.name = name
+        self.films = CatalogView(catalog, require)
+        self.catalog = catalog
+        self.recipe = recipe
+        self.slots = slots
+        self.coordinator = coordinator
+        self.pool = None
+        if config.player_pool:
+            self.pool = playerpool.PlayerPool(slots.layers, slots.players, slots.display)
+        self.recipe_index = 0
+        self.journal = journal.get_journal()
+        # files of the last few clips, which we don't repeat if we can help it
+        self.history = deque(maxlen=config.journal_history)
+        self.last_thread = None
+        # when the watchdog last killed a hung player of ours, until the
+        # next clip is on screen
+        self._hung_at = None
+        # called with the time the channel's first clip is on screen
+        self.on_first_shown = None
+        self._stop = Latch()
+
+    def __repr__(self):
+        return "Channel(%r, %r)" % (self.name, self.slots)
+
+    def run(self, steps=None, warm_films=None):
+        """Play the recipe forever, or for the given number of steps,
+        then let the last clip play out. Until the catalog is ready,
+        play warm_films, or wait."""
+        # a coordinated clip is pre-rolled whatever config.preroll says
+        preroll = config.preroll or self.coordinator is not None
+        if self.journal is not None:
+            self.resume(preroll)
+        if warm_films:
+            self.warm_up(warm_films)
+        self.catalog.ready.wait()
+        step = 0
+        while (steps is None or step < steps) and not self._stop.is_set():
+            step += 1
+            self.step(preroll)
+        if self.last_thread:
+            self.last_thread.wait_for_end()
+            self.last_thread.join()
+
+    def resume(self, preroll=False):
+        """Carry on from the journal: the recipe from the step after the
+        last clip we played, and that clip too, if it would still be on"""
+        entry = self.journal.last(self.name)
+        if entry is None:
+            return
+        self.history.extend(self.journal.recent(self.name))
+        index = entry['index']
+        if index >= len(self.recipe):
+            return
+        self.recipe_index = (index + 1) % len(self.recipe)
+        clip = journal.remainder(entry)
+        if clip is None or not os.path.isfile(os.path.join(config.media_base, clip['file'])):
+            report("%s: carrying on from recipe step %i" % (self.name, self.recipe_index))
+            return
+        report("%s: resuming %s at %.1fs, then recipe step %i" %
+               (self.name, clip['file'], clip['start'], self.recipe_index))
+        self.play(clip, preroll, index)
+
+    def step(self, preroll=False):
+        """Start the next clip in the recipe, and wait until it's over
+        (with pre-roll, until it's time to start the one after)"""
+        index = self.recipe_index
+        this_recipe, duration = self.recipe[index]
+        self.recipe_index += 1
+        if self.recipe_index >= len(self.recipe):
+            self.recipe_index = 0
+        metrics.recipe_step()
+        if this_recipe not in self.films:
+            return
+        debug(lazy_format("%s: next recipe (%i): %s, duration %.2fs, %s choices",
+                          self.name, self.recipe_index, this_recipe, duration,
+                          Lazy(len, self.films.films(this_recipe))))
+        content_film = self.films.choice(this_recipe, avoid=self.history)
+        # if we have an override duration, play the film for that long,
+        # leaving the catalog's record alone
+        if duration:
+            content_film = content_film.override(length=duration)
+        debug("Selected film:", content_film, level=2)
+        self.play(content_film, preroll, index)
+
+    def warm_up(self, films):
+        """Until the catalog is ready, play these films (from the startup
+        snapshot) in turn, for startup_clip_length seconds each"""
+        preroll = config.preroll or self.coordinator is not None
+        i = 0
+        while not self.catalog.ready.is_set() and not self._stop.is_set():
+            film = films[i % len(films)]
+            if config.startup_clip_length:
+                film = film.override(length=config.startup_clip_length)
+            i += 1
+            self.play(film, preroll)
+
+    def play(self, content_film, preroll=False, index=None):
+        """Start a clip, and wait until it's over (with pre-roll, until
+        it's time to start the one after). A clip for a recipe step
+        (index) goes in the journal once it's on screen."""
+        # with pre-roll, the next clip is revealed the moment this one ends
+        start_at = None
+        if preroll and self.last_thread:
+            start_at = self.last_thread.end_time()
+        # tell the followers, who need a moment's notice
+        if self.coordinator:
+            seq, start_at = self.coordinator.schedule(content_film, start_at)
+        content_thread = videothread.VideoThread(content_film, config.media_base,
+                                                 debug=config.debug, start_at=start_at,
+                                                 slots=self.slots, pool=self.pool)
+        if self.last_thread is not None and self.last_thread.hung_at:
+            self._hung_at = self.last_thread.hung_at
+        callbacks = []
+        if self.on_first_shown:
+            callbacks.append(self.on_first_shown)
+            self.on_first_shown = None
+        if self.coordinator:
+            callbacks.append(self.coordinator.shown_callback(seq))
+        if self._hung_at:
+            callbacks.append(self._recovered)
+        if index is not None:
+            self.history.append(content_film['file'])
+            if self.journal is not None:
+                callbacks.append(lambda at: self.journal.played(self.name, index,
+                                                                content_film, at))
+        if callbacks:
+            content_thread.on_shown = lambda at: [callback(at) for callback in callbacks]
+        # start new video
+        content_thread.start()
+        # pick up any edits to the film db while this clip plays
+        self.catalog.check()
+        if self.journal is not None:
+            self.journal.check()
+        # store current handle for later
+        self.last_thread = content_thread
+        # now wait synchronously for end of video (or, with pre-roll,
+        # until it is time to start the next one)
+        if self.coordinator:
+            content_thread.wait_for_end(lead=max(videothread.preroll_lead(),
+                                                 config.sync_lead))
+        elif preroll:
+            content_thread.wait_for_end(lead=videothread.preroll_lead())
+        else:
+            content_thread.wait_for_end()
+
+    def _recovered(self, at):
+        """A clip is on screen again after a hung player"""
+        hung_at, self._hung_at = self._hung_at, None
+        if hung_at:
+            report("%s: back on screen %.2fs after a hung player" % (self.name, at - hung_at))
+            metrics.hang_recovered(at - hung_at)
+
+    def stop(self):
+        """Stop after the clip showing, and cut that short"""
+        self._stop.set()
+        if self.last_thread:
+            self.last_thread.stop()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def configured():
+    """config.channels with the defaults filled in. With no channels
+    configured, one channel plays config.recipedb on layers 1 and 2."""
+    specs = config.channels or [{}]
+    channels = []
+    for i, spec in enumerate(specs):
+        layers = spec.get('layers', [1, 2])
+        channels.append({
+            'name': spec.get('name', 'channel%i' % (i + 1)),
+            'recipe': spec.get('recipe', config.recipedb),
+            'require': spec.get('require'),
+            'layers': layers,
+            'players': spec.get('players', range(2 * i + 1, 2 * i + 1 + len(layers))),
+            'display': spec.get('display'),
+        })
+    return channels
+
+
+def from_config(catalog, coordinator=None):
+    """Channels as configured, sharing the catalog"""
+    channels = []
+    for spec in configured():
+        slots = spawn.Slots(spec['layers'], spec['players'], spec['display'])
+        channels.append(Channel(spec['name'], catalog, spec['recipe'], slots,
+                                require=spec['require'],
+                                coordinator=coordinator if not channels else None))
+    players = [p for channel in channels for p in channel.slots.players]
+    if len(set(players)) != len(players):
+        raise ValueError("channels must have player numbers of their own")
+    return channels
+
+
+def play(channels, steps=None, warm_films=None):
+    """Run the channels together, each for steps recipe steps (or
+    forever), warming up on warm_films while the catalog loads. If one
+    fails, the others are stopped and the error is raised here."""
+    if len(channels) == 1:
+        channels[0].run(steps, warm_films)
+        return
+    errors = []
+
+    def run(channel):
+        try:
+            channel.run(steps, warm_films)
+        except Exception as e:
+            report("Channel %s failed: %s" % (channel.name, str(e)))
+            errors.append(e)
+            for other in channels:
+                other.stop()
+
+    threads = []
+    for channel in channels:
+        thread = threading.Thread(target=run, args=(channel,), name=channel.name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    report("Playing %i channels: %s" % (len(channels),
+                                        ", ".join(channel.name for channel in channels)))
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(JOIN_INTERVAL)
+    except BaseException:
+        for channel in channels:
+            channel.stop()
+        raise
+    if errors:
+        raise errors[0]
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""clock.py: the time clips are timed by, which can be made to run fast
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Everything that times clips (the event loop, latches, playbacks, the
+# reaper, the recipe loop, metrics and the journal, and the log's rate
+# limits) gets the time here rather than from the time module:
+#
+#   time()          now, by the clock
+#   sleep(s)        sleep for s seconds of the clock's time
+#   timeout(s)      the real seconds that s seconds of the clock's
+#                   time take, for select() and the like
+#
+# Normally that is just real time. A soak test can set_clock() to a
+# ScaledClock, and a day of clips goes by in a minute or two. Players,
+# ffprobe, D-Bus and the filesystem still keep real time, so settings
+# that wait on them (player startup, teardown) need stretching to
+# match; see soak.py.
+#
+# Set the clock before anything else starts, as the loop and any clip
+# already under way go on with the time they were given.
+#
+
+import time as _time
+import threading
+
+
+class Clock(object):
+    """Real time"""
+
+    rate = 1.0
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def timeout(self, seconds):
+        return seconds
+
+
+class ScaledClock(Clock):
+    """Time that goes rate times faster than real time, from start (by
+    default, the real time now)"""
+
+    def __init__(self, rate, start=None):
+        self.rate = float(rate)
+        self._real_start = _time.time()
+        self._start = self._real_start if start is None else start
+
+    def __repr__(self):
+        return "ScaledClock(%g)" % self.rate
+
+    def time(self):
+        return self._start + (_time.time() - self._real_start) * self.rate
+
+    def sleep(self, seconds):
+        _time.sleep(max(seconds, 0) / self.rate)
+
+    def timeout(self, seconds):
+        if seconds is None:
+            return None
+        return seconds / self.rate
+
+
+#
+# Shared clock
+#
+
+_clock = Clock()
+_clock_lock = threading.Lock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """Time everything by clock from now on. Returns the one it replaces."""
+    global _clock
+    with _clock_lock:
+        old, _clock = _clock, clock
+    return old
+
+
+def time():
+    return _clock.time()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def timeout(seconds):
+    return _clock.timeout(seconds)
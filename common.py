@@ -11,75 +11,148 @@ __author__  = "Wes Modes <wmodes@gmail.com>"
 __version__ = "1.0pre0"
 __license__ = "MIT"
 
-from time import sleep, time
+# what "from common import *" brings in; not the clock's time() and
+# sleep(), which modules that keep real time would otherwise get
+__all__ = ['logger', 'format_args', 'report', 'debug', 'update', 'Lazy',
+           'lazy_format', 'RateLimiter']
+
+from collections import OrderedDict
 import sys
 import logging
 import warnings
 
 # local modules
+from clock import sleep, time
 import config
+import logwriter
 
 
 #
 # Globals
 #
 
+class RateLimiter(object):
+    """Remembers when each message was last let through, for at most
+    size distinct messages (forgetting the least recently seen), so
+    it can't grow without bound"""
+
+    def __init__(self, interval, size):
+        self.interval = interval
+        self.size = size
+        self._last = OrderedDict()
+
+    def __len__(self):
+        return len(self._last)
+
+    def allow(self, text):
+        """Should text be logged now?"""
+        now = time()
+        last = self._last.pop(text, None)
+        if last is not None and now <= last + self.interval:
+            # too soon; put it back as most recently seen
+            self._last[text] = last
+            return False
+        self._last[text] = now
+        if len(self._last) > self.size:
+            self._last.popitem(last=False)
+        return True
+
+
+class Lazy(object):
+    """An argument to debug() that is only worked out if the message is
+    actually logged, e.g. debug("films:", Lazy(pformat, films), level=2)"""
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def lazy_format(fmt, *args):
+    """fmt % args, as a Lazy argument to debug(), e.g.
+    debug(lazy_format("took %.2fs", took))"""
+    return Lazy(fmt.__mod__, args)
+
+
 # we only report each error periodically,
 # so we keep a record of last report time
-last_report_time = {}
-# report interval in seconds
 report_interval = 5
+last_report_time = RateLimiter(report_interval, config.log_ratelimit_size)
 
 # we only report each DEBUG msg periodically,
 # so we keep a record of last debug time
-last_debug_time = {}
-# report interval in seconds
 debug_interval = 1
-# last function that called debug
+last_debug_time = RateLimiter(debug_interval, config.log_ratelimit_size)
+# last function that called debug (only tracked with config.debug_callers)
 debug_last_caller = ""
 
-# create logger 
-logger = logging.getLogger(__appname__)
-logging.basicConfig(filename=config.logfile, level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+class _Logger(logging.Logger):
+    """We don't log source locations, so don't walk the stack for them on
+    every call. Just our logger, not everyone's (as logging._srcfile
+    would be)."""
+
+    def findCaller(self, *args):
+        return "(unknown file)", 0, "(unknown function)"
+
+
+# create logger, writing through a background queue. Made directly
+# rather than by setLoggerClass(), which would change every logger
+logger = _Logger(__appname__)
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
+log_handler = logwriter.QueuedFileHandler(config.logfile, config.log_max_bytes,
+                                          config.log_backup_count,
+                                          config.log_batch_interval)
+log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+logger.addHandler(log_handler)
 warnings.filterwarnings('ignore')
 
+
+def format_args(args):
+    """Join arguments with spaces, like print does"""
+    if len(args) == 1:
+        return str(args[0])
+    return " ".join(map(str, args))
+
+
 def report(*args):
     """immediately report information.
     Note: Accepts multiple arguments"""
-    text = " ".join(list(map(str, args)))
     #print text
-    logger.info(text)
+    logger.info(format_args(args))
 
 
 def debug(*args, **kargs):
-    """Produce debug message, indenting if from same calling function"""
+    """Produce debug message if level is within config.debug. Nothing
+    is formatted unless the message is going to be logged."""
     global debug_last_caller
-    if 'level' in kargs:
-        level = kargs['level']
+    if kargs.get('level', 1) > config.debug:
+        return
+    text = format_args(args)
+    # if now is greater than our last debug time + an interval
+    if not last_debug_time.allow(text):
+        return
+    if not config.debug_callers:
+        logger.info("debug: " + text)
+        return
+    # indent if from the same calling function
+    caller = sys._getframe(1).f_code.co_name
+    if (caller == debug_last_caller):
+        logger.info("    debug: %s: %s" % (caller, text))
     else:
-        level = 1
-    if (level <= config.debug):
-        text = " ".join(list(map(str, args)))
-        caller = sys._getframe(1).f_code.co_name
-        # if now is greater than our last debug time + an interval
-        if (text not in last_debug_time or
-                time() > last_debug_time[text] + debug_interval):
-            if (caller == debug_last_caller):
-                report("    debug: %s: %s" % (caller, text))
-            else:
-                report("debug: %s: %s" % (caller, text))
-            last_debug_time[text] = time()
-        debug_last_caller = caller
+        logger.info("debug: %s: %s" % (caller, text))
+    debug_last_caller = caller
 
 
 def update(*args):
     """periodically report information at report_interval seconds.
     Note: Accepts multiple arguments"""
-    text = " ".join(list(map(str, args)))
+    text = format_args(args)
     # if now is greater than our last report time + an interval
-    if (text not in last_report_time or
-            time() > last_report_time[text] + report_interval):
-        report(text)
-        last_report_time[text] = time()
+    if last_report_time.allow(text):
+        logger.info(text)
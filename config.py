@@ -11,14 +11,194 @@ debug = 3
 media_base = '../media'
 filmdb = 'FILM_DB.json'
 logfile = '/var/log/exhibitvideo/exhibitvideo.log'
+# rotate the log at this size, keeping this many old ones
+log_max_bytes = 5 * 1024 * 1024
+log_backup_count = 3
+# the log writer gathers messages for this long between writes
+log_batch_interval = 1.0
+# how many distinct messages the rate limiter remembers
+log_ratelimit_size = 256
+# name the calling function in debug messages (costs a frame lookup)
+debug_callers = False
 inter_video_delay = 0.25
 
+# Playback timing stats are written here every metrics_interval seconds,
+# as a Prometheus textfile if the name ends in .prom, otherwise as JSON.
+# None turns metrics off. metrics_screen labels the stats (default: hostname).
+metrics_file = None
+metrics_interval = 60
+metrics_screen = None
+
+ffprobe_cmd = ['ffprobe']
+ffmpeg_cmd = ['ffmpeg']
+# read MP4/MOV headers ourselves, and only run ffprobe for other formats
+native_probe = True
+
+# ffprobe results are cached here, keyed by path, size and mtime
+# set media_cache_file to None to turn caching off
+media_cache_file = '/var/cache/exhibitvideo/media_cache.json'
+media_cache_max_entries = 2000
+# number of ffprobe processes run at once when probing the catalog
+probe_workers = 4
+
+# keyframe index, built at load time for films with a 'start', so
+# starts can be moved onto keyframes (omxplayer otherwise decodes from
+# the keyframe before, which can stall for seconds on long GOPs)
+keyframe_index = True
+# 'previous', 'nearest' or None to leave starts alone
+keyframe_snap = 'nearest'
+# don't move a start by more than this many seconds
+keyframe_snap_window = 1.0
+# report starts this many seconds or more past their keyframe
+keyframe_slow_seek = 2.0
+
+# clips that start partway in or are cut short are pre-cut into this
+# directory in the background (ffmpeg stream copy) and played from there
+# set segment_dir to None to turn this off
+segment_dir = '/var/cache/exhibitvideo/segments'
+# at most this many bytes of segments, and keep this much disk free
+segment_budget = 2 * 1024 * 1024 * 1024
+segment_min_free = 512 * 1024 * 1024
+# ffmpeg processes run at once, at low priority
+segment_workers = 1
+segment_cmd = ['nice', '-n', '19'] + ffmpeg_cmd
+
+# several players in step: one 'coordinator' runs the recipe and tells
+# the 'follower's what to play and when, over UDP multicast
+# None plays alone
+sync_role = None
+sync_group = '239.255.42.99'
+sync_port = 5099
+# address of the interface to multicast on ('127.0.0.1' to try several
+# players on one machine), and how many routers the schedule may cross
+sync_interface = '0.0.0.0'
+sync_ttl = 1
+# clips are announced this many seconds ahead; must cover player startup
+sync_lead = 1.0
+# how often followers check their clock against the coordinator's
+sync_ping_interval = 1.0
+# this player's name in skew reports (None for the hostname)
+sync_node = None
+# how often the coordinator logs the skew between screens
+sync_report_interval = 60
+
+# files with these extensions are media
+media_extensions = ['.mp4', '.m4v', '.mov', '.mkv', '.avi', '.mpg', '.mpeg', '.ts', '.webm']
+
+# watch the media directory, so clips added or removed while we run
+# come into or go out of rotation without a restart
+watch_media = True
+# use inotify where we can; otherwise poll the directory's mtime
+watch_inotify = True
+watch_poll_interval = 2.0
+# when polling, look at every file this often, for files rewritten in place
+watch_rescan_interval = 60.0
+
+# ingest.py: preparing the media directory
+# processes used for hashing, remuxing and transcoding
+ingest_workers = 2
+# what the player decodes in hardware; anything else is transcoded
+ingest_codecs = ['h264']
+ingest_max_height = 1080
+ingest_transcode_args = ['-map', '0:v:0', '-map', '0:a?', '-c:v', 'libx264',
+                         '-preset', 'medium', '-crf', '20', '-profile:v', 'high',
+                         '-pix_fmt', 'yuv420p', '-vf', "scale=-2:'min(1080,ih)'",
+                         '-c:a', 'aac', '-b:a', '192k', '-movflags', '+faststart']
+# transcoded originals are moved here, inside the media directory
+# (None deletes them)
+ingest_originals = 'originals'
+# what ingest knows about each file, kept in the media directory
+ingest_state_file = '.ingest.json'
+
 omx_cmd = ['omxplayer', '--no-osd', '--no-keys', '--refresh', '--aspect-mode stretch']
 #omx_cmd = ['omxplayer', '--no-osd', '--no-keys', '--refresh']
 content_cmd = omx_cmd + ['--layer %i', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer%i']
 loop_cmd = omx_cmd + ['--layer %i', '--loop', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer%i']
 transition_cmd = omx_cmd + ['--layer %i', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer%i']
 
+# Players are run directly, without a shell, in their own session.
+# Under python 2 we use setsid(1) for that; set to [] to fall back to
+# calling setsid() from python in the child.
+setsid_cmd = ['setsid']
+
+# D-Bus name of player %i (must match the --dbus_name above)
+dbus_name = 'org.mpris.MediaPlayer2.omxplayer%i'
+# omxplayer leaves the address of its session bus here (%s is the user)
+dbus_address_file = '/tmp/omxplayerdbus.%s'
+# talk to the players over one connection of our own (needs dbus-python
+# and PyGObject), rather than running dbus-send for every call; without
+# them, dbus-send is used anyway
+dbus_native = True
+dbus_send_cmd = ['dbus-send', '--print-reply=literal', '--session', '--reply-timeout=500']
+
+# Pre-roll: start the next clip's player hidden and paused on the other
+# layer, and reveal it at the clip boundary. How early we start it is
+# learned from measured player startup time (times preroll_margin),
+# kept between preroll_min_lead and preroll_max_lead seconds.
+preroll = False
+preroll_margin = 1.5
+preroll_min_lead = 0.5
+preroll_max_lead = 4.0
+
+# Player pool: keep a few players running, one per layer, and drive
+# them over D-Bus instead of spawning a player per clip
+player_pool = False
+player_pool_layers = [1, 2]
+# seconds to wait for a freshly spawned pooled player to answer
+player_pool_startup_timeout = 5.0
+
+# Clips run as callbacks on one event loop; the blocking parts (ffprobe,
+# D-Bus calls) on this many worker threads
+engine_workers = 4
+
+# Watchdog: a player that shows no sign of life watchdog_startup
+# seconds after starting, or whose position stops moving for
+# watchdog_stall seconds, is killed and the next clip started. Players
+# are looked at when they could be hung by then, but no more often than
+# every watchdog_interval seconds (None turns checks off).
+watchdog_interval = 1.0
+watchdog_startup = 5.0
+watchdog_stall = 3.0
+
+# a player told to stop that is still there (itself, or anything it
+# started) teardown_timeout seconds later is killed
+teardown_timeout = 2.0
+
+# lines of each player's output kept for error reports (add '--stats'
+# to omx_cmd and its progress lines count as signs of life too)
+player_output_lines = 50
+
+# Fast start: a few loops and titles from the last full catalog load
+# are remembered in startup_snapshot, and played (for
+# startup_clip_length seconds each, 0 for their own length) as soon as
+# we start, while the catalog loads. None turns this off.
+startup_snapshot = '/var/cache/exhibitvideo/startup.json'
+startup_tags = ['loop', 'title']
+startup_clip_length = 10.0
+
+# Playback journal: each clip that goes on screen is appended to
+# journal_file, so after a crash or a reboot each channel carries on
+# where it left off (in its recipe, and partway into the clip that was
+# playing). Rewritten down to the last journal_history clips of each
+# channel every journal_compact clips. None turns it off.
+journal_file = '/var/cache/exhibitvideo/journal.log'
+journal_compact = 200
+journal_history = 20
+
+# Channels: several screens from one process, or several layer ranges
+# on one screen, each with its own recipe, layers and player numbers.
+# A channel may be limited to films carrying a tag of its own
+# ('require'). None is a single channel playing recipedb on layers 1
+# and 2 as players 1 and 2. e.g. both HDMI ports of a Pi 4 (omxplayer
+# calls them displays 2 and 7):
+#   channels = [
+#       {'name': 'left', 'display': 2, 'recipe': recipedb, 'require': 'left'},
+#       {'name': 'right', 'display': 7, 'recipe': recipedb, 'require': 'right'},
+#   ]
+# Layers default to [1, 2]; player numbers to 1, 2 for the first
+# channel, 3, 4 for the second, and so on.
+channels = None
+
 # A recipe for film sequencing - a list of tuples (<tag>, <length>)
 # note length here, overrides db values, and 0 takes db value
 # possible values: footage, interview, title, trailer
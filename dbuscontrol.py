@@ -0,0 +1,307 @@
+#!/usr/bin/python
+"""dbuscontrol.py: control running players over their MPRIS D-Bus interface
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# This does what omxplayer's own dbuscontrol.sh does: omxplayer starts
+# a private session bus and leaves its address in /tmp/omxplayerdbus.$USER,
+# and we talk to it.
+#
+# With dbus-python (python-dbus on Debian) we keep one connection to
+# that bus for all players, and calls cost a round trip on it, not a
+# process. A GLib main loop on a thread of its own hears the bus's
+# NameOwnerChanged signal, so waiting for a player to come up is a
+# wait on an event rather than a poll. If the bus goes away (the last
+# player gone, or omxplayer started a new one) we connect again on the
+# next call. Without dbus-python, or with config.dbus_native off, each
+# call runs dbus-send, as before.
+#
+# Note omxplayer's quirks: Position and Duration are methods on the
+# Properties interface, and SetAlpha/SetPosition take a dummy object path.
+#
+
+import os
+import getpass
+import threading
+import subprocess
+from time import sleep, time
+
+try:
+    import dbus
+    import dbus.bus
+    import dbus.mainloop.glib
+    try:
+        from gi.repository import GLib as mainloop
+    except ImportError:
+        import gobject as mainloop
+except ImportError:
+    dbus = None
+
+# local modules
+from common import *
+import config
+
+nullin = open(os.devnull, 'r')
+
+#
+# Constants
+#
+
+OBJECT_PATH = '/org/mpris/MediaPlayer2'
+ROOT_IFACE = 'org.mpris.MediaPlayer2'
+PLAYER_IFACE = 'org.mpris.MediaPlayer2.Player'
+PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+DUMMY_PATH = '/not/used'
+BUS_NAME = 'org.freedesktop.DBus'
+BUS_PATH = '/org/freedesktop/DBus'
+
+# how often we ask a starting player whether it is up yet, when we
+# can't be told (dbus-send, or no bus yet)
+READY_POLL_INTERVAL = 0.02
+# seconds we wait for a reply, as dbus-send's --reply-timeout
+CALL_TIMEOUT = 0.5
+# dbus-send's names for the argument types we send
+SEND_TYPES = {'x': 'int64', 'o': 'objpath', 's': 'string'}
+
+
+def bus_address():
+    """The players' bus address, or None if no player has written it"""
+    try:
+        with open(config.dbus_address_file % getpass.getuser(), 'r') as fp:
+            return fp.read().strip() or None
+    except IOError:
+        return None
+
+
+def bus_env():
+    """Environment for dbus-send, pointing at the players' session bus.
+    Falls back to our own environment if no player has written its
+    bus address yet."""
+    env = dict(os.environ)
+    filename = config.dbus_address_file % getpass.getuser()
+    try:
+        with open(filename, 'r') as fp:
+            env['DBUS_SESSION_BUS_ADDRESS'] = fp.read().strip()
+        with open(filename + '.pid', 'r') as fp:
+            env['DBUS_SESSION_BUS_PID'] = fp.read().strip()
+    except IOError:
+        pass
+    return env
+
+
+def native():
+    """Do we talk to the bus ourselves, rather than with dbus-send?"""
+    return dbus is not None and config.dbus_native
+
+
+class Bus(object):
+    """One connection to the players' bus, and the main loop thread
+    that hears its signals"""
+
+    def __init__(self, address):
+        self.address = address
+        self._loop = mainloop.MainLoop()
+        self.connection = dbus.bus.BusConnection(
+            address, mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        self._thread = threading.Thread(target=self._loop.run, name='dbus')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def connected(self):
+        return self.connection.get_is_connected()
+
+    def close(self):
+        self._loop.quit()
+        try:
+            self.connection.close()
+        except dbus.exceptions.DBusException:
+            pass
+
+
+_bus = None
+_bus_lock = threading.Lock()
+_threads_ready = False
+
+
+def get_bus():
+    """The shared connection to the players' bus, made (or made again,
+    if the bus has changed or gone) as needed. None if there is no bus
+    to talk to yet."""
+    global _bus, _threads_ready
+    address = bus_address()
+    with _bus_lock:
+        if _bus is not None and _bus.address == address and _bus.connected():
+            return _bus
+        if _bus is not None:
+            _bus.close()
+            _bus = None
+        if address is None:
+            return None
+        if not _threads_ready:
+            # we call in from the executor's threads
+            mainloop.threads_init()
+            dbus.mainloop.glib.threads_init()
+            _threads_ready = True
+        try:
+            _bus = Bus(address)
+        except dbus.exceptions.DBusException as e:
+            debug("Couldn't connect to the players' bus: %s" % str(e), level=2)
+        return _bus
+
+
+def shutdown():
+    """Close the connection, if we have one"""
+    global _bus
+    with _bus_lock:
+        if _bus is not None:
+            _bus.close()
+            _bus = None
+
+
+class PlayerControl(object):
+    """Remote control for one player, by D-Bus name"""
+
+    def __init__(self, dbus_name):
+        self.dbus_name = dbus_name
+
+    def __repr__(self):
+        return "PlayerControl(%r)" % self.dbus_name
+
+    def call(self, interface, method, signature='', *args):
+        """Call a method on the player, with args of the given D-Bus
+        signature. Returns the reply (True if there is none to give), or
+        None if the call failed (player not up, gone, or hung)."""
+        if native():
+            return self._call_bus(interface, method, signature, args)
+        return self._call_send(interface, method, signature, args)
+
+    def _call_bus(self, interface, method, signature, args):
+        bus = get_bus()
+        if bus is None:
+            return None
+        try:
+            reply = bus.connection.call_blocking(self.dbus_name, OBJECT_PATH, interface,
+                                                 method, signature, args,
+                                                 timeout=CALL_TIMEOUT)
+        except dbus.exceptions.DBusException as e:
+            debug("D-Bus call", method, "to", self.dbus_name, "failed:", Lazy(str, e), level=2)
+            return None
+        return True if reply is None else reply
+
+    def _call_send(self, interface, method, signature, args):
+        cmd = config.dbus_send_cmd + ['--dest=' + self.dbus_name, OBJECT_PATH,
+                                      interface + '.' + method]
+        cmd += ['%s:%s' % (SEND_TYPES[kind], arg) for kind, arg in zip(signature, args)]
+        try:
+            process = subprocess.Popen(cmd, stdin=nullin, env=bus_env(),
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+        except OSError as e:
+            debug("Couldn't run dbus-send: %s" % str(e), level=2)
+            return None
+        if process.returncode != 0:
+            return None
+        # e.g. 'int64 1234567', or nothing
+        words = out.split()
+        if not words:
+            return True
+        try:
+            return int(words[-1]) if words[0] == 'int64' else out.strip()
+        except ValueError:
+            return None
+
+    def ready(self):
+        """Is the player up and answering?"""
+        return self.position() is not None
+
+    def wait_ready(self, timeout):
+        """Wait up to timeout seconds for the player to answer. Returns
+        True if it did."""
+        deadline = time() + timeout
+        while time() < deadline:
+            if native():
+                bus = get_bus()
+                if bus is not None:
+                    return self._wait_owner(bus, deadline - time())
+            elif self.ready():
+                return True
+            # no bus yet: the first player is still starting it
+            sleep(READY_POLL_INTERVAL)
+        return False
+
+    def _wait_owner(self, bus, timeout):
+        """Wait for our name to be taken on the bus, as the player takes
+        it once it is up, then check it answers"""
+        owned = threading.Event()
+
+        def owner_changed(name, old_owner, new_owner):
+            if new_owner:
+                owned.set()
+
+        # listen before asking, so we can't miss it in between
+        match = bus.connection.add_signal_receiver(
+            owner_changed, 'NameOwnerChanged', BUS_NAME, BUS_NAME, BUS_PATH,
+            arg0=self.dbus_name)
+        try:
+            if not bus.connection.name_has_owner(self.dbus_name):
+                owned.wait(max(timeout, 0))
+        except dbus.exceptions.DBusException:
+            return False
+        finally:
+            match.remove()
+        return owned.is_set() or self.ready()
+
+    def position(self):
+        """Playback position in seconds, or None"""
+        return _seconds(self.call(PROPS_IFACE, 'Position'))
+
+    def duration(self):
+        """Length of the open file in seconds, or None"""
+        return _seconds(self.call(PROPS_IFACE, 'Duration'))
+
+    def play(self):
+        return self.call(PLAYER_IFACE, 'Play') is not None
+
+    def pause(self):
+        return self.call(PLAYER_IFACE, 'Pause') is not None
+
+    def stop(self):
+        return self.call(PLAYER_IFACE, 'Stop') is not None
+
+    def quit(self):
+        return self.call(ROOT_IFACE, 'Quit') is not None
+
+    def seek(self, offset):
+        """Seek relative to the current position, in seconds"""
+        return self.call(PLAYER_IFACE, 'Seek', 'x', int(offset * 1e6)) is not None
+
+    def set_position(self, position):
+        """Seek to an absolute position, in seconds"""
+        return self.call(PLAYER_IFACE, 'SetPosition', 'ox', DUMMY_PATH,
+                         int(position * 1e6)) is not None
+
+    def open_uri(self, filename):
+        return self.call(PLAYER_IFACE, 'OpenUri', 's', filename) is not None
+
+    def set_alpha(self, alpha):
+        return self.call(PLAYER_IFACE, 'SetAlpha', 'ox', DUMMY_PATH, alpha) is not None
+
+    def hide_video(self):
+        return self.call(PLAYER_IFACE, 'HideVideo') is not None
+
+    def unhide_video(self):
+        return self.call(PLAYER_IFACE, 'UnHideVideo') is not None
+
+
+def _seconds(reply):
+    """Seconds from a reply of int64 microseconds"""
+    if reply is None or reply is True:
+        return None
+    try:
+        return int(reply) / 1e6
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+"""engine.py: one select() loop for every player, timer and signal
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Rather than a thread per clip, each sleeping on its own player, one
+# thread runs an event loop and every playing clip is a set of
+# callbacks on it: a reader on the player's output, a timer for its
+# deadline, another for a pre-rolled reveal. The loop sleeps in a
+# single select() until the next timer is due or some file is ready.
+#
+# What it offers, much like asyncio's loop (which python 2 doesn't
+# have):
+#
+#   call_soon_threadsafe(fn, *args)    run fn on the loop, from anywhere
+#   call_at(when, fn, *args)           run fn at time() == when
+#   call_later(delay, fn, *args)       ... or delay seconds from now
+#   add_reader(file, fn)               run fn whenever file is readable
+#   run_in_executor(fn, args, done)    run a blocking fn (ffprobe,
+#                                      D-Bus calls) on a worker thread,
+#                                      then done(result, error) on the loop
+#   add_signal_handler(signum, fn)     run fn on the loop when signalled
+#
+# Callbacks must not block: anything slow goes to the executor, a small
+# pool of long-lived worker threads. Callbacks run one at a time, so
+# state they share needs no locks, as long as other threads only touch
+# it through call_soon_threadsafe().
+#
+# Python only runs signal handlers in the main thread, and the loop
+# usually runs on a thread of its own, so a signal handler just queues
+# its callback and pokes the loop awake through its wakeup pipe.
+#
+# Timers go by clock.time(), which is real time unless a soak test has
+# sped it up.
+#
+
+import os
+import fcntl
+import errno
+import heapq
+import select
+import signal
+import threading
+import traceback
+from collections import deque
+from itertools import count
+from multiprocessing.pool import ThreadPool
+
+# local modules
+import clock
+from clock import time
+from common import *
+import config
+
+
+class Timer(object):
+    """A callback due at a certain time, which can be cancelled"""
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        # it stays in the heap until it's due; don't keep what it
+        # would have called alive until then
+        self.fn = self.args = None
+
+
+class Loop(object):
+    """A select()-based event loop"""
+
+    def __init__(self, workers=None):
+        self.workers = workers or config.engine_workers
+        # file descriptor -> (file, callback)
+        self._readers = {}
+        # heap of (when, order, Timer)
+        self._timers = []
+        self._order = count()
+        # calls queued from other threads (and signal handlers)
+        self._calls = deque()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._stopping = False
+        self.thread = None
+
+    #
+    # Scheduling
+    #
+
+    def call_soon_threadsafe(self, fn, *args):
+        self._calls.append((fn, args))
+        self._wakeup()
+
+    def call_at(self, when, fn, *args):
+        """Run fn(*args) at when. Only call this on the loop."""
+        timer = Timer(when, fn, args)
+        heapq.heappush(self._timers, (when, next(self._order), timer))
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(time() + delay, fn, *args)
+
+    def add_reader(self, fileobj, fn):
+        """Call fn() whenever fileobj is readable. Only call this on the loop."""
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self._readers[fd] = (fileobj, fn)
+
+    def remove_reader(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self._readers.pop(fd, None) is not None
+
+    def run_in_executor(self, fn, args=(), done=None):
+        """Run fn(*args) on a worker thread, then done(result, error) on
+        the loop, with error the exception fn raised, or None"""
+        def work():
+            try:
+                result, error = fn(*args), None
+            except Exception as e:
+                debug("%s failed: %s" % (getattr(fn, '__name__', fn), str(e)))
+                debug(traceback.format_exc(), level=2)
+                result, error = None, e
+            if done is not None:
+                self.call_soon_threadsafe(done, result, error)
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPool(self.workers)
+            self._executor.apply_async(work)
+
+    def add_signal_handler(self, signum, fn):
+        """Run fn() on the loop when we get signum. Like signal.signal(),
+        this can only be called from the main thread."""
+        signal.signal(signum, lambda signum, frame: self.call_soon_threadsafe(fn))
+
+    #
+    # Running
+    #
+
+    def run_forever(self):
+        """Run callbacks until stop() is called"""
+        self._stopping = False
+        while not self._stopping:
+            self._run_once()
+
+    def stop(self):
+        """Stop the loop, from any thread, once the current callback is done"""
+        def stopping():
+            self._stopping = True
+        self.call_soon_threadsafe(stopping)
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.terminate()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            os.close(fd)
+
+    def _run_once(self):
+        timeout = None
+        if self._calls:
+            timeout = 0
+        elif self._timers:
+            timeout = clock.timeout(max(self._timers[0][0] - time(), 0))
+        files = list(self._readers) + [self._wakeup_read]
+        try:
+            ready = select.select(files, [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if self._wakeup_read in ready:
+            self._drain_wakeup()
+        while self._calls:
+            fn, args = self._calls.popleft()
+            self._call(fn, args)
+        for fd in ready:
+            # a callback may have removed it meanwhile
+            reader = self._readers.get(fd)
+            if reader is not None:
+                self._call(reader[1], ())
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._call(timer.fn, timer.args)
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            report("Error in %s: %s" % (getattr(fn, '__name__', fn), str(e)))
+            debug(traceback.format_exc())
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'x')
+        except OSError as e:
+            # the pipe is full, so the loop is awake already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+#
+# Shared loop
+#
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the shared loop, started on a thread of its own on first use"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = Loop()
+                loop.thread = threading.Thread(target=loop.run_forever, name='engine')
+                loop.thread.daemon = True
+                loop.thread.start()
+                _loop = loop
+    return _loop
+
+
+def shutdown():
+    """Stop the shared loop, if it was ever started"""
+    global _loop
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is not None:
+        loop.stop()
+        loop.thread.join()
+        loop.close()
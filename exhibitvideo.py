@@ -7,100 +7,105 @@ Copyright: 2017, MIT """
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 from random import choice
-import os
-from subprocess import call
-from pprint import pformat
+import signal
 
 # local modules
-import videothread
+import channel
+import dbuscontrol
+import engine
+import mediacache
+import playerpool
+import reaper
+import segments
+import startup
+import sync
+import metrics
 from common import *
 import config
 from video import *
+from catalog import Catalog
+from watcher import Watcher
 
 
 #
-# Globals
+# Control
 #
-last_thread = None
 
-#
-# Preparatory
-#
+def stop_channels(channels):
+    report("Stopping")
+    for each in channels:
+        each.stop()
 
-def create_film_lists_dict(film_list):
-    """Iterate through imported database and sort list by type"""
-    film_lists_dict = {}
-    for film in film_list:
-        if 'disabled' not in film or not film['disabled']:
-            # make lists of film types
-            # Note, that this means a film can be in several lists
-            if 'tags' in film:
-                for tag in film['tags']:
-                    if tag not in film_lists_dict: 
-                        film_lists_dict[tag] = [film]
-                    else:
-                        film_lists_dict[tag].append(film)
-    return film_lists_dict
 
-#
-# Control
-#
+def on_sigterm(stop):
+    """On SIGTERM, call stop, to wind down cleanly"""
+    try:
+        engine.get_loop().add_signal_handler(signal.SIGTERM, stop)
+    except ValueError:
+        # not the main thread; whoever runs us looks after signals
+        pass
 
-def main():
-    global last_thread
+
+def main(steps=None):
+    """Play the recipe forever, or for the given number of recipe steps"""
     # setup everything
     report("Starting exhibitvideo")
+    boot = startup.Boot()
+    # something to show while the catalog loads
+    warm_films = startup.load_snapshot()
     report("Reading film database")
-    film_list = read_film_file(config.media_base + '/' + config.filmdb)
-    debug("\nfilm_list = \n", pformat(film_list), level=2)
-    film_dict = create_film_lists_dict(film_list)
-    debug("\nfilm_dict = \n", pformat(film_dict), level=2)
-    recipe_index = 0
+    # the catalog also warms the media cache, so clips don't wait on
+    # ffprobe at play time. It loads in the background, so the first
+    # frame needn't wait for it.
+    catalog = Catalog(config.media_base + '/' + config.filmdb, load=False)
+    catalog.load_in_background()
+    startup.when_loaded(catalog, boot)
+    # keep the catalog in step with the media directory
+    watcher = None
+    if config.watch_media:
+        watcher = Watcher(config.media_base, catalog.media_changed)
+        watcher.start()
+    coordinator = None
+    channels = []
     try:
-        while True:
-            this_recipe, duration = config.recipedb[recipe_index]
-            recipe_index += 1
-            if recipe_index >= len(config.recipedb):
-                recipe_index = 0
-            # max_content = len(content_film_list)-1
-            # print ""
-            # next_film = raw_input("Next video (0-%i or 'q' to quit): " % max_content)
-            # if ('q' in next_film):
-            #     break
-            # if (str.isdigit(next_film) and int(next_film) >= 0 and int(next_film) <= max_content):
-            #     content_film = content_film_list[int(next_film)]
-            # elif (next_film in content_film_dict):
-            #     content_film = choice(content_film_dict[next_film])
-            # else:
-            #     continue
-            if this_recipe in film_dict:
-                debug("Next recipe (%i): %s, duration %.2fs, %i choices" % (recipe_index,
-                      this_recipe, duration, len(film_dict[this_recipe])) )
-                content_film = choice(film_dict[this_recipe])
-                # if we have an override duration, add to film record
-                if duration:
-                    content_film['length'] = duration
-                debug("Selected film: %s" % content_film, debug=2)
-                content_thread = videothread.VideoThread(content_film, config.media_base, debug=config.debug) 
-                # start new video
-                content_thread.start()
-                # # kill the previous one if it is still around
-                # if last_thread:
-                #     last_thread.stop()
-                # # store current handle for later
-                # last_thread = content_thread
-                # now wait synchronously for end of video
-                content_thread.wait_for_end()
+        # followers play what the coordinator says, not the recipe
+        if config.sync_role == 'follower':
+            catalog.ready.wait()
+            follower = sync.Follower(catalog)
+            on_sigterm(follower.stop)
+            follower.run(steps)
+            return
+        if config.sync_role == 'coordinator':
+            coordinator = sync.Coordinator()
+            coordinator.start()
+        # each screen plays its own recipe; the first keeps the followers in step
+        channels = channel.from_config(catalog, coordinator)
+        channels[0].on_first_shown = boot.first_frame
+        on_sigterm(lambda: stop_channels(channels))
+        channel.play(channels, steps, warm_films)
 
     except Exception, e:
         debug("Encountered exception: %s" % str(e))
         print ""
         print "Done."
-        nullin = open(os.devnull, 'r')
-        nullout = open(os.devnull, 'w')
-        call(["killall", "-9", "omxplayer", "omxplayer.bin"], stdout=nullout, stderr=nullout)
-        nullin.close()
-        nullout.close()
+        stop_channels(channels)
+
+    finally:
+        # however we got here: players killed, pools shut down, caches
+        # written
+        if watcher:
+            watcher.stop()
+        if coordinator:
+            coordinator.stop()
+        playerpool.shutdown()
+        for each in channels:
+            each.shutdown()
+        segments.shutdown()
+        mediacache.flush()
+        # every player we started, gone for sure
+        reaper.shutdown()
+        dbuscontrol.shutdown()
+        engine.shutdown()
 
 
 if __name__ == "__main__":
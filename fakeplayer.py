@@ -0,0 +1,319 @@
+#!/usr/bin/python
+"""fakeplayer.py: a stand-in for omxplayer, for testing away from the Pi
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Takes the same command line as omxplayer (the parts we use) and serves
+# the same MPRIS D-Bus methods under its --dbus_name, but instead of
+# decoding video it just keeps time. It prints what it is doing to
+# stdout, and exits at the end of the file unless --loop is given.
+#
+# To use it, point the player command in config.py at it:
+#
+#   omx_cmd = ['python /path/to/fakeplayer.py', '--no-osd', ...]
+#
+# For benchmarks it can also misbehave on request, through the
+# environment:
+#
+#   FAKEPLAYER_STARTUP_DELAY  seconds to wait before coming up
+#   FAKEPLAYER_RUNTIME        play this long, whatever the file
+#   FAKEPLAYER_FAILURE_RATE   chance (0..1) of failing at startup
+#   FAKEPLAYER_HANG_RATE      chance (0..1) of hanging at startup,
+#                             silent and unresponsive until killed
+#   FAKEPLAYER_STUBBORN_RATE  chance (0..1) of ignoring SIGTERM, and
+#                             leaving a child behind that does too,
+#                             like a wedged omxplayer.bin
+#
+# D-Bus support needs dbus-python and PyGObject (python-dbus and
+# python-gi on Debian). It talks on the session bus, and like omxplayer
+# leaves the bus address in /tmp/omxplayerdbus.$USER.
+#
+
+import os
+import sys
+import random
+import signal
+import getpass
+import argparse
+from time import sleep, time
+
+try:
+    import dbus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop
+    try:
+        from gi.repository import GLib as mainloop
+    except ImportError:
+        import gobject as mainloop
+except ImportError:
+    dbus = None
+
+OBJECT_PATH = '/org/mpris/MediaPlayer2'
+ROOT_IFACE = 'org.mpris.MediaPlayer2'
+PLAYER_IFACE = 'org.mpris.MediaPlayer2.Player'
+PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+
+# used when we can't work out how long a file is
+DEFAULT_DURATION = 30.0
+# how often --stats prints a status line
+STATS_INTERVAL = 0.5
+
+
+class FakeClock(object):
+    """Playback state of the fake player: which file, where we are in
+    it, and whether we're paused, hidden or transparent"""
+
+    def __init__(self, filename, duration, position=0.0, loop=False, alpha=255):
+        self.filename = filename
+        self.duration = duration
+        self.loop = loop
+        self.alpha = alpha
+        self.hidden = False
+        self.paused = False
+        self._position = position
+        self._since = time()
+
+    def position(self):
+        if self.paused:
+            return self._position
+        pos = self._position + time() - self._since
+        if self.loop and self.duration:
+            pos %= self.duration
+        return min(pos, self.duration)
+
+    def remaining(self):
+        """Seconds until the end of the file, or None if we'll never get there"""
+        if self.paused or self.loop:
+            return None
+        return max(self.duration - self.position(), 0.0)
+
+    def set_position(self, position):
+        self._position = max(0.0, min(position, self.duration))
+        self._since = time()
+
+    def pause(self):
+        if not self.paused:
+            self._position = self.position()
+            self.paused = True
+
+    def play(self):
+        if self.paused:
+            self._since = time()
+            self.paused = False
+
+    def open(self, filename, duration):
+        self.filename = filename
+        self.duration = duration
+        self.set_position(0.0)
+        self.paused = False
+
+
+def file_duration(filename):
+    """How long the file is, asking ffprobe if we can"""
+    try:
+        import ffprobe
+        length = ffprobe.duration(filename)
+    except Exception:
+        length = None
+    return length or DEFAULT_DURATION
+
+
+def stats(clock):
+    """A status line like omxplayer --stats prints, media time first"""
+    sys.stdout.write("M:%8i V:  0.00s      0k/     0k A:  0.00  0.00s/ 0.00s Cv:     0k Ca:     0k\r"
+                     % (clock.position() * 1e6))
+    sys.stdout.flush()
+    return True
+
+
+def say(*args):
+    print "fakeplayer:", " ".join(map(str, args))
+    sys.stdout.flush()
+
+
+if dbus is not None:
+
+    class FakePlayerService(dbus.service.Object):
+        """omxplayer's D-Bus interface, served from a FakeClock"""
+
+        def __init__(self, bus, name, clock, quit):
+            self._name = dbus.service.BusName(name, bus)
+            dbus.service.Object.__init__(self, bus, OBJECT_PATH)
+            self.clock = clock
+            self._quit = quit
+            self._eof_timer = None
+            self.schedule_eof()
+
+        def schedule_eof(self):
+            """Arrange to stop at the end of the file"""
+            if self._eof_timer is not None:
+                mainloop.source_remove(self._eof_timer)
+                self._eof_timer = None
+            remaining = self.clock.remaining()
+            if remaining is not None:
+                self._eof_timer = mainloop.timeout_add(int(remaining * 1000) + 1,
+                                                       self._eof)
+
+        def _eof(self):
+            self._eof_timer = None
+            say("end of", self.clock.filename)
+            self._quit()
+            return False
+
+        @dbus.service.method(ROOT_IFACE)
+        def Quit(self):
+            say("quit")
+            self._quit()
+
+        @dbus.service.method(PROPS_IFACE, out_signature='x')
+        def Position(self):
+            return int(self.clock.position() * 1e6)
+
+        @dbus.service.method(PROPS_IFACE, out_signature='x')
+        def Duration(self):
+            return int(self.clock.duration * 1e6)
+
+        @dbus.service.method(PROPS_IFACE, out_signature='s')
+        def PlaybackStatus(self):
+            return 'Paused' if self.clock.paused else 'Playing'
+
+        @dbus.service.method(PLAYER_IFACE)
+        def Play(self):
+            say("play at %.3f" % self.clock.position())
+            self.clock.play()
+            self.schedule_eof()
+
+        @dbus.service.method(PLAYER_IFACE)
+        def Pause(self):
+            self.clock.pause()
+            say("pause at %.3f" % self.clock.position())
+            self.schedule_eof()
+
+        @dbus.service.method(PLAYER_IFACE)
+        def PlayPause(self):
+            if self.clock.paused:
+                self.Play()
+            else:
+                self.Pause()
+
+        @dbus.service.method(PLAYER_IFACE)
+        def Stop(self):
+            say("stop")
+            self._quit()
+
+        @dbus.service.method(PLAYER_IFACE, in_signature='x', out_signature='x')
+        def Seek(self, offset):
+            self.clock.set_position(self.clock.position() + offset / 1e6)
+            self.schedule_eof()
+            return offset
+
+        @dbus.service.method(PLAYER_IFACE, in_signature='ox', out_signature='x')
+        def SetPosition(self, path, position):
+            self.clock.set_position(position / 1e6)
+            say("position %.3f" % self.clock.position())
+            self.schedule_eof()
+            return position
+
+        @dbus.service.method(PLAYER_IFACE, in_signature='s', out_signature='s')
+        def OpenUri(self, uri):
+            self.clock.open(str(uri), file_duration(str(uri)))
+            say("open", uri)
+            self.schedule_eof()
+            return uri
+
+        @dbus.service.method(PLAYER_IFACE, in_signature='ox', out_signature='x')
+        def SetAlpha(self, path, alpha):
+            self.clock.alpha = alpha
+            say("alpha", alpha)
+            return alpha
+
+        @dbus.service.method(PLAYER_IFACE)
+        def HideVideo(self):
+            self.clock.hidden = True
+            say("hide")
+
+        @dbus.service.method(PLAYER_IFACE)
+        def UnHideVideo(self):
+            self.clock.hidden = False
+            say("unhide")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Pretend to be omxplayer")
+    parser.add_argument('filename')
+    parser.add_argument('--pos', type=float, default=0.0)
+    parser.add_argument('--loop', action='store_true')
+    parser.add_argument('--layer', type=int, default=0)
+    parser.add_argument('--alpha', type=int, default=255)
+    parser.add_argument('--dbus_name', default='org.mpris.MediaPlayer2.omxplayer')
+    parser.add_argument('--aspect-mode')
+    parser.add_argument('--no-osd', action='store_true')
+    parser.add_argument('--no-keys', action='store_true')
+    parser.add_argument('--refresh', action='store_true')
+    parser.add_argument('--stats', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    startup_delay = float(os.environ.get('FAKEPLAYER_STARTUP_DELAY', 0))
+    runtime = os.environ.get('FAKEPLAYER_RUNTIME')
+    failure_rate = float(os.environ.get('FAKEPLAYER_FAILURE_RATE', 0))
+    hang_rate = float(os.environ.get('FAKEPLAYER_HANG_RATE', 0))
+    stubborn_rate = float(os.environ.get('FAKEPLAYER_STUBBORN_RATE', 0))
+    if startup_delay:
+        sleep(startup_delay)
+    if random.random() < failure_rate:
+        say("failing to start, as asked")
+        return 1
+    if random.random() < hang_rate:
+        while True:
+            sleep(3600)
+    if random.random() < stubborn_rate:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if os.fork() == 0:
+            while True:
+                sleep(3600)
+    duration = float(runtime) if runtime else file_duration(args.filename)
+    # a forced runtime is how long we play from wherever we start
+    clock = FakeClock(args.filename, duration,
+                      position=0.0 if runtime else args.pos,
+                      loop=args.loop, alpha=args.alpha)
+    say("playing %s from %.3f (layer %i, alpha %i, %s)" %
+        (args.filename, args.pos, args.layer, args.alpha, args.dbus_name))
+    if dbus is None:
+        say("no dbus-python here, playing without a D-Bus interface")
+        # nothing can pause us, so just sleep out the file
+        remaining = clock.remaining()
+        while args.stats and (remaining is None or remaining > 0):
+            stats(clock)
+            sleep(STATS_INTERVAL if remaining is None else min(STATS_INTERVAL, remaining))
+            remaining = clock.remaining()
+        while remaining is None:
+            sleep(3600)
+        sleep(remaining)
+        say("end of", args.filename)
+        return 0
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    # like omxplayer, tell controllers where to find our bus
+    address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+    if address:
+        filename = '/tmp/omxplayerdbus.%s' % getpass.getuser()
+        with open(filename, 'w') as fp:
+            fp.write(address + '\n')
+    loop = mainloop.MainLoop()
+    if args.stats:
+        mainloop.timeout_add(int(STATS_INTERVAL * 1000), stats, clock)
+    FakePlayerService(bus, args.dbus_name, clock, loop.quit)
+    loop.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+"""fakeprobe.py: a stand-in for ffprobe, for testing and benchmarks
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Takes ffprobe's command line (the last argument is the file) and
+# prints the kind of JSON ffprobe would, without looking at the file.
+# What it says, and how, is set through the environment:
+#
+#   FAKEPROBE_DURATION      duration to report, in seconds (default 10)
+#   FAKEPROBE_DELAY         seconds to take over it
+#   FAKEPROBE_FAILURE_RATE  chance (0..1) of printing nothing and failing
+#
+# To use it: config.ffprobe_cmd = ['python', '/path/to/fakeprobe.py']
+#
+
+import os
+import sys
+import json
+import random
+from time import sleep
+
+
+def main(argv):
+    duration = float(os.environ.get('FAKEPROBE_DURATION', 10))
+    delay = float(os.environ.get('FAKEPROBE_DELAY', 0))
+    failure_rate = float(os.environ.get('FAKEPROBE_FAILURE_RATE', 0))
+    if delay:
+        sleep(delay)
+    if random.random() < failure_rate:
+        return 1
+    filename = argv[-1] if argv else ''
+    print json.dumps({
+        'format': {'filename': filename, 'format_name': 'mov,mp4,m4a,3gp,3g2,mj2',
+                   'duration': '%f' % duration},
+        'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                     'width': 1920, 'height': 1080, 'avg_frame_rate': '30000/1001',
+                     'r_frame_rate': '30000/1001', 'duration': '%f' % duration}],
+    })
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
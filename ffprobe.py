@@ -12,18 +12,53 @@ import subprocess as sp
 import json
 from common import *
 import config
+import mediacache
+import mp4info
 
+# the only format and stream fields we keep in the media cache
+format_fields = ['duration', 'format_name']
+stream_fields = ['index', 'codec_type', 'codec_name', 'width', 'height',
+                 'avg_frame_rate', 'r_frame_rate', 'duration']
 
-def probe(vid_file_path):
-    ''' Give a json from ffprobe command line
+
+def probe(vid_file_path, save=True):
+    ''' Give a json from ffprobe command line, consulting the media
+    cache first. MP4 and MOV files are read by mp4info instead, with
+    ffprobe only for what it can't read. Results, cached or not, hold
+    only the fields in format_fields and stream_fields.
 
     @vid_file_path : The absolute (full) path of the video file, string.
+    @save : Write the cache file after a new probe (at most every
+            mediacache.SAVE_INTERVAL seconds). Bulk callers pass False
+            and save once at the end.
     '''
     if type(vid_file_path) != str:
         debug(vid_file_path, 'Give ffprobe a full file path of the video')
         return
+    cache = mediacache.get_cache()
+    if cache is not None:
+        cached = cache.get(vid_file_path)
+        if cached is not None and 'probe' in cached:
+            return cached['probe']
+    _json = None
+    if config.native_probe:
+        _json = mp4info.probe(vid_file_path)
+    if not _json:
+        _json = run_ffprobe(vid_file_path)
+    if not _json:
+        return _json
+    # the same fields whether it came from the cache or not
+    trimmed = trim(_json)
+    if cache is not None:
+        cache.put(vid_file_path, {'probe': trimmed, 'info': summarize(trimmed)},
+                  save=save)
+    return trimmed
+
 
-    command = ["ffprobe",
+def run_ffprobe(vid_file_path):
+    ''' Fork ffprobe and return its parsed json, bypassing the cache
+    '''
+    command = config.ffprobe_cmd + [
             "-loglevel",  "quiet",
             "-print_format", "json",
              "-show_format",
@@ -33,13 +68,115 @@ def probe(vid_file_path):
 
     pipe = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
     out, err = pipe.communicate()
-    return json.loads(out)
+    try:
+        return json.loads(out)
+    except ValueError:
+        debug(vid_file_path, 'ffprobe gave us no json')
+        return {}
+
+
+def run_keyframes(vid_file_path):
+    ''' Fork ffprobe to list the first video stream's keyframe times.
+    This decodes nothing but does read the whole file, so it is slow;
+    keep it for ingest time.
+    '''
+    command = config.ffprobe_cmd + [
+            "-loglevel",  "quiet",
+            "-print_format", "json",
+            "-select_streams", "v:0",
+            "-skip_frame", "nokey",
+            "-show_entries", "frame=pkt_pts_time,best_effort_timestamp_time",
+            vid_file_path
+            ]
+    pipe = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+    out, err = pipe.communicate()
+    try:
+        frames = json.loads(out).get('frames', [])
+    except (ValueError, AttributeError):
+        debug(vid_file_path, 'ffprobe gave us no keyframes')
+        return None
+    times = []
+    for frame in frames:
+        value = frame.get('best_effort_timestamp_time', frame.get('pkt_pts_time'))
+        try:
+            times.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    return sorted(times) or None
+
+
+def trim(_json):
+    ''' Keep only the parts of ffprobe output we care about
+    '''
+    trimmed = {'format': {}, 'streams': []}
+    if 'format' in _json:
+        for field in format_fields:
+            if field in _json['format']:
+                trimmed['format'][field] = _json['format'][field]
+    for s in _json.get('streams', []):
+        trimmed['streams'].append(
+            dict((field, s[field]) for field in stream_fields if field in s))
+    return trimmed
+
+
+def summarize(_json):
+    ''' Flatten probe output into duration plus video stream info
+    '''
+    summary = {'duration': _duration(_json), 'codec': None,
+               'width': None, 'height': None, 'fps': None}
+    for s in _json.get('streams', []):
+        if s.get('codec_type') == 'video':
+            summary['codec'] = s.get('codec_name')
+            summary['width'] = s.get('width')
+            summary['height'] = s.get('height')
+            summary['fps'] = _rate(s.get('avg_frame_rate') or s.get('r_frame_rate'))
+            break
+    return summary
+
+
+def info(vid_file_path, save=True):
+    ''' Video's duration, codec, width, height and fps as a dict
+    '''
+    cache = mediacache.get_cache()
+    if cache is not None:
+        cached = cache.get(vid_file_path)
+        if cached is not None and 'info' in cached:
+            return cached['info']
+    _json = probe(vid_file_path, save=save)
+    if not _json:
+        return None
+    return summarize(_json)
+
+
+def _rate(text):
+    ''' Turn an ffprobe rate like "30000/1001" into a float
+    '''
+    if not text:
+        return None
+    try:
+        num, _, den = str(text).partition('/')
+        if den:
+            return float(num) / float(den) if float(den) else None
+        return float(num)
+    except ValueError:
+        return None
 
 
 def duration(vid_file_path):
     ''' Video's duration in seconds, return a float number
     '''
     _json = probe(vid_file_path)
+    length = _duration(_json)
+    if length is None:
+        debug(vid_file_path, 'I found no duration')
+    return length
+
+
+def _duration(_json):
+    ''' Pull a duration out of probe output
+    '''
+    if not _json:
+        return None
 
     if 'format' in _json:
         if 'duration' in _json['format']:
@@ -53,8 +190,7 @@ def duration(vid_file_path):
 
     # if everything didn't happen,
     # we got here because no single 'return' in the above happen.
-    debug(vid_file_path, 'I found no duration')
-    #return None
+    return None
 
 
 if __name__ == "__main__":
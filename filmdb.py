@@ -0,0 +1,331 @@
+#!/usr/bin/python
+"""filmdb.py: compact, read-only film records, and reading the film database
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A film is a Film: a record with a slot for each field we know (file,
+# name, tags, start, length, disabled) and the rest kept as they came in
+# .extra. Tags are interned strings, and films with the same tags share
+# one tuple of them, so a catalog of tens of thousands of films costs a
+# fraction of what it did as dicts of unicode.
+#
+# Films can't be changed once made. The catalog shares them between its
+# tag lists, channels and players, so a clip that plays for other than
+# the film's own length gets an Override, which reads through to the
+# film for everything else:
+#
+#   clip = film.override(length=10.0)
+#
+# Both read like the dicts they replace (film['file'], 'start' in film,
+# film.get('name')), where a field that isn't set is simply not there,
+# and as_dict() gives the dict back for JSON.
+#
+# The database is read in one pass, strings made bytes as the parser
+# builds each object, and a film at a time from a small buffer, so
+# however big the file, we never hold the whole text and the whole
+# parsed tree along with the films.
+#
+
+import re
+import abc
+import json
+
+#
+# Constants
+#
+
+# fields with a slot of their own, in the order as_dict() gives them
+FIELDS = ('file', 'name', 'tags', 'start', 'length', 'disabled')
+
+# the db file is read this much at a time
+READ_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+
+_field_set = frozenset(FIELDS)
+
+# one shared tuple for each set of tags
+_tag_sets = {}
+# the keys we know, as bytes, to save encoding them for every film
+_keys = dict((unicode(key), key) for key in FIELDS)
+
+
+class Record(object):
+    """What Film and Override have in common: read-only, dict-like access,
+    built on the two methods each gives: _value() and as_dict()"""
+
+    __metaclass__ = abc.ABCMeta
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s records are read-only" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s records are read-only" % type(self).__name__)
+
+    @abc.abstractmethod
+    def _value(self, key):
+        """The value of a field, or None if it isn't set"""
+
+    def __getitem__(self, key):
+        value = self._value(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._value(key) is not None
+
+    def get(self, key, default=None):
+        value = self._value(key)
+        if value is None:
+            return default
+        return value
+
+    def keys(self):
+        return self.as_dict().keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    @abc.abstractmethod
+    def as_dict(self):
+        """The fields that are set, as a dict"""
+
+    def override(self, **changes):
+        """This film, played with some fields changed"""
+        return Override(self, **changes)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.as_dict())
+
+
+class Film(Record):
+    """One entry in the film database"""
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, file=None, name=None, tags=(), start=None, length=None,
+                 disabled=None, **extra):
+        init = object.__setattr__
+        init(self, 'file', file)
+        init(self, 'name', name)
+        init(self, 'tags', _tags(tags))
+        init(self, 'start', start)
+        init(self, 'length', length)
+        init(self, 'disabled', disabled)
+        # anything else, as a sorted tuple of (key, value), or None
+        init(self, 'extra', tuple(sorted((intern(key), value)
+                                         for key, value in extra.items())) or None)
+
+    @classmethod
+    def from_dict(cls, fields):
+        # the same as cls(**fields), without the keyword arguments
+        film = cls.__new__(cls)
+        init = object.__setattr__
+        get = fields.get
+        init(film, 'file', get('file'))
+        init(film, 'name', get('name'))
+        init(film, 'tags', _tags(get('tags')))
+        init(film, 'start', get('start'))
+        init(film, 'length', get('length'))
+        init(film, 'disabled', get('disabled'))
+        extra = None
+        for key in fields:
+            if key not in _field_set:
+                extra = tuple(sorted((intern(str(key)), value) for key, value in fields.items()
+                                     if key not in _field_set))
+                break
+        init(film, 'extra', extra)
+        return film
+
+    def _value(self, key):
+        if key in _field_set:
+            return getattr(self, key)
+        for name, value in self.extra or ():
+            if name == key:
+                return value
+        return None
+
+    def as_dict(self):
+        fields = dict(self.extra or ())
+        for key in FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                fields[key] = list(value) if key == 'tags' else value
+        return fields
+
+    def _fields(self):
+        return tuple(getattr(self, key) for key in FIELDS) + (self.extra,)
+
+    def __eq__(self, other):
+        return isinstance(other, Film) and self._fields() == other._fields()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.file)
+
+
+class Override(Record):
+    """A film as one clip plays it: its own length (and start) if given,
+    the film's for the rest"""
+
+    __slots__ = ('film', 'length', 'start')
+
+    def __init__(self, film, length=None, start=None):
+        # an override of an override overrides the film
+        if isinstance(film, Override):
+            length = film.length if length is None else length
+            start = film.start if start is None else start
+            film = film.film
+        init = object.__setattr__
+        init(self, 'film', film)
+        init(self, 'length', length)
+        init(self, 'start', start)
+
+    def _value(self, key):
+        if key == 'length' and self.length is not None:
+            return self.length
+        if key == 'start' and self.start is not None:
+            return self.start
+        return self.film._value(key)
+
+    def as_dict(self):
+        fields = self.film.as_dict()
+        if self.length is not None:
+            fields['length'] = self.length
+        if self.start is not None:
+            fields['start'] = self.start
+        return fields
+
+
+def _tags(tags):
+    tags = tuple(tags or ())
+    shared = _tag_sets.get(tags)
+    if shared is None:
+        shared = tuple(intern(_bytes(tag)) for tag in tags)
+        shared = _tag_sets.setdefault(shared, shared)
+    return shared
+
+
+#
+# Reading
+#
+
+def _bytes(value):
+    # json gives unicode, but for our purposes byte strings are fine
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_bytes(item) for item in value]
+    return value
+
+
+def _object(pairs, keep=()):
+    """For json's object_pairs_hook: each object as it is parsed, with
+    bytes for its strings (its own objects are done already), bar lists
+    under the keys in keep"""
+    fields = {}
+    for key, value in pairs:
+        key = _keys.get(key) or key.encode('utf-8')
+        if type(value) is unicode:
+            value = value.encode('utf-8')
+        elif type(value) is list and key not in keep:
+            value = _bytes(value)
+        fields[key] = value
+    return fields
+
+
+def load_json(fp):
+    """json.load(), with byte strings"""
+    return json.load(fp, object_pairs_hook=_object)
+
+
+def loads_json(text):
+    """json.loads(), with byte strings"""
+    return json.loads(text, object_pairs_hook=_object)
+
+
+def _film(entry):
+    if not isinstance(entry, dict):
+        raise ValueError("film database entries must be objects, not %r" % (entry,))
+    return Film.from_dict(entry)
+
+
+def iter_films(fp):
+    """The films in a db file (a JSON list of objects), parsed one at a
+    time as the file is read"""
+    # tags are made bytes (once for each set of them) by Film. The
+    # decoder's scanner is what raw_decode() calls, less the checks.
+    scan = json.JSONDecoder(object_pairs_hook=lambda pairs: _object(pairs, ('tags',))).scan_once
+    state = {'text': '', 'eof': False}
+
+    def more(pos):
+        # drop what's been parsed and read the next chunk
+        chunk = fp.read(READ_SIZE)
+        state['eof'] = not chunk
+        state['text'] = state['text'][pos:] + chunk
+        return 0
+
+    def finish(pos):
+        # after the list, nothing but whitespace
+        while True:
+            pos = WHITESPACE.match(state['text'], pos).end()
+            if pos < len(state['text']):
+                raise ValueError("unexpected %r after the film database's list" %
+                                 state['text'][pos:pos + 40])
+            if state['eof']:
+                return
+            pos = more(pos)
+
+    def token(pos):
+        # the position of the next character that isn't whitespace
+        while True:
+            pos = WHITESPACE.match(state['text'], pos).end()
+            if pos < len(state['text']):
+                return pos
+            if state['eof']:
+                raise ValueError("film database ends early")
+            pos = more(pos)
+
+    pos = token(0)
+    if state['text'][pos] != '[':
+        raise ValueError("film database must be a list")
+    pos = token(pos + 1)
+    if state['text'][pos] == ']':
+        finish(pos + 1)
+        return
+    while True:
+        # an entry: parse it, reading more until it is all there (and,
+        # as a number may go on into the next chunk, a little after)
+        while True:
+            text = state['text']
+            try:
+                entry, end = scan(text, pos)
+                if end < len(text) or state['eof']:
+                    break
+            except (ValueError, StopIteration):
+                if state['eof']:
+                    raise ValueError("bad entry in film database at %r" % text[pos:pos + 40])
+            pos = more(pos)
+        yield _film(entry)
+        pos = token(end)
+        char = state['text'][pos]
+        if char == ']':
+            finish(pos + 1)
+            return
+        if char != ',':
+            raise ValueError("expected ',' or ']' in film database, found %r" % char)
+        pos = token(pos + 1)
+
+
+def read(filename):
+    """The list of films in a db file"""
+    with open(filename, 'r') as fp:
+        return list(iter_films(fp))
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+"""ingest.py: prepare the media directory and film database for playback
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# One pass over the media directory that:
+#
+#   1. renames files to lower case names without spaces or punctuation
+#      (what fix_filenames.py used to do)
+#   2. transcodes clips the player can't play well (codec or picture
+#      size outside config.ingest_codecs / ingest_max_height) to H.264
+#      MP4, keeping the original in config.ingest_originals
+#   3. remuxes MP4/MOV files with the moov box at the end so it comes
+#      first ("faststart"), which is lossless
+#   4. probes duration, codec and size
+#   5. rewrites the film database: renamed files, probed durations as
+#      the length of films that don't give one (so the player needn't
+#      probe them), and an untagged entry for every new file, for a
+#      curator to tag
+#
+# Steps 2-4 run on a process pool. What we learn about each file is kept
+# in a state file in the media directory, with its size, mtime and a
+# hash of its contents. On the next run, files whose size and mtime
+# haven't changed are skipped without reading them, and files that have
+# only been touched, copied or renamed are recognised by their hash, so
+# going over a big library again only costs work for new or changed
+# files.
+#
+# e.g.  python ingest.py                    # config.media_base
+#       python ingest.py --dry-run /media/usb
+#       python ingest.py --rename-only
+#
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import subprocess
+from multiprocessing import Pool
+from time import time
+
+import config
+
+nullin = open(os.devnull, 'r')
+
+# read files this much at a time when hashing
+HASH_CHUNK = 1024 * 1024
+# files in the media directory that aren't media
+EXCLUDE = ['README.md', config.filmdb]
+# film db keys written first, in this order; the rest follow sorted
+DB_KEY_ORDER = ['file', 'name', 'tags']
+# containers the player takes as they are
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+# ffmpeg arguments for a lossless remux into MP4 with moov first
+COPY_ARGS = ['-map', '0', '-c', 'copy', '-movflags', '+faststart']
+ACTIONS = {'transcode': "transcoded", 'rewrap': "rewrapped as mp4",
+           'faststart': "moved moov to the front"}
+
+
+#
+# Names
+#
+
+def normalize_name(filename):
+    """Lower case, with runs of spaces and punctuation made underscores"""
+    new_filename = re.sub(r'[ \-\(\)+:]', '_', filename).lower()
+    new_filename = re.sub('__*', '_', new_filename)
+    return new_filename.replace('_.', '.')
+
+
+def scan(media_dir):
+    """Names of the media files in media_dir, in one listing"""
+    names = []
+    for name in sorted(os.listdir(media_dir)):
+        if name.startswith('.') or name in EXCLUDE:
+            continue
+        if os.path.splitext(name)[1].lower() not in config.media_extensions:
+            continue
+        if os.path.isfile(os.path.join(media_dir, name)):
+            names.append(name)
+    return names
+
+
+def plan_renames(names):
+    """{old name: new name} for names that need normalizing, leaving
+    out any that would collide with another file"""
+    taken = set(names)
+    renames = {}
+    for name in names:
+        new_name = normalize_name(name)
+        if new_name == name:
+            continue
+        if new_name in taken:
+            report("Not renaming %s: %s already exists" % (name, new_name))
+            continue
+        taken.discard(name)
+        taken.add(new_name)
+        renames[name] = new_name
+    return renames
+
+
+#
+# Work done on the pool
+#
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def hash_job(path):
+    """(path, size, mtime, hash) of a file"""
+    size, mtime = _stamp(path)
+    return path, size, mtime, file_hash(path)
+
+
+def probe_job(path):
+    """Duration, codec and size of a file, without the media cache, which
+    belongs to the player and isn't safe to write from several processes"""
+    import ffprobe
+    import mp4info
+    _json = mp4info.probe(path) or ffprobe.trim(ffprobe.run_ffprobe(path))
+    return ffprobe.summarize(_json)
+
+
+def plan(path, info, options):
+    """What a file needs: 'transcode' if the player can't decode it well,
+    'rewrap' if it just needs an MP4 container, 'faststart' if its moov
+    box is at the end, or None"""
+    import mp4info
+    if info is None or not info['codec']:
+        return None
+    if options['transcode']:
+        if info['codec'] not in config.ingest_codecs:
+            return 'transcode'
+        if info['height'] and info['height'] > config.ingest_max_height:
+            return 'transcode'
+    if not options['remux']:
+        return None
+    if os.path.splitext(path)[1].lower() not in MP4_EXTENSIONS:
+        return 'rewrap'
+    if mp4info.faststart(path) is False:
+        return 'faststart'
+    return None
+
+
+def run_ffmpeg(args, path, output):
+    """Run ffmpeg into a temporary file next to output, and move it into
+    place if all went well"""
+    partname = output + '.part' + os.path.splitext(output)[1]
+    argv = config.ffmpeg_cmd + ['-nostdin', '-loglevel', 'error', '-y', '-i', path] + \
+        args + [partname]
+    process = subprocess.Popen(argv, stdin=nullin, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    out = process.communicate()[0]
+    if process.returncode != 0 or not os.path.isfile(partname):
+        if os.path.exists(partname):
+            os.remove(partname)
+        raise RuntimeError("ffmpeg failed on %s: %s" % (path, out.strip()))
+    os.rename(partname, output)
+
+
+def prepare_job(job):
+    """Transcode or remux one file as needed, and probe the result.
+    Returns (name, new name, record, message)."""
+    media_dir, name, digest, options = job
+    path = os.path.join(media_dir, name)
+    try:
+        info = probe_job(path)
+        action = plan(path, info, options)
+        new_name = name
+        if action in ('transcode', 'rewrap'):
+            new_name = os.path.splitext(name)[0] + '.mp4'
+            output = os.path.join(media_dir, new_name)
+            if new_name != name and os.path.exists(output):
+                raise RuntimeError("%s is in the way" % new_name)
+            args = config.ingest_transcode_args if action == 'transcode' else COPY_ARGS
+            tmp = output if new_name != name else output + '.new.mp4'
+            run_ffmpeg(args, path, tmp)
+            _keep_original(media_dir, name)
+            if tmp != output:
+                os.rename(tmp, output)
+            path = output
+        elif action == 'faststart':
+            # lossless, so no need to keep the original
+            run_ffmpeg(COPY_ARGS, path, path)
+        if action:
+            info = probe_job(path)
+        size, mtime = _stamp(path)
+        record = {'size': size, 'mtime': mtime,
+                  'hash': file_hash(path) if action else digest,
+                  'source_hash': digest, 'info': info}
+        return name, new_name, record, ACTIONS.get(action, "")
+    except Exception as e:
+        return name, name, None, str(e)
+
+
+def _keep_original(media_dir, name):
+    path = os.path.join(media_dir, name)
+    if not config.ingest_originals:
+        os.remove(path)
+        return
+    originals = os.path.join(media_dir, config.ingest_originals)
+    if not os.path.isdir(originals):
+        os.makedirs(originals)
+    shutil.move(path, os.path.join(originals, name))
+
+
+#
+# State and film database
+#
+
+def load_json(filename, default):
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(filename, text):
+    """Write atomically, so a power cut leaves the old file or the new"""
+    with open(filename + '.tmp', 'w') as fp:
+        fp.write(text)
+    os.rename(filename + '.tmp', filename)
+
+
+def format_db(films):
+    """The film database as JSON, one film to a block, 'file' first"""
+    blocks = []
+    for film in films:
+        keys = [k for k in DB_KEY_ORDER if k in film]
+        keys += sorted(k for k in film if k not in DB_KEY_ORDER)
+        lines = ['    %s: %s' % (json.dumps(k), json.dumps(film[k])) for k in keys]
+        blocks.append('  {\n' + ',\n'.join(lines) + '\n  }')
+    return '[\n' + ',\n'.join(blocks) + '\n]\n'
+
+
+def _set_length(film, record):
+    """Give film the probed duration as its length, which the player
+    would otherwise probe for when it loads the database. A length a
+    curator set is left alone; we know our own by it matching the
+    'duration' we wrote last time, and follow the file if it changes."""
+    if not record or not record.get('info') or not record['info'].get('duration'):
+        return
+    duration = round(record['info']['duration'], 3)
+    if not film.get('length') or film['length'] == film.get('duration'):
+        film['length'] = duration
+    film['duration'] = duration
+
+
+def update_db(films, renames, state, names):
+    """Apply renames and probed lengths to the film list and add the
+    files it doesn't mention yet. Returns the names added."""
+    listed = set()
+    for film in films:
+        if 'file' not in film:
+            continue
+        while film['file'] in renames:
+            film['file'] = renames[film['file']]
+        listed.add(film['file'])
+        _set_length(film, state.get(film['file']))
+    added = []
+    for name in names:
+        if name not in listed:
+            film = {'file': name, 'tags': []}
+            _set_length(film, state.get(name))
+            films.append(film)
+            added.append(name)
+    on_disk = set(names)
+    for film in films:
+        if 'file' in film and film['file'] not in on_disk:
+            report("In the film database but not on disk: %s" % film['file'])
+    return added
+
+
+#
+# Control
+#
+
+def report(text):
+    print text
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Prepare media for playback")
+    parser.add_argument('media_dir', nargs='?', default=None,
+                        help="media directory (default config.media_base)")
+    parser.add_argument('--db', help="film database (default media_dir/%s)" % config.filmdb)
+    parser.add_argument('--workers', type=int, default=config.ingest_workers)
+    parser.add_argument('--rename-only', action='store_true',
+                        help="just normalize names, in files and database")
+    parser.add_argument('--no-transcode', action='store_true')
+    parser.add_argument('--no-remux', action='store_true')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="say what would be done, change nothing")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    media_dir = args.media_dir or config.media_base
+    db_file = args.db or os.path.join(media_dir, config.filmdb)
+    state_file = os.path.join(media_dir, config.ingest_state_file)
+    started = time()
+
+    # 1. names
+    names = scan(media_dir)
+    renames = plan_renames(names)
+    state = load_json(state_file, {})
+    for name, new_name in sorted(renames.items()):
+        report("%s --> %s" % (name, new_name))
+        if not args.dry_run:
+            os.rename(os.path.join(media_dir, name), os.path.join(media_dir, new_name))
+        if name in state:
+            state[new_name] = state.pop(name)
+    if not args.dry_run:
+        names = [renames.get(name, name) for name in names]
+    films = load_json(db_file, [])
+
+    if not args.rename_only:
+        # 2. find what's new or changed: unchanged size and mtime means
+        # unchanged, otherwise we hash it and see if we know the hash
+        by_hash = dict((r['hash'], r) for r in state.values() if r.get('hash'))
+        suspects = []
+        for name in names:
+            record = state.get(name)
+            path = os.path.join(media_dir, name)
+            if record and (record['size'], record['mtime']) == _stamp(path):
+                continue
+            suspects.append(path)
+        # drop what's gone
+        for name in list(state):
+            if name not in names:
+                del state[name]
+        pool = Pool(max(1, args.workers))
+        try:
+            todo = []
+            for path, size, mtime, digest in pool.imap_unordered(hash_job, suspects):
+                name = os.path.basename(path)
+                known = by_hash.get(digest)
+                if known:
+                    # same contents as a file we've seen, just renamed or touched
+                    state[name] = dict(known, size=size, mtime=mtime)
+                else:
+                    todo.append((name, digest))
+            report("%i files, %i new or changed" % (len(names), len(todo)))
+            # 3. transcode, remux and probe what's new
+            options = {'transcode': not args.no_transcode, 'remux': not args.no_remux}
+            if args.dry_run:
+                for name, digest in todo:
+                    report("would prepare %s" % name)
+                todo = []
+            jobs = [(media_dir, name, digest, options) for name, digest in todo]
+            for name, new_name, record, message in pool.imap_unordered(prepare_job, jobs):
+                if record is None:
+                    report("Failed: %s: %s" % (name, message))
+                    continue
+                report("%s%s" % (name, ": " + message if message else ""))
+                if new_name != name:
+                    renames[name] = new_name
+                    names = [new_name if n == name else n for n in names]
+                state[new_name] = record
+                # save as we go, so an interrupted run isn't wasted
+                save_json(state_file, json.dumps(state))
+        finally:
+            pool.close()
+            pool.join()
+
+    # 4. the film database
+    added = update_db(films, renames, state, names)
+    for name in added:
+        report("New, needs tags: %s" % name)
+    if not args.dry_run:
+        if os.path.exists(db_file):
+            shutil.copy(db_file, db_file + '.bak')
+        save_json(db_file, format_db(films))
+        if not args.rename_only:
+            save_json(state_file, json.dumps(state))
+    report("Done in %.1fs" % (time() - started))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""journal.py: remember where each channel is, so a restart carries on from there
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Each clip that goes on screen adds a line to the journal: the channel,
+# its place in the recipe, the film as played and when it went on
+# screen, as one line of JSON:
+#
+#   {"channel": "channel1", "index": 4, "film": {"file": ...}, "at": 1508...}
+#
+# A line is appended with a single write() to a file opened for
+# appending, and nothing is synced, so it costs the SD card next to
+# nothing. A crash can lose the last few lines, or leave the last one
+# cut short; reading skips anything that doesn't parse. Every
+# config.journal_compact lines, the journal is rewritten with only the
+# last config.journal_history lines of each channel (to a new file,
+# synced and renamed over the old one, so it is always whole).
+#
+# At startup, each channel looks up its last line. If that clip would
+# still be playing, it is played again from where it would be now, and
+# the recipe carries on after it; otherwise the recipe carries on from
+# the next step. Recent films are passed to the channel, which avoids
+# repeating them where it can.
+#
+
+import os
+import json
+import threading
+from collections import deque
+
+# local modules
+from clock import time
+from common import *
+import config
+import ffprobe
+import filmdb
+
+#
+# Constants
+#
+
+# a clip with less than this left isn't worth resuming
+RESUME_MIN = 1.0
+
+
+class Journal(object):
+    """An append-only log of the clips each channel has played"""
+
+    def __init__(self, filename, compact_every=None, history=None):
+        self.filename = filename
+        self.compact_every = compact_every or config.journal_compact
+        self.history = history or config.journal_history
+        # channel -> deque of its last few entries
+        self._entries = {}
+        # lines in the file
+        self._lines = 0
+        self._fd = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the journal, skipping lines that don't parse"""
+        entries, lines, bad = {}, 0, 0
+        try:
+            with open(self.filename, 'r') as fp:
+                for line in fp:
+                    lines += 1
+                    try:
+                        entry = filmdb.loads_json(line)
+                        channel = entry['channel']
+                        entry['film'] = filmdb.Film.from_dict(entry['film'])
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        bad += 1
+                        continue
+                    if channel not in entries:
+                        entries[channel] = deque(maxlen=self.history)
+                    entries[channel].append(entry)
+        except IOError:
+            pass
+        if bad:
+            debug("Skipped %i bad lines in journal %s" % (bad, self.filename))
+        with self._lock:
+            self._entries = entries
+            self._lines = lines
+        # start from a clean file if the last one was cut short
+        if bad:
+            self.compact()
+
+    def last(self, channel):
+        """The channel's last entry, or None"""
+        with self._lock:
+            entries = self._entries.get(channel)
+            return entries[-1] if entries else None
+
+    def recent(self, channel):
+        """The files the channel played last, oldest first"""
+        with self._lock:
+            return [entry['film']['file'] for entry in self._entries.get(channel, ())]
+
+    def played(self, channel, index, film, at):
+        """A clip went on screen"""
+        entry = {'channel': channel, 'index': index, 'film': film, 'at': at}
+        line = json.dumps(dict(entry, film=film.as_dict())) + '\n'
+        with self._lock:
+            if channel not in self._entries:
+                self._entries[channel] = deque(maxlen=self.history)
+            self._entries[channel].append(entry)
+            try:
+                if self._fd is None:
+                    self._fd = _open_append(self.filename)
+                os.write(self._fd, line)
+                self._lines += 1
+            except (IOError, OSError) as e:
+                debug("Couldn't write journal %s: %s" % (self.filename, str(e)))
+
+    def check(self):
+        """Compact the journal if it's due"""
+        if self._lines >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the journal with only the last few entries of each channel"""
+        with self._lock:
+            entries = sorted((entry for entries in self._entries.values() for entry in entries),
+                             key=lambda entry: entry['at'])
+            lines = [json.dumps(dict(entry, film=entry['film'].as_dict())) for entry in entries]
+            tmpname = self.filename + '.tmp'
+            try:
+                with open(tmpname, 'w') as fp:
+                    fp.write(''.join(line + '\n' for line in lines))
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.rename(tmpname, self.filename)
+            except (IOError, OSError) as e:
+                debug("Couldn't compact journal %s: %s" % (self.filename, str(e)))
+                return
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._lines = len(lines)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def _open_append(filename):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+
+def remainder(entry, now=None):
+    """What's left of the clip in a journal entry, as an Override of the
+    film starting where it would be now, or None if it would be over"""
+    now = now or time()
+    film = entry['film']
+    elapsed = now - entry['at']
+    if elapsed < 0:
+        return None
+    length = film.get('length')
+    if not length:
+        length = ffprobe.duration(os.path.join(config.media_base, film['file']))
+    if not length or length - elapsed < RESUME_MIN:
+        return None
+    return film.override(start=(film.get('start') or 0.0) + elapsed,
+                         length=length - elapsed)
+
+
+#
+# Shared journal
+#
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Return the shared journal, reading it on first use. Returns None
+    if the journal is turned off in config."""
+    global _journal
+    if _journal is None and config.journal_file:
+        with _journal_lock:
+            if _journal is None:
+                _journal = Journal(config.journal_file)
+    return _journal
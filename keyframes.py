@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""keyframes.py: per-file keyframe index, for starts that seek quickly
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# omxplayer --pos has to decode from the keyframe before the position,
+# so a start deep into a long GOP stalls the clip. We keep the keyframe
+# times of each film that has a start, and move starts onto (or near)
+# a keyframe before playing.
+#
+# The index is an array of times in seconds. In the media cache it is
+# stored as zlib compressed millisecond deltas, base64 encoded, which
+# for footage with a regular GOP comes to a few dozen bytes.
+#
+# Built at load time: MP4/MOV from the container headers (mp4info),
+# anything else by asking ffprobe for the keyframes. At play time we
+# only look in the cache or read MP4 headers, never run ffprobe.
+#
+# python keyframes.py [film db] reports the films whose starts are
+# expensive to seek to.
+#
+
+import os
+import sys
+import zlib
+import base64
+import struct
+from array import array
+from bisect import bisect_right
+from multiprocessing.pool import ThreadPool
+
+# local modules
+from common import *
+import config
+import ffprobe
+import mediacache
+import mp4info
+
+#
+# Constants
+#
+
+# where the keyframes' presentation times are kept in a media cache
+# record (encoded; None if the file has none we can read)
+CACHE_FIELD = 'keyframe_times'
+
+
+def encode(times):
+    """Compact text form of a list of times, for the cache"""
+    ms = [int(round(t * 1000)) for t in times]
+    deltas = [b - a for a, b in zip([0] + ms, ms)]
+    packed = struct.pack('<%ii' % len(deltas), *deltas)
+    return base64.b64encode(zlib.compress(packed))
+
+
+def decode(text):
+    """The array of times encode() was given, to the millisecond"""
+    packed = zlib.decompress(base64.b64decode(text))
+    deltas = struct.unpack('<%ii' % (len(packed) // 4), packed)
+    times = array('d')
+    total = 0
+    for delta in deltas:
+        total += delta
+        times.append(total / 1000.0)
+    return times
+
+
+def lookup(filename, build=False, save=True):
+    """Keyframe times for a file, or None if we don't know them. Without
+    build, only the cache and MP4 headers are consulted, which is cheap
+    enough to do at play time."""
+    cache = mediacache.get_cache()
+    if cache is not None:
+        cached = cache.get(filename)
+        if cached is not None and CACHE_FIELD in cached:
+            return decode(cached[CACHE_FIELD]) if cached[CACHE_FIELD] else None
+    times = mp4info.keyframes(filename)
+    if times is None and build:
+        times = ffprobe.run_keyframes(filename)
+    # remember failures too, so we don't keep asking, but only once we
+    # have asked everyone
+    if cache is not None and (times or build):
+        # the record has to exist before we can add to it
+        if cache.get(filename) is None:
+            ffprobe.probe(filename, save=False)
+        cache.update(filename, save=save, **{CACHE_FIELD: encode(times) if times else None})
+    return array('d', times) if times else None
+
+
+def previous(times, position):
+    """The last keyframe at or before position"""
+    i = bisect_right(times, position + 1e-3)
+    return times[i - 1] if i else 0.0
+
+
+def following(times, position):
+    """The first keyframe after position, or None"""
+    i = bisect_right(times, position + 1e-3)
+    return times[i] if i < len(times) else None
+
+
+def seek_cost(times, position):
+    """Seconds of video the player must decode to start at position"""
+    return max(position - previous(times, position), 0.0)
+
+
+def snap(times, position, mode=None, window=None):
+    """A start position moved onto a keyframe, if there's one within
+    window seconds. mode is 'previous' or 'nearest'."""
+    if mode is None:
+        mode = config.keyframe_snap
+    if window is None:
+        window = config.keyframe_snap_window
+    if not mode or not times or position <= 0:
+        return position
+    candidates = [previous(times, position)]
+    if mode == 'nearest':
+        after = following(times, position)
+        if after is not None:
+            candidates.append(after)
+    best = min(candidates, key=lambda t: abs(t - position))
+    if abs(best - position) <= window:
+        return best
+    return position
+
+
+def _start(film):
+    try:
+        return float(film.get('start') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def index_films(film_list, workers=None):
+    """Build the index for every enabled film with a start, running up
+    to workers at once, and report starts that are slow to seek to.
+    Returns a list of (film, start, cost) for those."""
+    if not config.keyframe_index:
+        return []
+    if workers is None:
+        workers = config.probe_workers
+    wanted = []
+    for film in film_list:
+        if 'disabled' in film and film['disabled']:
+            continue
+        if _start(film) <= 0:
+            continue
+        filename = config.media_base + '/' + film['file']
+        if os.path.isfile(filename):
+            wanted.append((film, filename))
+    if not wanted:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(wanted))))
+    try:
+        indexes = pool.map(_index_one, [filename for film, filename in wanted])
+    finally:
+        pool.close()
+        pool.join()
+    cache = mediacache.get_cache()
+    if cache is not None:
+        cache.save()
+    slow = []
+    for (film, filename), times in zip(wanted, indexes):
+        if not times:
+            continue
+        start = _start(film)
+        cost = seek_cost(times, start)
+        if cost >= config.keyframe_slow_seek:
+            slow.append((film, start, cost))
+            update("Slow start: %s at %.2fs is %.2fs past the keyframe at %.2fs%s" %
+                   (film.get('name', film['file']), start, cost,
+                    previous(times, start), _advice(times, start)))
+    return slow
+
+
+def _advice(times, start):
+    snapped = snap(times, start)
+    if snapped != start:
+        return " (will start at %.2fs)" % snapped
+    return ""
+
+
+def _index_one(filename):
+    try:
+        return lookup(filename, build=True, save=False)
+    except Exception as e:
+        debug("Couldn't index keyframes of %s: %s" % (filename, str(e)))
+        return None
+
+
+def main(argv):
+    import video
+    filename = argv[0] if argv else config.media_base + '/' + config.filmdb
+    config.media_base = os.path.dirname(os.path.abspath(filename))
+    films = video.read_film_file(filename)
+    slow = index_films(films)
+    for film, start, cost in slow:
+        print "%-40s start %8.2fs  decodes %6.2fs first" % (film['file'], start, cost)
+    print "%i of %i films have slow starts" % (len(slow), len(films))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""logwriter.py: queued, batched, rotating log file writer
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A logging handler that never touches the disk on the caller's thread.
+# Records go onto a queue; a writer thread takes them off in batches,
+# formats them, writes the lot and flushes once. After each batch the
+# writer waits batch_interval seconds so that bursts of messages end up
+# in one write, which is kinder to SD cards. When nothing is being
+# logged the writer sleeps on the empty queue and costs nothing.
+#
+# The file is rotated when it grows past max_bytes, keeping
+# backup_count old files (name.1 is the newest).
+#
+
+import os
+import sys
+import atexit
+import logging
+import threading
+from time import sleep
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# the most records we write in one go
+BATCH_SIZE = 500
+
+
+class _FlushRequest(object):
+    """Queued behind the records a flush() is waiting for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class QueuedFileHandler(logging.Handler):
+    """Hands records to a background writer thread"""
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, batch_interval=0.5):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_interval = batch_interval
+        # open now, so a bad log path fails at startup, not later
+        self._stream = open(filename, 'a')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name='logwriter')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        self._queue.put(record)
+
+    def flush(self):
+        """Wait for everything queued so far to reach the file"""
+        if not self._thread.is_alive():
+            return
+        request = _FlushRequest()
+        self._queue.put(request)
+        # wait() without a timeout blocks outright; no polling
+        request.done.wait()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        logging.Handler.close(self)
+
+    def _writer(self):
+        while True:
+            # block until there's something to do
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not self._write(batch):
+                return
+            if self.batch_interval:
+                sleep(self.batch_interval)
+
+    def _write(self, batch):
+        """Write a batch. Returns False when told to stop."""
+        lines = []
+        waiters = []
+        running = True
+        for item in batch:
+            if item is None:
+                running = False
+            elif isinstance(item, _FlushRequest):
+                waiters.append(item.done)
+            else:
+                try:
+                    lines.append(self.format(item) + "\n")
+                except Exception:
+                    self.handleError(item)
+        if lines:
+            try:
+                self._stream.write(''.join(lines))
+                self._stream.flush()
+                if self.max_bytes and self._stream.tell() >= self.max_bytes:
+                    self._rotate()
+            except (IOError, OSError, ValueError):
+                # ValueError: the stream is closed, if rotating failed
+                # to reopen it; keep going, so the queue keeps draining
+                sys.stderr.write("Couldn't write to log %s\n" % self.filename)
+        for done in waiters:
+            done.set()
+        if not running:
+            self._stream.close()
+        return running
+
+    def _rotate(self):
+        self._stream.close()
+        try:
+            if self.backup_count:
+                for i in range(self.backup_count - 1, 0, -1):
+                    older = "%s.%i" % (self.filename, i)
+                    if os.path.exists(older):
+                        os.rename(older, "%s.%i" % (self.filename, i + 1))
+                os.rename(self.filename, self.filename + ".1")
+            else:
+                os.remove(self.filename)
+        finally:
+            # reopen even if the renames failed, appending to the old
+            # file if it's still there, so we never write to a closed one
+            self._stream = open(self.filename, 'a')
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""mediacache.py: persistent on-disk cache of media file metadata
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import json
+import threading
+from time import time
+
+# local modules
+from common import *
+import config
+
+
+#
+# Constants
+#
+
+# fraction of the cache dropped at once when we go over the size cap,
+# so we don't have to hunt for the oldest entry on every insert
+EVICT_FRACTION = 0.1
+# a change is written at most this many seconds after the last write;
+# the rest wait for the next change after that, or flush()
+SAVE_INTERVAL = 60
+
+
+class MediaCache(object):
+    """A persistent cache of probe results, keyed by file path.
+
+    Each record remembers the size and mtime of the file when it was
+    probed. If either has changed on a later lookup, the record is stale
+    and is dropped. The cache holds at most max_entries records, evicting
+    the least recently used when it grows past that.
+
+    Writing the file costs the whole cache, so changes made one at a
+    time (at play time) are saved at most every save_interval seconds;
+    flush() writes whatever is left."""
+
+    def __init__(self, filename=None, max_entries=1000, save_interval=SAVE_INTERVAL):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        # path -> {'size':, 'mtime':, 'used':, 'data':}
+        self._entries = {}
+        self._dirty = False
+        self._saved_at = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Read the cache file, if there is one"""
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as fp:
+                entries = json.load(fp)
+        except (IOError, ValueError) as e:
+            debug("Couldn't read media cache %s: %s" % (self.filename, str(e)))
+            return
+        if isinstance(entries, dict):
+            with self._lock:
+                self._entries = entries
+
+    def save(self):
+        """Write the cache file atomically, so a power cut never leaves
+        a half-written cache behind"""
+        if not self.filename:
+            return
+        with self._lock:
+            text = json.dumps(self._entries)
+            self._dirty = False
+            self._saved_at = time()
+        tmpname = self.filename + '.tmp'
+        try:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmpname, 'w') as fp:
+                fp.write(text)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            debug("Couldn't write media cache %s: %s" % (self.filename, str(e)))
+
+    def flush(self):
+        """Save, if anything has changed since the last save"""
+        if self._dirty:
+            self.save()
+
+    def _changed(self, save):
+        """Note a change, and save if it's been a while. Bulk callers
+        pass save=False and save once at the end."""
+        self._dirty = True
+        if save and time() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def get(self, path):
+        """Return cached data for path, or None if missing or stale"""
+        key = _key(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        with self._lock:
+            record = self._entries.get(key)
+            if record is None:
+                return None
+            if (record['size'] != st.st_size or
+                    record['mtime'] != st.st_mtime):
+                del self._entries[key]
+                return None
+            record['used'] = time()
+            return record['data']
+
+    def put(self, path, data, save=True):
+        """Store data for path, stamped with the file's current size
+        and mtime. With save, the file is written if it hasn't been for
+        save_interval seconds."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[_key(path)] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'used': time(),
+                'data': data,
+            }
+            self._evict()
+        self._changed(save)
+
+    def update(self, path, save=True, **kwargs):
+        """Add fields to an existing record's data, if it is still fresh"""
+        data = self.get(path)
+        if data is None:
+            return False
+        with self._lock:
+            data.update(kwargs)
+        self._changed(save)
+        return True
+
+    def invalidate(self, path):
+        """Drop any record for path"""
+        with self._lock:
+            self._entries.pop(_key(path), None)
+
+    def clear(self):
+        """Drop every record"""
+        with self._lock:
+            self._entries = {}
+        self.save()
+
+    def _evict(self):
+        """Drop least recently used records if we are over the size cap.
+        Caller must hold the lock."""
+        if not self.max_entries or len(self._entries) <= self.max_entries:
+            return
+        count = len(self._entries) - self.max_entries
+        count += int(self.max_entries * EVICT_FRACTION)
+        oldest = sorted(self._entries, key=lambda k: self._entries[k]['used'])
+        for key in oldest[:count]:
+            del self._entries[key]
+
+
+def _key(path):
+    return os.path.normpath(path)
+
+
+#
+# Shared cache
+#
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the shared media cache, creating it on first use.
+    Returns None if caching is turned off in config."""
+    global _cache
+    if _cache is None and config.media_cache_file:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MediaCache(config.media_cache_file,
+                                    config.media_cache_max_entries)
+    return _cache
+
+
+def flush():
+    """Write the shared cache, if it has changes not yet saved"""
+    if _cache is not None:
+        _cache.flush()
@@ -0,0 +1,357 @@
+#!/usr/bin/python
+"""metrics.py: per-clip playback timing and periodic stats export
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Each clip gets a timeline of timestamped events:
+#
+#   scheduled   when the clip was meant to start
+#   spawn       when we asked for a player
+#   running     when the player showed signs of life
+#   shown       when the clip went on screen
+#   deadline    when the clip was meant to end
+#   ended       when we stopped it (or it stopped by itself)
+#   reaped      when the player process was gone
+#
+# The gap is measured between clips on the same channel (the layers
+# and display they take turns on), so screens with several channels
+# don't measure one channel's clips against another's.
+#
+# Hung players are counted separately: how long it took to notice, and
+# how long until the next clip was on screen.
+#
+# Finished timelines feed a few histograms (gap between clips, spawn
+# latency, overrun past the deadline, teardown time), which are written
+# every metrics_interval seconds to config.metrics_file, either as a
+# Prometheus textfile (if the name ends in .prom) or as JSON.
+#
+# With metrics_file set to None all of this turns into no-op calls.
+#
+
+import os
+import json
+import socket
+import threading
+from collections import deque
+
+# local modules
+from clock import time
+from common import *
+import config
+
+
+#
+# Constants
+#
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# how many recent samples we keep for percentiles
+SAMPLES = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram(object):
+    """Cumulative bucket counts for export, plus a window of recent
+    samples for percentiles"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        stats = {'count': self.count, 'sum': self.sum,
+                 'max': max(self.samples) if self.samples else None}
+        for q in QUANTILES:
+            stats['p%i' % int(q * 100)] = self.quantile(q)
+        return stats
+
+    def as_prometheus(self, labels):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s histogram" % self.name]
+        for bound, count in zip(BUCKETS, self.counts):
+            lines.append('%s_bucket{%s,le="%g"} %i' % (self.name, labels, bound, count))
+        lines.append('%s_bucket{%s,le="+Inf"} %i' % (self.name, labels, self.count))
+        lines.append('%s_sum{%s} %f' % (self.name, labels, self.sum))
+        lines.append('%s_count{%s} %i' % (self.name, labels, self.count))
+        lines.append("# TYPE %s_quantile gauge" % self.name)
+        for q in QUANTILES:
+            value = self.quantile(q)
+            if value is not None:
+                lines.append('%s_quantile{%s,quantile="%g"} %f' %
+                             (self.name, labels, q, value))
+        return lines
+
+
+class Timeline(object):
+    """Timestamps of one clip's life, on a channel (anything hashable
+    that tells channels apart)"""
+
+    __slots__ = ('name', 'channel', 'events')
+
+    def __init__(self, name, channel=None):
+        self.name = name
+        self.channel = channel
+        self.events = {}
+
+    def mark(self, event, when=None):
+        self.events[event] = time() if when is None else when
+
+    def first(self, event):
+        """Mark an event only if it hasn't happened yet"""
+        if event not in self.events:
+            self.events[event] = time()
+
+    def forget(self, *events):
+        """Unmark events, for a player given up on before it was shown"""
+        for event in events:
+            self.events.pop(event, None)
+
+    def since(self, later, earlier):
+        if later in self.events and earlier in self.events:
+            return self.events[later] - self.events[earlier]
+        return None
+
+
+class NullTimeline(object):
+    """What clips get when metrics are off"""
+
+    __slots__ = ()
+
+    def mark(self, event, when=None):
+        pass
+
+    def first(self, event):
+        pass
+
+    def forget(self, *events):
+        pass
+
+
+NULL_TIMELINE = NullTimeline()
+
+
+class Metrics(object):
+    """Aggregates finished timelines and writes them out"""
+
+    def __init__(self, filename, interval=60, screen=None):
+        self.filename = filename
+        self.interval = interval
+        self.screen = screen or socket.gethostname()
+        self.gap = Histogram('exhibitvideo_clip_gap_seconds',
+                             'Time from one clip leaving the screen to the next appearing')
+        self.spawn_latency = Histogram('exhibitvideo_spawn_latency_seconds',
+                                       'Time from spawning a player to it running')
+        self.overrun = Histogram('exhibitvideo_clip_overrun_seconds',
+                                 'How late a clip was stopped after its deadline')
+        self.teardown = Histogram('exhibitvideo_teardown_seconds',
+                                  'Time from stopping a player to it and its children being gone')
+        self.sync_skew = Histogram('exhibitvideo_sync_skew_seconds',
+                                   'Spread between synced screens showing the same clip')
+        self.hang_detect = Histogram('exhibitvideo_hang_detect_seconds',
+                                     'Time from a player hanging to the watchdog noticing')
+        self.hang_recover = Histogram('exhibitvideo_hang_recover_seconds',
+                                      'Time from noticing a hung player to the next clip showing')
+        self.histograms = [self.gap, self.spawn_latency, self.overrun, self.teardown,
+                           self.sync_skew, self.hang_detect, self.hang_recover]
+        self.clips = 0
+        self.hangs = 0
+        # players we had to SIGKILL, and players that wouldn't die even then
+        self.teardown_kills = 0
+        self.leaked = 0
+        # seconds from process start to each stage of starting up
+        self.boot = {}
+        self.recipe_steps = 0
+        # channel -> when its last clip ended
+        self._last_ended = {}
+        self._last_write = time()
+        self._lock = threading.Lock()
+
+    def finish(self, timeline):
+        """Fold a finished clip's timeline into the stats"""
+        with self._lock:
+            self.clips += 1
+            events = timeline.events
+            last_ended = self._last_ended.get(timeline.channel)
+            if last_ended is not None and 'shown' in events:
+                self.gap.observe(max(events['shown'] - last_ended, 0.0))
+            latency = timeline.since('running', 'spawn')
+            if latency is not None:
+                self.spawn_latency.observe(latency)
+            overrun = timeline.since('ended', 'deadline')
+            if overrun is not None:
+                self.overrun.observe(max(overrun, 0.0))
+            if 'ended' in events:
+                self._last_ended[timeline.channel] = events['ended']
+        self.maybe_write()
+
+    def observe_skew(self, skew):
+        with self._lock:
+            self.sync_skew.observe(skew)
+
+    def observe_hang(self, detect):
+        with self._lock:
+            self.hangs += 1
+            self.hang_detect.observe(detect)
+
+    def observe_recovery(self, recover):
+        with self._lock:
+            self.hang_recover.observe(recover)
+
+    def observe_teardown(self, seconds):
+        with self._lock:
+            self.teardown.observe(seconds)
+
+    def teardown_killed(self):
+        with self._lock:
+            self.teardown_kills += 1
+
+    def set_leaked(self, count):
+        with self._lock:
+            self.leaked = count
+
+    def observe_boot(self, stage, seconds):
+        with self._lock:
+            self.boot[stage] = seconds
+
+    def recipe_step(self):
+        with self._lock:
+            self.recipe_steps += 1
+
+    def maybe_write(self):
+        if time() - self._last_write >= self.interval:
+            self.write()
+
+    def as_dict(self):
+        stats = {'screen': self.screen, 'time': time(), 'clips': self.clips,
+                 'recipe_steps': self.recipe_steps, 'hangs': self.hangs,
+                 'teardown_kills': self.teardown_kills, 'leaked_players': self.leaked,
+                 'boot_seconds': dict(self.boot)}
+        for hist in self.histograms:
+            stats[hist.name] = hist.as_dict()
+        return stats
+
+    def as_prometheus(self):
+        labels = 'screen="%s"' % self.screen
+        lines = ["# TYPE exhibitvideo_clips_total counter",
+                 "exhibitvideo_clips_total{%s} %i" % (labels, self.clips),
+                 "# TYPE exhibitvideo_recipe_steps_total counter",
+                 "exhibitvideo_recipe_steps_total{%s} %i" % (labels, self.recipe_steps),
+                 "# TYPE exhibitvideo_hangs_total counter",
+                 "exhibitvideo_hangs_total{%s} %i" % (labels, self.hangs),
+                 "# TYPE exhibitvideo_teardown_kills_total counter",
+                 "exhibitvideo_teardown_kills_total{%s} %i" % (labels, self.teardown_kills),
+                 "# TYPE exhibitvideo_leaked_players gauge",
+                 "exhibitvideo_leaked_players{%s} %i" % (labels, self.leaked)]
+        if self.boot:
+            lines.append("# TYPE exhibitvideo_boot_seconds gauge")
+        for stage, seconds in sorted(self.boot.items()):
+            lines.append('exhibitvideo_boot_seconds{%s,stage="%s"} %f' % (labels, stage, seconds))
+        for hist in self.histograms:
+            lines += hist.as_prometheus(labels)
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Write the stats file atomically, so scrapers never see half of it"""
+        with self._lock:
+            self._last_write = time()
+            if self.filename.endswith('.prom'):
+                text = self.as_prometheus()
+            else:
+                text = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        tmpname = self.filename + '.tmp'
+        try:
+            with open(tmpname, 'w') as fp:
+                fp.write(text)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            update("Couldn't write metrics to %s: %s" % (self.filename, str(e)))
+
+
+#
+# Shared metrics
+#
+
+enabled = bool(config.metrics_file)
+_metrics = Metrics(config.metrics_file, config.metrics_interval,
+                   config.metrics_screen) if enabled else None
+
+
+def get_metrics():
+    return _metrics
+
+
+def clip(name, channel=None):
+    """A timeline for a new clip on a channel (a no-op one if metrics
+    are off)"""
+    if not enabled:
+        return NULL_TIMELINE
+    return Timeline(name, channel)
+
+
+def finish(timeline):
+    if enabled and timeline is not NULL_TIMELINE:
+        _metrics.finish(timeline)
+
+
+def recipe_step():
+    if enabled:
+        _metrics.recipe_step()
+        _metrics.maybe_write()
+
+
+def sync_skew(skew):
+    if enabled:
+        _metrics.observe_skew(skew)
+
+
+def boot_stage(stage, seconds):
+    if enabled:
+        _metrics.observe_boot(stage, seconds)
+
+
+def teardown(seconds):
+    if enabled:
+        _metrics.observe_teardown(seconds)
+
+
+def teardown_killed():
+    if enabled:
+        _metrics.teardown_killed()
+
+
+def leaked_players(count):
+    if enabled:
+        _metrics.set_leaked(count)
+
+
+def hang(detect):
+    if enabled:
+        _metrics.observe_hang(detect)
+
+
+def hang_recovered(recover):
+    if enabled:
+        _metrics.observe_recovery(recover)
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+"""mp4info.py: read duration and stream info straight from MP4/MOV headers
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# MP4 and QuickTime files are a tree of boxes, each starting with a
+# 32-bit size and a four letter type. Everything we want is in the moov
+# box: the overall duration in moov/mvhd, and for each track its
+# timescale and duration (mdia/mdhd), its kind (mdia/hdlr), its codec
+# and picture size (stbl/stsd) and its sample count (stbl/stts).
+#
+# Keyframe times come from the video track's sample tables: stss says
+# which samples are keyframes, stts when each is decoded, ctts how much
+# later each is shown, and the edit list (edts/elst) where on the
+# movie's timeline the track starts. With B-frames the decode times run
+# ahead of what the player shows by a frame or two, so we use all of
+# them and give presentation times, as ffprobe does.
+#
+# We memory-map the file and hop from header to header, so we only ever
+# touch the few pages holding box headers and the moov box, wherever
+# it is in the file; moov at the end (no faststart) costs the same.
+#
+# probe() returns the same shape of dict as ffprobe.trim() makes from
+# ffprobe's output, or None if this isn't a file we understand, in which
+# case the caller should ask ffprobe.
+#
+
+import os
+import sys
+import mmap
+import struct
+from fractions import gcd
+
+#
+# Constants
+#
+
+# sample entry fourccs to ffprobe codec names
+CODECS = {
+    b'avc1': 'h264', b'avc3': 'h264',
+    b'hvc1': 'hevc', b'hev1': 'hevc',
+    b'mp4v': 'mpeg4', b'jpeg': 'mjpeg', b'mjpa': 'mjpeg',
+    b'apcn': 'prores', b'apch': 'prores', b'apcs': 'prores', b'apco': 'prores',
+    b'mp4a': 'aac', b'ac-3': 'ac3', b'ec-3': 'eac3', b'.mp3': 'mp3',
+    b'lpcm': 'pcm_s16le', b'sowt': 'pcm_s16le', b'twos': 'pcm_s16be',
+}
+
+HANDLERS = {b'vide': 'video', b'soun': 'audio', b'text': 'subtitle',
+            b'sbtl': 'subtitle', b'subt': 'subtitle'}
+
+# what ffprobe calls the family
+FORMAT_NAME = 'mov,mp4,m4a,3gp,3g2,mj2'
+
+# file extensions worth trying
+EXTENSIONS = set(['.mp4', '.m4v', '.mov', '.qt', '.3gp'])
+
+
+class BadFile(Exception):
+    pass
+
+
+def boxes(data, start, end):
+    """Yield (type, payload start, box end) for each box between start
+    and end"""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise BadFile("truncated box header")
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            # runs to the end of the file
+            size = end - pos
+        if size < header or pos + size > end:
+            raise BadFile("bad size for %r box" % kind)
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def find(data, start, end, kind):
+    """First child box of this kind, as (payload start, end), or None"""
+    for child, payload, box_end in boxes(data, start, end):
+        if child == kind:
+            return payload, box_end
+    return None
+
+
+def _version(data, pos):
+    return struct.unpack_from('>B', data, pos)[0]
+
+
+def parse_mvhd(data, pos):
+    """(timescale, duration) from a movie header"""
+    if _version(data, pos) == 1:
+        return struct.unpack_from('>IQ', data, pos + 20)
+    return struct.unpack_from('>II', data, pos + 12)
+
+
+parse_mdhd = parse_mvhd
+
+
+def parse_tkhd(data, pos):
+    """(width, height) from a track header"""
+    offset = 84 if _version(data, pos) == 0 else 96
+    width, height = struct.unpack_from('>II', data, pos + offset - 8)
+    return width >> 16, height >> 16
+
+
+def parse_hdlr(data, pos):
+    return struct.unpack_from('>4s', data, pos + 8)[0]
+
+
+def parse_stsd(data, pos):
+    """(fourcc, width, height) of the first sample entry"""
+    count = struct.unpack_from('>I', data, pos + 4)[0]
+    if not count:
+        return None, None, None
+    entry = pos + 8
+    fourcc = struct.unpack_from('>4s', data, entry + 4)[0]
+    width, height = struct.unpack_from('>HH', data, entry + 32)
+    return fourcc, width, height
+
+
+def parse_stts(data, pos):
+    """List of (sample count, sample duration) runs"""
+    count = struct.unpack_from('>I', data, pos + 4)[0]
+    flat = struct.unpack_from('>%iI' % (2 * count), data, pos + 8)
+    return zip(flat[0::2], flat[1::2])
+
+
+def parse_ctts(data, pos):
+    """List of (sample count, composition offset) runs"""
+    version = _version(data, pos)
+    count = struct.unpack_from('>I', data, pos + 4)[0]
+    # version 1 offsets are signed
+    flat = struct.unpack_from('>' + ('Ii' if version else 'II') * count, data, pos + 8)
+    return zip(flat[0::2], flat[1::2])
+
+
+def parse_elst(data, pos):
+    """List of (segment duration, media time) edits; media time -1 is
+    an empty edit, a delay before the track starts"""
+    version = _version(data, pos)
+    count = struct.unpack_from('>I', data, pos + 4)[0]
+    entry, size = ('>Qq', 20) if version == 1 else ('>Ii', 12)
+    return [struct.unpack_from(entry, data, pos + 8 + i * size) for i in range(count)]
+
+
+def parse_stss(data, pos):
+    """Sample numbers (counting from 1) of the sync samples"""
+    count = struct.unpack_from('>I', data, pos + 4)[0]
+    return struct.unpack_from('>%iI' % count, data, pos + 8)
+
+
+def parse_trak(data, start, end):
+    """Stream info for one track, or None if it has no media"""
+    stream = {}
+    tkhd = find(data, start, end, b'tkhd')
+    mdia = find(data, start, end, b'mdia')
+    if mdia is None:
+        return None
+    mdhd = find(data, mdia[0], mdia[1], b'mdhd')
+    hdlr = find(data, mdia[0], mdia[1], b'hdlr')
+    if mdhd is None or hdlr is None:
+        return None
+    timescale, duration = parse_mdhd(data, mdhd[0])
+    stream['time_base'] = '1/%i' % timescale
+    stream['codec_type'] = HANDLERS.get(parse_hdlr(data, hdlr[0]), 'data')
+    if timescale:
+        stream['duration'] = '%f' % (float(duration) / timescale)
+    minf = find(data, mdia[0], mdia[1], b'minf')
+    stbl = minf and find(data, minf[0], minf[1], b'stbl')
+    if stbl:
+        stsd = find(data, stbl[0], stbl[1], b'stsd')
+        if stsd:
+            fourcc, width, height = parse_stsd(data, stsd[0])
+            if fourcc:
+                stream['codec_name'] = CODECS.get(fourcc, fourcc.decode('latin-1').strip().lower())
+            if stream['codec_type'] == 'video':
+                stream['width'], stream['height'] = width, height
+        stts = find(data, stbl[0], stbl[1], b'stts')
+        if stts and stream['codec_type'] == 'video' and duration:
+            samples = sum(count for count, delta in parse_stts(data, stts[0]))
+            # frames per second as a ratio, like ffprobe's avg_frame_rate
+            num, den = samples * timescale, duration
+            common = gcd(num, den) or 1
+            stream['avg_frame_rate'] = '%i/%i' % (num // common, den // common)
+            stream['nb_frames'] = samples
+    if stream['codec_type'] == 'video' and 'width' not in stream and tkhd:
+        stream['width'], stream['height'] = parse_tkhd(data, tkhd[0])
+    return stream
+
+
+def find_moov(data):
+    """(payload start, end) of the moov box. Raises BadFile."""
+    # top level boxes are few and big; hop over mdat to find moov
+    moov = find(data, 0, len(data), b'moov')
+    if moov is None:
+        raise BadFile("no moov box")
+    return moov
+
+
+def parse(data):
+    """ffprobe-shaped info from a mapped file. Raises BadFile."""
+    moov = find_moov(data)
+    mvhd = find(data, moov[0], moov[1], b'mvhd')
+    if mvhd is None:
+        raise BadFile("no mvhd box")
+    timescale, duration = parse_mvhd(data, mvhd[0])
+    if not timescale or not duration:
+        # fragmented files keep their duration elsewhere
+        raise BadFile("no duration in mvhd")
+    streams = []
+    for kind, payload, box_end in boxes(data, moov[0], moov[1]):
+        if kind == b'trak':
+            stream = parse_trak(data, payload, box_end)
+            if stream is not None:
+                stream['index'] = len(streams)
+                streams.append(stream)
+    return {
+        'format': {'duration': '%f' % (float(duration) / timescale),
+                   'format_name': FORMAT_NAME},
+        'streams': streams,
+    }
+
+
+def _sample_values(runs, samples):
+    """For each of samples (sample numbers, counting from 1, in order)
+    the (start, value) of it in a list of (count, value) runs, where
+    start is the sum of the values of the samples before it"""
+    found = []
+    i, sample, total = 0, 1, 0
+    for count, value in runs:
+        run_end = sample + count
+        while i < len(samples) and samples[i] < run_end:
+            found.append((total + (samples[i] - sample) * value, value))
+            i += 1
+        total += count * value
+        sample = run_end
+    return found
+
+
+def _edit(data, start, end, movie_timescale, timescale):
+    """(delay, media start) from a track's edit list, both in the
+    track's timescale: how long the track waits before it starts, and
+    the decode time it starts from. We only follow the first edit that
+    shows media, which is all anything but an editing tool writes."""
+    edts = find(data, start, end, b'edts')
+    elst = edts and find(data, edts[0], edts[1], b'elst')
+    if not elst:
+        return 0, 0
+    delay = 0
+    for duration, media_time in parse_elst(data, elst[0]):
+        if media_time == -1:
+            if movie_timescale:
+                delay += duration * timescale // movie_timescale
+            continue
+        return delay, media_time
+    return delay, 0
+
+
+def parse_keyframes(data):
+    """Presentation times in seconds of the first video track's sync
+    samples (keyframes), with the composition offsets (ctts) and edit
+    list (elst) applied, so they match the player's positions. Raises
+    BadFile."""
+    moov = find_moov(data)
+    mvhd = find(data, moov[0], moov[1], b'mvhd')
+    movie_timescale = parse_mvhd(data, mvhd[0])[0] if mvhd else 0
+    for kind, start, end in boxes(data, moov[0], moov[1]):
+        if kind != b'trak':
+            continue
+        mdia = find(data, start, end, b'mdia')
+        hdlr = mdia and find(data, mdia[0], mdia[1], b'hdlr')
+        if not hdlr or parse_hdlr(data, hdlr[0]) != b'vide':
+            continue
+        mdhd = find(data, mdia[0], mdia[1], b'mdhd')
+        minf = find(data, mdia[0], mdia[1], b'minf')
+        stbl = minf and find(data, minf[0], minf[1], b'stbl')
+        stts = stbl and find(data, stbl[0], stbl[1], b'stts')
+        if not mdhd or not stts:
+            raise BadFile("video track without timing")
+        timescale = float(parse_mdhd(data, mdhd[0])[0])
+        if not timescale:
+            raise BadFile("video track without a timescale")
+        runs = parse_stts(data, stts[0])
+        stss = find(data, stbl[0], stbl[1], b'stss')
+        if stss is None:
+            # no sync sample table: every sample is a keyframe
+            sync = xrange(1, sum(count for count, delta in runs) + 1)
+        else:
+            sync = parse_stss(data, stss[0])
+        # decode times, walking the runs of equal-length samples
+        # alongside the sync list
+        decoded = [when for when, delta in _sample_values(runs, sync)]
+        ctts = find(data, stbl[0], stbl[1], b'ctts')
+        if ctts is not None:
+            offsets = _sample_values(parse_ctts(data, ctts[0]), sync)
+            if len(offsets) != len(decoded):
+                raise BadFile("ctts doesn't cover the keyframes")
+            decoded = [when + offset for when, (skip, offset) in zip(decoded, offsets)]
+        delay, media_start = _edit(data, start, end, movie_timescale, timescale)
+        # keyframes before the edit starts are never shown
+        return sorted((when - media_start + delay) / timescale for when in decoded
+                      if when >= media_start)
+    raise BadFile("no video track")
+
+
+def parse_faststart(data):
+    """Does the moov box come before the media data? Raises BadFile."""
+    for kind, payload, box_end in boxes(data, 0, len(data)):
+        if kind == b'moov':
+            return True
+        if kind == b'mdat':
+            return False
+    raise BadFile("no moov or mdat box")
+
+
+def _read(filename, parser):
+    """Map the file and run parser on it, or return None if this is not
+    a file we can read (wrong format, fragmented, damaged)"""
+    if os.path.splitext(filename)[1].lower() not in EXTENSIONS:
+        return None
+    try:
+        with open(filename, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size < 8:
+                return None
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return parser(data)
+            finally:
+                data.close()
+    except (IOError, OSError, ValueError, struct.error, BadFile):
+        return None
+
+
+def probe(filename):
+    """Info for an MP4/MOV file in ffprobe's shape, or None if we can't
+    read it, so ffprobe should"""
+    return _read(filename, parse)
+
+
+def faststart(filename):
+    """True if an MP4/MOV file can start playing before it is all read
+    (moov first), False if not, None if we can't tell"""
+    return _read(filename, parse_faststart)
+
+
+def keyframes(filename):
+    """Keyframe times in seconds for an MP4/MOV file, or None if we
+    can't read it"""
+    return _read(filename, parse_keyframes)
+
+
+#
+# Self check against generated files
+#
+
+def _box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _full(kind, payload, version=0):
+    return _box(kind, struct.pack('>I', version << 24) + payload)
+
+
+def make_sample(moov_at_end=False, large_mdat=False, seconds=10, fps=25,
+                width=640, height=360, reorder=False):
+    """The bytes of a tiny but well-formed MP4 with one video track. With
+    reorder, it is laid out as B-frames are: every frame shown two
+    frames after it is decoded, and an edit list to take that back out
+    of the timeline."""
+    timescale = fps * 1000
+    frames = seconds * fps
+    mvhd = _full(b'mvhd', struct.pack('>IIII', 0, 0, 1000, seconds * 1000) + b'\0' * 80)
+    tkhd = _full(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0, seconds * 1000) +
+                 b'\0' * 52 + struct.pack('>II', width << 16, height << 16))
+    mdhd = _full(b'mdhd', struct.pack('>IIII', 0, 0, timescale, frames * 1000) + b'\0' * 4)
+    hdlr = _full(b'hdlr', struct.pack('>I4s', 0, b'vide') + b'\0' * 13)
+    entry = _box(b'avc1', b'\0' * 6 + struct.pack('>H', 1) + b'\0' * 16 +
+                 struct.pack('>HH', width, height) + b'\0' * 50)
+    stsd = _full(b'stsd', struct.pack('>I', 1) + entry)
+    stts = _full(b'stts', struct.pack('>III', 1, frames, 1000))
+    # a keyframe every second
+    sync = range(1, frames + 1, fps)
+    stss = _full(b'stss', struct.pack('>%iI' % (len(sync) + 1), len(sync), *sync))
+    tables = stsd + stts + stss
+    edts = b''
+    if reorder:
+        tables += _full(b'ctts', struct.pack('>III', 1, frames, 2000))
+        edts = _box(b'edts', _full(b'elst', struct.pack('>IIiI', 1, seconds * 1000, 2000, 1 << 16)))
+    stbl = _box(b'stbl', tables)
+    mdia = _box(b'mdia', mdhd + hdlr + _box(b'minf', stbl))
+    moov = _box(b'moov', mvhd + _box(b'trak', tkhd + edts + mdia))
+    ftyp = _box(b'ftyp', b'isom\0\0\x02\0isomavc1')
+    payload = b'\0' * 4096
+    if large_mdat:
+        mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + len(payload)) + payload
+    else:
+        mdat = _box(b'mdat', payload)
+    if moov_at_end:
+        return ftyp + mdat + moov
+    return ftyp + moov + mdat
+
+
+def self_check(tmpdir):
+    ok = True
+    for moov_at_end in (False, True):
+        for large_mdat in (False, True):
+            filename = os.path.join(tmpdir, 'sample-%i%i.mp4' % (moov_at_end, large_mdat))
+            with open(filename, 'wb') as fp:
+                fp.write(make_sample(moov_at_end, large_mdat))
+            info = probe(filename)
+            video = info and info['streams'][0]
+            good = (info is not None and
+                    float(info['format']['duration']) == 10.0 and
+                    video['codec_name'] == 'h264' and
+                    (video['width'], video['height']) == (640, 360) and
+                    video['avg_frame_rate'] == '25/1' and
+                    keyframes(filename) == [float(t) for t in range(10)] and
+                    faststart(filename) == (not moov_at_end))
+            print "%-40s %s" % (filename, "ok" if good else "FAILED: %r" % info)
+            ok = ok and good
+    # B-frames: keyframes are shown later than they are decoded
+    filename = os.path.join(tmpdir, 'sample-reorder.mp4')
+    with open(filename, 'wb') as fp:
+        fp.write(make_sample(reorder=True))
+    good = keyframes(filename) == [float(t) for t in range(10)]
+    print "%-40s %s" % (filename, "ok" if good else "FAILED: %r" % keyframes(filename))
+    ok = ok and good
+    # and something that isn't an MP4 at all
+    filename = os.path.join(tmpdir, 'junk.mp4')
+    with open(filename, 'wb') as fp:
+        fp.write(b'this is not a video file at all')
+    good = probe(filename) is None
+    print "%-40s %s" % (filename, "ok" if good else "FAILED")
+    return ok and good
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from time import time
+    if len(sys.argv) > 1:
+        for filename in sys.argv[1:]:
+            start = time()
+            info = probe(filename)
+            print "%s (%.3fms)" % (filename, 1000 * (time() - start))
+            print info
+            start = time()
+            times = keyframes(filename)
+            print "%i keyframes (%.3fms)" % (len(times or []), 1000 * (time() - start))
+    else:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sys.exit(0 if self_check(tmpdir) else 1)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""playeroutput.py: drain a player's output as it comes, keeping the last few lines
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A player's stdout (and stderr, on the same pipe) is read on the event
+# loop whenever there is something there, so the player never blocks on
+# a full pipe, however much it says and however long it runs. We keep
+# only the last config.player_output_lines lines, for error reports.
+#
+# Lines are parsed as they come in. omxplayer run with --stats prints a
+# status line several times a second, ending in \r rather than \n:
+#
+#   M:  12345678 V:  6.00s  1024k/ 1024k A:  0.00  0.00s/ 0.00s Cv: 0k Ca: 0k
+#
+# where M is the media time in microseconds. That becomes .position,
+# with .progress_at the time it last moved, which the watchdog counts
+# as a sign of life alongside D-Bus.
+#
+# Whoever is playing on the player can set on_data(output) and
+# on_closed(output), called on the loop when something is read and when
+# the player closes its output (which it does when it exits).
+#
+
+import os
+import re
+import fcntl
+import errno
+from collections import deque
+
+# local modules
+from clock import time
+from common import *
+import config
+import engine
+
+#
+# Constants
+#
+
+READ_SIZE = 4096
+# a line longer than this is cut, so a player that never ends its
+# lines can't make us keep everything
+MAX_LINE = 1024
+
+STATS_LINE = re.compile(r'^M:\s*(-?\d+)')
+LINE_ENDS = re.compile(r'[\r\n]')
+
+
+class PlayerOutput(object):
+    """Reads one player's output on the event loop"""
+
+    def __init__(self, stream, name='player', lines=None, loop=None):
+        self.stream = stream
+        self.name = name
+        self.loop = loop or engine.get_loop()
+        self.lines = deque(maxlen=lines or config.player_output_lines)
+        # bytes read in all
+        self.bytes = 0
+        # media position from the last status line, in seconds, and
+        # when it last changed
+        self.position = None
+        self.progress_at = None
+        self.closed = False
+        self.on_data = None
+        self.on_closed = None
+        self._partial = ''
+        self._attached = False
+        fd = stream.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def start(self):
+        """Start reading. Call this on the loop."""
+        if not self.closed and not self._attached:
+            self._attached = True
+            self.loop.add_reader(self.stream, self.read)
+
+    def read(self):
+        """Read whatever is waiting, up to end of file"""
+        while not self.closed:
+            try:
+                data = os.read(self.stream.fileno(), READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            if not data:
+                self._eof()
+                return
+            self.feed(data)
+            if self.on_data is not None:
+                self.on_data(self)
+            if len(data) < READ_SIZE:
+                return
+
+    def feed(self, data):
+        """Split data into lines, keeping the last few and parsing them"""
+        self.bytes += len(data)
+        parts = LINE_ENDS.split(self._partial + data)
+        self._partial = parts.pop()
+        if len(self._partial) > MAX_LINE:
+            parts.append(self._partial[:MAX_LINE])
+            self._partial = ''
+        for line in parts:
+            if line:
+                self._parse(line)
+                self.lines.append(line[:MAX_LINE])
+
+    def _parse(self, line):
+        match = STATS_LINE.match(line)
+        if match:
+            position = int(match.group(1)) / 1e6
+            if position != self.position:
+                self.position = position
+                self.progress_at = time()
+
+    def _eof(self):
+        if self._partial:
+            self.lines.append(self._partial)
+            self._partial = ''
+        self.close()
+        if self.on_closed is not None:
+            self.on_closed(self)
+
+    def close(self):
+        """Stop reading and close the stream. Call this on the loop."""
+        if self._attached:
+            self.loop.remove_reader(self.stream)
+            self._attached = False
+        if not self.closed:
+            self.closed = True
+            self.stream.close()
+
+    def tail(self):
+        """The last few lines, as text"""
+        return "\n".join(self.lines)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+"""playerpool.py: a small pool of long-lived players driven over D-Bus
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Rather than spawning and killing a player per clip, we keep a few
+# players running, each on its own layer with its own D-Bus name, and
+# take turns using them. Between clips a player sits paused and hidden.
+# A new clip is loaded with OpenUri, positioned with SetPosition, and
+# revealed with SetAlpha. Players run with --loop so they never exit on
+# their own at the end of a file; clip deadlines are ours to keep.
+#
+# A player that has died is simply respawned the next time it's needed.
+# So is one that stops doing as it's told: it's killed when a command
+# fails, as if it had died.
+#
+# Each player's output is read on the event loop for as long as it runs,
+# clips or no clips, so it never fills its pipe while sitting idle.
+#
+
+import threading
+
+# local modules
+import clock
+from clock import time
+from common import *
+import config
+import dbuscontrol
+import engine
+import reaper
+import spawn
+from playeroutput import PlayerOutput
+
+
+class PooledPlayer(object):
+    """One long-lived player process"""
+
+    def __init__(self, player_id, layer, display=None):
+        self.player_id = player_id
+        self.layer = layer
+        self.display = display
+        self.process = None
+        self.output = None
+        self.control = dbuscontrol.PlayerControl(config.dbus_name % player_id)
+        # the file the player has open
+        self.filename = None
+
+    def __repr__(self):
+        return "PooledPlayer(%i, layer %i)" % (self.player_id, self.layer)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def load(self, filename, start=0.0):
+        """Open filename paused and hidden at start. Spawns the player if
+        it isn't running. Returns False if the player didn't come up."""
+        if not self.alive():
+            return self._spawn(filename, start)
+        if not self.control.set_alpha(0):
+            debug("Player %i didn't hide, respawning" % self.player_id)
+            self.kill()
+            return self._spawn(filename, start)
+        if filename != self.filename:
+            if not self.control.open_uri(filename):
+                debug("Player %i didn't take %s, respawning" % (self.player_id, filename))
+                self.kill()
+                return self._spawn(filename, start)
+            self.filename = filename
+        if not self._cue(start):
+            debug("Player %i didn't cue %s, respawning" % (self.player_id, filename))
+            self.kill()
+            return self._spawn(filename, start)
+        return True
+
+    def show(self):
+        """Reveal and play whatever is loaded. Returns False, having
+        killed the player, if it didn't do as it was told."""
+        if self.control.set_alpha(255) and self.control.play():
+            return True
+        debug("Player %i didn't show %s, killing it" % (self.player_id, self.filename))
+        self.kill()
+        return False
+
+    def hide(self):
+        """Pause and hide, leaving the player running for next time"""
+        if self.alive():
+            self.control.pause()
+            self.control.set_alpha(0)
+
+    def kill(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.control.quit()
+        # past this the reaper has given up on it as leaked
+        reaper.get_reaper().stop(self.process).wait(config.teardown_timeout + reaper.KILL_GRACE)
+        engine.get_loop().call_soon_threadsafe(self.output.close)
+        self.process = None
+        self.output = None
+        self.filename = None
+
+    def _spawn(self, filename, start):
+        # always the loop command, so the player outlives the file
+        argv = spawn.player_argv(['loop'], filename, start, self.layer,
+                                 self.player_id, hidden=True, display=self.display)
+        debug("Spawning pooled player %i: %s" % (self.player_id, argv), level=2)
+        spawn_time = time()
+        try:
+            self.process = spawn.launch(argv)
+        except OSError as e:
+            debug("Couldn't spawn pooled player %i: %s" % (self.player_id, str(e)))
+            self.process = None
+            return False
+        reaper.get_reaper().track(self.process, 'player %i' % self.player_id,
+                                  self.layer, self.display)
+        self.output = PlayerOutput(self.process.stdout, 'player %i' % self.player_id)
+        engine.get_loop().call_soon_threadsafe(self.output.start)
+        self.filename = filename
+        # D-Bus keeps real time
+        if not self.control.wait_ready(clock.timeout(config.player_pool_startup_timeout)):
+            debug("Pooled player %i never answered on D-Bus" % self.player_id)
+            self.kill()
+            return False
+        debug("Pooled player %i up in %.3fs" % (self.player_id, time() - spawn_time))
+        if not self._cue(start):
+            debug("Pooled player %i didn't cue %s" % (self.player_id, filename))
+            self.kill()
+            return False
+        return True
+
+    def _cue(self, start):
+        """Pause at start, ready to be shown"""
+        return self.control.pause() and self.control.set_position(start)
+
+
+class PlayerPool(object):
+    """Hands out players in rotation, so the next clip always loads on
+    a different player (and layer) from the one on screen"""
+
+    def __init__(self, layers, players=None, display=None):
+        if players is None:
+            players = range(1, len(layers) + 1)
+        self.players = [PooledPlayer(player_id, layer, display)
+                        for layer, player_id in zip(layers, players)]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            player = self.players[self._next]
+            self._next = (self._next + 1) % len(self.players)
+            return player
+
+    def shutdown(self):
+        for player in self.players:
+            player.kill()
+
+
+#
+# Shared pool
+#
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the shared player pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PlayerPool(config.player_pool_layers)
+    return _pool
+
+
+def shutdown():
+    """Stop every pooled player, if we ever started any"""
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
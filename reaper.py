@@ -0,0 +1,295 @@
+#!/usr/bin/python
+"""reaper.py: see every player we start all the way out
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Every player we spawn is tracked here, with the layer (and display)
+# it is on, until it is gone: the player itself reaped, and nothing
+# left in its process group. omxplayer is a script that runs
+# omxplayer.bin, so the player exiting is not enough; a leftover
+# omxplayer.bin holds on to GPU memory and its layer.
+#
+# Stopping a player sends SIGTERM to its process group and checks it
+# every REAP_INTERVAL seconds on the event loop. Anything still there
+# config.teardown_timeout seconds later gets SIGKILL; anything still
+# there KILL_GRACE seconds after that is counted as leaked, reported,
+# and tried again now and then.
+#
+# We make ourselves the "child subreaper" for our descendants (on
+# Linux), so when a player exits and leaves a child behind, the child
+# becomes ours rather than init's, and once it dies we reap it from
+# the player's group ourselves, instead of waiting on init.
+#
+# A clip about to spawn on a layer first asks when_free() for it. If
+# a player we started earlier is still on the layer, it is stopped
+# (if it isn't being stopped already) and the spawn waits until it is
+# gone, or until it is clear it won't go, rather than stacking a new
+# player on top of it.
+#
+# Everything here runs on the event loop, bar stop() and shutdown(),
+# which can be called from anywhere and return something to wait on.
+#
+
+import os
+import errno
+import ctypes
+import signal
+import threading
+
+# local modules
+from clock import time
+from common import *
+import config
+import engine
+import metrics
+from timing import Latch
+
+#
+# Constants
+#
+
+# how often a stopping player is checked
+REAP_INTERVAL = 0.01
+# after SIGKILL, how long before we call a player leaked
+KILL_GRACE = 1.0
+# how often a leaked player is checked again
+LEAK_INTERVAL = 10.0
+# prctl() option (from linux/prctl.h)
+PR_SET_CHILD_SUBREAPER = 36
+
+
+class Player(object):
+    """A player process we started"""
+
+    def __init__(self, process, name, layer=None, display=None):
+        self.process = process
+        self.pid = process.pid
+        # each player is the leader of its own process group
+        self.pgid = process.pid
+        self.name = name
+        self.layer = layer
+        self.display = display
+        # when we asked it to go, and if we had to SIGKILL it
+        self.stopping_at = None
+        self.killed = False
+        self.leaked = False
+        # set once the player and everything in its group are gone
+        self.gone = Latch()
+        self._waiters = []
+
+    def __repr__(self):
+        return "Player(%i, %r, layer %r)" % (self.pid, self.name, self.layer)
+
+    def exited(self):
+        """Has the player itself exited (and been reaped)?"""
+        return self.process.poll() is not None
+
+    def reap_group(self):
+        """Reap whatever of the group has died and is ours to reap: the
+        player's children, once it is gone itself"""
+        while True:
+            try:
+                pid, status = os.waitpid(-self.pgid, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if not pid:
+                return
+
+    def group_alive(self):
+        """Is anything left in the player's process group?"""
+        try:
+            os.killpg(self.pgid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.pgid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                debug("Couldn't signal %s (group %i): %s" % (self.name, self.pgid, str(e)))
+
+
+class Reaper(object):
+    """Tracks the players we started until they are gone"""
+
+    def __init__(self, loop=None):
+        self.loop = loop or engine.get_loop()
+        _become_subreaper()
+        # pid -> Player, for every player not yet gone
+        self._players = {}
+        self._lock = threading.Lock()
+
+    def track(self, process, name, layer=None, display=None):
+        """Start tracking a player we just spawned"""
+        player = Player(process, name, layer, display)
+        with self._lock:
+            self._players[player.pid] = player
+        return player
+
+    def players(self):
+        with self._lock:
+            return list(self._players.values())
+
+    def leaked(self):
+        return [player for player in self.players() if player.leaked]
+
+    def stop(self, process, sig=signal.SIGTERM, done=None):
+        """Stop a player (a Popen we tracked), from any thread. Returns a
+        Latch set once it and its process group are gone. done(), if
+        given, is called on the loop then, or once it's found leaked."""
+        with self._lock:
+            player = self._players.get(process.pid)
+        if player is None:
+            # not ours, or gone already
+            if done is not None:
+                self.loop.call_soon_threadsafe(done)
+            gone = Latch()
+            gone.set()
+            return gone
+        if done is not None:
+            self.loop.call_soon_threadsafe(self._when_gone, player, done)
+        self.loop.call_soon_threadsafe(self._stop, player, sig)
+        return player.gone
+
+    def _when_gone(self, player, done):
+        """Call done() once the player is gone, or found leaked. On the
+        loop, so it can't have gone between our looking and waiting."""
+        if player.gone.is_set() or player.leaked:
+            done()
+        else:
+            player._waiters.append(lambda player: done())
+
+    def when_free(self, layer, display, fn):
+        """Call fn() on the loop once no player of ours is left on the
+        layer, stopping whatever is there"""
+        holders = [player for player in self.players()
+                   if player.layer == layer and player.display == display
+                   and not player.leaked]
+        if not holders:
+            fn()
+            return
+        debug("Layer %i still has %s, waiting for it to go" %
+              (layer, ", ".join(player.name for player in holders)))
+        waiting = set(holder.pid for holder in holders)
+
+        def gone(player):
+            waiting.discard(player.pid)
+            if not waiting:
+                fn()
+        for holder in holders:
+            holder._waiters.append(gone)
+            self._stop(holder, signal.SIGTERM)
+
+    def _stop(self, player, sig):
+        if player.gone.is_set():
+            return
+        if sig == signal.SIGKILL:
+            player.killed = True
+        if player.stopping_at is not None:
+            # on its way out already; only ever escalate
+            if sig == signal.SIGKILL:
+                player.signal(sig)
+            return
+        player.stopping_at = time()
+        # the player may have exited by itself, leaving its children
+        player.signal(sig)
+        self._check(player)
+
+    def _check(self, player):
+        # the player first, through its Popen, so it keeps its exit status
+        if player.exited():
+            player.reap_group()
+            if not player.group_alive():
+                return self._gone(player)
+        waited = time() - player.stopping_at
+        if not player.killed and waited >= config.teardown_timeout:
+            report("%s didn't stop in %.1fs, killing it" % (player.name, waited))
+            player.killed = True
+            player.signal(signal.SIGKILL)
+            metrics.teardown_killed()
+        elif player.killed and not player.leaked and waited >= config.teardown_timeout + KILL_GRACE:
+            report("%s (group %i) won't die; leaving it for now" % (player.name, player.pgid))
+            player.leaked = True
+            metrics.leaked_players(len(self.leaked()))
+            self._wake(player)
+        if player.leaked:
+            player.signal(signal.SIGKILL)
+            self.loop.call_later(LEAK_INTERVAL, self._check, player)
+        else:
+            self.loop.call_later(REAP_INTERVAL, self._check, player)
+
+    def _gone(self, player):
+        with self._lock:
+            self._players.pop(player.pid, None)
+        if player.leaked:
+            report("%s is gone at last" % player.name)
+            metrics.leaked_players(len(self.leaked()))
+        else:
+            metrics.teardown(time() - player.stopping_at)
+        player.gone.set()
+        self._wake(player)
+
+    def _wake(self, player):
+        waiters, player._waiters = player._waiters, []
+        for waiter in waiters:
+            waiter(player)
+
+    def shutdown(self, timeout=None):
+        """Stop every player we have, and wait (from any thread but the
+        loop's) until they are gone or timeout passes. Returns the
+        players left behind."""
+        if timeout is None:
+            timeout = config.teardown_timeout + KILL_GRACE + 1.0
+        deadline = time() + timeout
+        for player in self.players():
+            self.stop(player.process)
+        for player in self.players():
+            player.gone.wait(max(deadline - time(), 0))
+        left = [player for player in self.players() if not player.gone.is_set()]
+        for player in left:
+            report("Left behind: %s (group %i)" % (player.name, player.pgid))
+        return left
+
+
+def _become_subreaper():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+        debug("Can't be a child subreaper (%s); init reaps what players leave" % str(e))
+
+
+#
+# Shared reaper
+#
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def get_reaper():
+    """Return the shared reaper, created on first use"""
+    global _reaper
+    if _reaper is None:
+        with _reaper_lock:
+            if _reaper is None:
+                _reaper = Reaper()
+    return _reaper
+
+
+def shutdown():
+    """Stop every player still running, if any were ever started"""
+    with _reaper_lock:
+        reaper = _reaper
+    if reaper is not None:
+        return reaper.shutdown()
+    return []
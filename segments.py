@@ -0,0 +1,299 @@
+#!/usr/bin/python
+"""segments.py: disk cache of pre-cut clip segments
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A clip that starts partway into a film, or is cut short by the recipe,
+# makes the player seek into a big file and then get killed on the
+# clock. Instead we cut such clips out ahead of time with ffmpeg stream
+# copy (no re-encoding), starting at the keyframe at or before the
+# clip's start, and play the cut file from (nearly) its beginning.
+#
+# Segments are keyed by (file, start, length, source mtime), so editing
+# a film makes its old segments unreachable; they then age out. The
+# directory is kept under config.segment_budget bytes (and clear of
+# config.segment_min_free), dropping the least recently played first.
+#
+# Building happens on a small pool of background threads, each running
+# one niced ffmpeg at a time. Nothing waits on it: a clip with no
+# segment yet plays from the original file and asks for one. Each cut
+# is written to a .part file and renamed into place when it's done; at
+# shutdown the ffmpegs still running are killed and their .part files
+# removed.
+#
+
+import os
+import json
+import hashlib
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+from time import time
+
+# local modules
+from common import *
+import config
+import keyframes
+
+nullin = open(os.devnull, 'r')
+
+# name of the index kept in the segment directory
+INDEX_FILE = 'segments.json'
+# segments this close to the whole file aren't worth cutting
+MIN_SAVING = 0.5
+
+
+class SegmentCache(object):
+    """Pre-cut segments in a directory, with an LRU disk budget"""
+
+    def __init__(self, directory, budget, min_free=0, workers=1):
+        self.directory = directory
+        self.budget = budget
+        self.min_free = min_free
+        self.workers = workers
+        # key -> {'file':, 'offset':, 'size':, 'used':}
+        self._segments = {}
+        # keys being built, and keys that failed to build
+        self._pending = set()
+        self._failed = set()
+        self._pool = None
+        # .part filename -> the ffmpeg writing it
+        self._running = {}
+        self._stopped = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self._segments)
+
+    def load(self):
+        """Read the index, keeping only segments still on disk, and
+        clear out cuts left half done by a crash"""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for name in os.listdir(self.directory):
+                if '.part.' in name:
+                    os.remove(os.path.join(self.directory, name))
+            with open(os.path.join(self.directory, INDEX_FILE), 'r') as fp:
+                segments = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return
+        with self._lock:
+            self._segments = dict(
+                (key, record) for key, record in segments.items()
+                if os.path.isfile(os.path.join(self.directory, record['file'])))
+
+    def save(self):
+        """Write the index atomically"""
+        with self._lock:
+            text = json.dumps(self._segments)
+        filename = os.path.join(self.directory, INDEX_FILE)
+        try:
+            with open(filename + '.tmp', 'w') as fp:
+                fp.write(text)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            debug("Couldn't write segment index %s: %s" % (filename, str(e)))
+
+    def lookup(self, filename, start, length):
+        """(segment filename, start within it) for this clip, or None"""
+        key = _key(filename, start, length)
+        if key is None:
+            return None
+        with self._lock:
+            record = self._segments.get(key)
+            if record is None:
+                return None
+            path = os.path.join(self.directory, record['file'])
+            if not os.path.isfile(path):
+                del self._segments[key]
+                return None
+            record['used'] = time()
+        return path, record['offset']
+
+    def request(self, filename, start, length):
+        """Build a segment for this clip in the background, unless we
+        have one, are building one, or couldn't"""
+        key = _key(filename, start, length)
+        if key is None:
+            return
+        with self._lock:
+            if self._stopped:
+                return
+            if key in self._segments or key in self._pending or key in self._failed:
+                return
+            self._pending.add(key)
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        self._pool.apply_async(self._build, (key, filename, start, length))
+
+    def shutdown(self):
+        """Stop building. Segments half built are thrown away."""
+        with self._lock:
+            self._stopped = True
+            pool, self._pool = self._pool, None
+            running, self._running = self._running, {}
+        # terminate() leaves the pool's ffmpegs running, so kill them
+        # ourselves
+        for partname, process in running.items():
+            try:
+                process.kill()
+                process.wait()
+            except OSError:
+                pass
+            try:
+                os.remove(partname)
+            except OSError:
+                pass
+        if pool is not None:
+            pool.terminate()
+        self.save()
+
+    def _build(self, key, filename, start, length):
+        try:
+            record = self._cut(key, filename, start, length)
+        except Exception as e:
+            debug("Couldn't cut %s at %.2fs: %s" % (filename, start, str(e)))
+            record = None
+        with self._lock:
+            self._pending.discard(key)
+            if record is None:
+                self._failed.add(key)
+                return
+            self._segments[key] = record
+        self._evict()
+        self.save()
+
+    def _cut(self, key, filename, start, length):
+        """Run ffmpeg to cut one segment. Returns its record, or None."""
+        # the cut has to start on a keyframe, so we need to know where
+        # they are; without an index we'd be guessing the offset
+        cut = 0.0
+        if start > 0:
+            times = keyframes.lookup(filename)
+            if not times:
+                return None
+            cut = keyframes.previous(times, start)
+        offset = start - cut
+        ext = os.path.splitext(filename)[1] or '.mp4'
+        name = key + ext
+        partname = os.path.join(self.directory, key + '.part' + ext)
+        argv = config.segment_cmd + [
+            '-nostdin', '-loglevel', 'error', '-y',
+            '-ss', '%.3f' % cut, '-i', filename, '-t', '%.3f' % (offset + length),
+            '-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero',
+            '-movflags', '+faststart', partname]
+        started = time()
+        with self._lock:
+            # started under the lock, so shutdown() can't miss it
+            if self._stopped:
+                return None
+            process = subprocess.Popen(argv, stdin=nullin, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            self._running[partname] = process
+        try:
+            output = process.communicate()[0]
+        finally:
+            with self._lock:
+                self._running.pop(partname, None)
+        if self._stopped:
+            # shutdown() killed it, or will have nothing to kill
+            try:
+                os.remove(partname)
+            except OSError:
+                pass
+            return None
+        if process.returncode != 0 or not os.path.isfile(partname):
+            debug("ffmpeg failed cutting %s: %s" % (filename, output))
+            if os.path.exists(partname):
+                os.remove(partname)
+            return None
+        os.rename(partname, os.path.join(self.directory, name))
+        size = os.path.getsize(os.path.join(self.directory, name))
+        debug("Cut %s at %.2fs for %.2fs in %.2fs (%i bytes)" %
+              (filename, cut, offset + length, time() - started, size))
+        return {'file': name, 'offset': offset, 'size': size, 'used': time()}
+
+    def _evict(self):
+        """Drop least recently used segments until we are within budget"""
+        with self._lock:
+            oldest = sorted(self._segments, key=lambda k: self._segments[k]['used'])
+            total = sum(record['size'] for record in self._segments.values())
+            dropped = []
+            while oldest and (total > self.budget or self._short_of_space()):
+                key = oldest.pop(0)
+                record = self._segments.pop(key)
+                total -= record['size']
+                dropped.append(record['file'])
+                try:
+                    os.remove(os.path.join(self.directory, record['file']))
+                except OSError:
+                    pass
+        if dropped:
+            debug("Dropped %i segments to stay within budget" % len(dropped))
+
+    def _short_of_space(self):
+        if not self.min_free:
+            return False
+        try:
+            st = os.statvfs(self.directory)
+        except OSError:
+            return False
+        return st.f_bavail * st.f_frsize < self.min_free
+
+
+def _key(filename, start, length):
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        return None
+    text = "%s|%.3f|%.3f|%r" % (os.path.normpath(filename), start, length, mtime)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def worth_cutting(start, length, filelength):
+    """Would a segment save the player any work?"""
+    return start > 0 or length < filelength - MIN_SAVING
+
+
+#
+# Shared cache
+#
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the shared segment cache, creating it on first use.
+    Returns None if segments are turned off in config."""
+    global _cache
+    if _cache is None and config.segment_dir:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SegmentCache(config.segment_dir, config.segment_budget,
+                                      config.segment_min_free, config.segment_workers)
+    return _cache
+
+
+def lookup(filename, start, length):
+    cache = get_cache()
+    if cache is None:
+        return None
+    return cache.lookup(filename, start, length)
+
+
+def request(filename, start, length):
+    cache = get_cache()
+    if cache is not None:
+        cache.request(filename, start, length)
+
+
+def shutdown():
+    if _cache is not None:
+        _cache.shutdown()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+"""soak.py: play weeks of the recipe in minutes, and look for leaks
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Leaks in a player that runs for weeks (a dict that never forgets, a
+# thread or a pipe left behind by every clip) only show after days.
+# This runs exhibitvideo.main() on a clock that goes --speed times
+# faster than real time, with the benchmark's stand-ins for omxplayer
+# and ffprobe, until --days of clips have gone by. Every
+# --sample-interval seconds of the clock's time it counts our memory
+# (RSS), open files, threads and child processes.
+#
+# It fails (exits non-zero) if any of those grew by more than its
+# threshold between the start and the end of the run, leaving out the
+# first --warmup days, while caches fill. Each is compared as the
+# median of the first and last quarter of the samples, so a sample
+# taken while one player is on its way out and the next on its way in
+# doesn't count as growth. Any player left running after shutdown
+# fails it too.
+#
+# The players still keep real time, so the settings that wait on them
+# (player startup, teardown, the watchdog) are stretched to match.
+# Each clip lasts --clip-length seconds of the clock's time; keep that
+# well above what spawning a player costs in real time times --speed.
+#
+# e.g.  python soak.py                  # 30 days of 5 minute clips, ~15 min
+#       python soak.py --days 2 --output soak.json
+#
+
+import os
+import sys
+import json
+import signal
+import argparse
+import tempfile
+import threading
+import shutil
+from time import time
+
+# nothing else yet: the other modules open the log file when imported,
+# and we want it somewhere else
+import config
+import benchmark
+import clock
+
+DAY = 24 * 60 * 60
+
+# settings (module, name) that wait on real processes, and so keep
+# real time however fast the clock goes
+REAL_TIME_SETTINGS = [
+    ('config', 'watchdog_interval'),
+    ('config', 'watchdog_startup'),
+    ('config', 'watchdog_stall'),
+    ('config', 'teardown_timeout'),
+    ('config', 'preroll_min_lead'),
+    ('config', 'preroll_max_lead'),
+    ('config', 'player_pool_startup_timeout'),
+    ('reaper', 'REAP_INTERVAL'),
+    ('reaper', 'KILL_GRACE'),
+    ('reaper', 'LEAK_INTERVAL'),
+]
+
+# what we count, and how much each may grow by default
+RESOURCES = [
+    ('rss_kb', 8192),
+    ('fds', 8),
+    ('threads', 4),
+    ('children', 2),
+]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Soak test the player in fast time")
+    parser.add_argument('--days', type=float, default=30.0, help="days of clips to play")
+    parser.add_argument('--speed', type=float, default=3000.0,
+                        help="how much faster than real time the clock goes")
+    parser.add_argument('--clip-length', type=float, default=300.0,
+                        help="seconds (of the clock's time) each clip plays for")
+    parser.add_argument('--films', type=int, default=200, help="films in the catalog")
+    parser.add_argument('--sample-interval', type=float, default=3600.0,
+                        help="seconds (of the clock's time) between samples")
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help="days left out of the comparison")
+    for name, limit in RESOURCES:
+        parser.add_argument('--max-%s-growth' % name.replace('_', '-'), type=int,
+                            default=limit, help="allowed growth in %s" % name)
+    parser.add_argument('--player-failure-rate', type=float, default=0.0)
+    parser.add_argument('--player-hang-rate', type=float, default=0.0)
+    parser.add_argument('--player-stubborn-rate', type=float, default=0.0,
+                        help="chance of a player ignoring SIGTERM and leaving a child")
+    parser.add_argument('--probe-failure-rate', type=float, default=0.0)
+    parser.add_argument('--preroll', action='store_true')
+    parser.add_argument('--debug', type=int, default=0, help="debug level for the log")
+    parser.add_argument('--output', help="write results, with every sample, here too")
+    args = parser.parse_args(argv)
+    # what benchmark.setup() wants that we don't ask about
+    args.player_startup = 0.0
+    args.player_runtime = 60.0
+    args.probe_delay = 0.0
+    args.no_cache = False
+    return args
+
+
+def setup(args, workdir):
+    benchmark.setup(args, workdir)
+    # films as long as their clips
+    os.environ['FAKEPROBE_DURATION'] = str(args.clip_length)
+    # safe to import now that config is settled
+    import reaper
+    modules = {'config': config, 'reaper': reaper}
+    for module, name in REAL_TIME_SETTINGS:
+        value = getattr(modules[module], name)
+        if value:
+            setattr(modules[module], name, value * args.speed)
+
+
+#
+# Counting
+#
+
+def open_fds():
+    # less the one listdir() has open
+    return len(os.listdir('/proc/self/fd')) - 1
+
+
+def live_threads():
+    # every thread, not just python's
+    return len(os.listdir('/proc/self/task'))
+
+
+def children():
+    """Processes descended from us, however many generations down"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as fp:
+                # the command name may have spaces in it, so count from after it
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    found = 0
+    todo = [os.getpid()]
+    while todo:
+        kids = parents.get(todo.pop(), [])
+        found += len(kids)
+        todo.extend(kids)
+    return found
+
+
+def sample(start, metrics):
+    return {
+        'day': (clock.time() - start) / DAY,
+        'clips': metrics.get_metrics().clips,
+        'rss_kb': benchmark.rss_kb(),
+        'fds': open_fds(),
+        'threads': live_threads(),
+        'children': children(),
+    }
+
+
+class Sampler(threading.Thread):
+    """Samples every interval of the clock's time, and sends us SIGTERM
+    once the run is over, as systemd would"""
+
+    def __init__(self, start, days, interval, metrics):
+        super(Sampler, self).__init__(name='soak-sampler')
+        self.daemon = True
+        self.start_time = start
+        self.end_time = start + days * DAY
+        self.interval = interval
+        self.metrics = metrics
+        self.samples = []
+
+    def run(self):
+        while clock.time() < self.end_time:
+            self.samples.append(sample(self.start_time, self.metrics))
+            clock.sleep(min(self.interval, self.end_time - clock.time()))
+        self.samples.append(sample(self.start_time, self.metrics))
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+#
+# Judging
+#
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def growth(samples, key):
+    """(before, after): the medians of key over the first and the last
+    quarter of the samples"""
+    quarter = max(len(samples) // 4, 1)
+    return median([s[key] for s in samples[:quarter]]), median([s[key] for s in samples[-quarter:]])
+
+
+def leaks(result, args):
+    """List what grew by more than it may"""
+    found = []
+    for name, default in RESOURCES:
+        before, after = result['growth'][name]
+        limit = getattr(args, 'max_%s_growth' % name)
+        if after - before > limit:
+            found.append("%s grew from %i to %i (more than %i)" % (name, before, after, limit))
+    if result['children_after_shutdown']:
+        found.append("%i processes left after shutdown" % result['children_after_shutdown'])
+    return found
+
+
+def run(args):
+    # safe to import now that config is settled
+    import exhibitvideo
+    import metrics
+    clock.set_clock(clock.ScaledClock(args.speed))
+    start = clock.time()
+    real_start = time()
+    sampler = Sampler(start, args.days, args.sample_interval, metrics)
+    sampler.start()
+    exhibitvideo.main()
+    sampler.join()
+    real_elapsed = time() - real_start
+    samples = sampler.samples
+    settled = [s for s in samples if s['day'] >= args.warmup] or samples
+    clips = metrics.get_metrics().clips
+    days = (clock.time() - start) / DAY
+    return {
+        'revision': benchmark.revision(),
+        'python': sys.version.split()[0],
+        'params': vars(args),
+        'days': days,
+        'real_seconds': real_elapsed,
+        'clips': clips,
+        'clips_per_day': clips / days if days else 0,
+        'hangs': metrics.get_metrics().hangs,
+        'teardown_kills': metrics.get_metrics().teardown_kills,
+        'peak': dict((name, max(s[name] for s in samples)) for name, limit in RESOURCES),
+        'growth': dict((name, growth(settled, name)) for name, limit in RESOURCES),
+        'children_after_shutdown': children(),
+        'samples': samples,
+    }
+
+
+def main(argv):
+    args = parse_args(argv)
+    sys.stderr.write("Playing %g days of clips, which should take about %.0f minutes\n" %
+                     (args.days, args.days * DAY / args.speed / 60))
+    workdir = tempfile.mkdtemp(prefix='exhibitvideo-soak-')
+    try:
+        setup(args, workdir)
+        result = run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    found = leaks(result, args)
+    result['leaks'] = found
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(json.dumps(result, indent=2, sort_keys=True) + "\n")
+    del result['samples']
+    print json.dumps(result, indent=2, sort_keys=True)
+    for problem in found:
+        sys.stderr.write("leak: %s\n" % problem)
+    if found:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""spawn.py: build player command lines and launch players without a shell
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# The player commands in config.py are lists of shell-ish fragments
+# ('--layer %i', '--aspect-mode stretch'). We split them into proper
+# argv lists once, remember where the layer and player numbers go, and
+# exec the player directly: no /bin/sh in between, and filenames with
+# quotes or spaces in them just work.
+#
+# Each player gets its own session (and so its own process group, whose
+# id is the player's pid) so it can be killed along with its children.
+# Under python 3 Popen does that itself. Python 2's only way is
+# preexec_fn, which runs python code between fork and exec; instead we
+# put setsid(1) in front of the command, which calls setsid() and execs
+# the player in the same process.
+#
+
+import os
+import sys
+import shlex
+import subprocess
+import threading
+
+# local modules
+from common import *
+import config
+
+nullin = open(os.devnull, 'r')
+
+# can Popen start a new session by itself?
+_new_session_supported = sys.version_info >= (3, 2)
+
+# we throw the argv cache away when it gets this big
+ARGV_CACHE_SIZE = 1000
+
+
+class CommandTemplate(object):
+    """A player command split into argv, with the layer and player
+    number slots found in advance"""
+
+    def __init__(self, cmd):
+        self.args = shlex.split(" ".join(cmd))
+        # positions of the '%i's, in order: layer, then player
+        self._slots = [i for i, arg in enumerate(self.args) if '%i' in arg]
+
+    def argv(self, layer, player):
+        argv = list(self.args)
+        for i, value in zip(self._slots, (layer, player)):
+            argv[i] = argv[i] % value
+        return argv
+
+
+class Slots(object):
+    """The layers and player numbers one screen's clips take turns on,
+    and the display they go to. Each clip takes the next (layer, player)
+    pair, so a new clip never lands on the one still showing."""
+
+    def __init__(self, layers, players, display=None):
+        if len(layers) != len(players):
+            raise ValueError("need a player number for each layer")
+        self.layers = list(layers)
+        self.players = list(players)
+        self.display = display
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Slots(%r, %r, display=%r)" % (self.layers, self.players, self.display)
+
+    def take(self):
+        """The next (layer, player) pair"""
+        with self._lock:
+            i = self._next
+            self._next = (i + 1) % len(self.layers)
+        return self.layers[i], self.players[i]
+
+
+_templates = {}
+_argv_cache = {}
+_lock = threading.Lock()
+
+
+def clip_kind(tags):
+    """Which player command a clip uses: 'loop', 'transition' or 'content'"""
+    if 'loop' in tags:
+        return 'loop'
+    if 'transition' in tags:
+        return 'transition'
+    return 'content'
+
+
+def template(kind):
+    """The CommandTemplate for a kind of clip, built on first use"""
+    if kind not in _templates:
+        _templates[kind] = CommandTemplate(getattr(config, kind + '_cmd'))
+    return _templates[kind]
+
+
+def reset():
+    """Forget templates and cached argvs, e.g. after changing config"""
+    with _lock:
+        _templates.clear()
+        _argv_cache.clear()
+
+
+def player_argv(tags, filename, start, layer, player, hidden=False, display=None):
+    """argv to play filename from start on a layer as player number
+    player, on the given display (None for the player's default).
+    Loops ignore start, as they always have. Hidden players start fully
+    transparent."""
+    kind = clip_kind(tags)
+    key = (kind, filename, start, layer, player, hidden, display)
+    argv = _argv_cache.get(key)
+    if argv is None:
+        argv = template(kind).argv(layer, player)
+        if display is not None:
+            argv += ['--display', str(display)]
+        if kind != 'loop':
+            argv += ['--pos', str(start)]
+        if hidden:
+            argv += ['--alpha', '0']
+        argv.append(filename)
+        with _lock:
+            if len(_argv_cache) >= ARGV_CACHE_SIZE:
+                _argv_cache.clear()
+            _argv_cache[key] = argv
+    return argv
+
+
+def launch(argv):
+    """Start a player in its own session, with stdout and stderr
+    together on a pipe. The player's pid is also its process group id."""
+    if _new_session_supported:
+        return subprocess.Popen(argv, start_new_session=True, stdin=nullin,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if config.setsid_cmd:
+        return subprocess.Popen(config.setsid_cmd + argv, stdin=nullin,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return subprocess.Popen(argv, preexec_fn=os.setsid, stdin=nullin,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
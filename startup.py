@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""startup.py: get something on screen fast at power-on, and time it
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Galleries power the players on every morning, and loading a big
+# catalog (reading the db, probing every film) takes a while. So we keep
+# a small snapshot of a few films we know play (loops and titles, by
+# default), written once the whole catalog has loaded and been probed,
+# along with each file's size and mtime. At the next start we play one
+# of those straight away, over and over if need be, while the catalog
+# loads in the background; the recipe starts once it is ready.
+#
+# A snapshot film whose file has changed since is passed over, and with
+# no usable snapshot we just wait for the catalog, as before.
+#
+# Each start logs how long it took to get the first frame on screen and
+# to have the whole catalog loaded and probed, counted from when the
+# process started, and from power-on (as far as /proc can tell).
+#
+
+import os
+import json
+import threading
+from pprint import pformat
+from time import time
+
+# local modules
+from common import *
+import config
+import ffprobe
+import filmdb
+import metrics
+
+#
+# Constants
+#
+
+# films kept in the snapshot
+SNAPSHOT_FILMS = 3
+
+
+def process_start():
+    """When this process started, by the clock; now, if we can't tell"""
+    try:
+        with open('/proc/stat') as fp:
+            btime = [int(line.split()[1]) for line in fp if line.startswith('btime')][0]
+        with open('/proc/self/stat') as fp:
+            # the command name may have spaces in it, so count from after it
+            fields = fp.read().rsplit(')', 1)[1].split()
+        return btime + int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return time()
+
+
+def uptime():
+    """Seconds since power-on, or None"""
+    try:
+        with open('/proc/uptime') as fp:
+            return float(fp.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+class Boot(object):
+    """Times the stages of starting up, each logged once"""
+
+    def __init__(self):
+        self.start = process_start()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def mark(self, stage):
+        with self._lock:
+            if stage in self.stages:
+                return
+            self.stages[stage] = elapsed = time() - self.start
+        since_power = uptime()
+        if since_power is not None:
+            report("Boot: %s %.2fs after start (%.1fs after power-on)" %
+                   (stage.replace('_', ' '), elapsed, since_power))
+        else:
+            report("Boot: %s %.2fs after start" % (stage.replace('_', ' '), elapsed))
+        metrics.boot_stage(stage, elapsed)
+
+    def first_frame(self, at=None):
+        """For VideoThread.on_shown"""
+        self.mark('first_frame')
+
+
+def when_loaded(catalog, boot):
+    """Once the catalog is loaded and probed, log it and snapshot it for
+    next time, on a thread of its own"""
+    def wait():
+        catalog.prepared.wait()
+        boot.mark('catalog')
+        debug("\nfilm_dict = \n", Lazy(pformat, catalog.index()), level=2)
+        save_snapshot(catalog)
+    thread = threading.Thread(target=wait, name='startup-snapshot')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+#
+# Snapshot
+#
+
+def _stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def load_snapshot(filename=None):
+    """Films from the snapshot whose files haven't changed since"""
+    filename = filename or config.startup_snapshot
+    if not filename:
+        return []
+    try:
+        with open(filename, 'r') as fp:
+            snapshot = filmdb.load_json(fp)
+    except (IOError, OSError, ValueError):
+        return []
+    films = []
+    for entry in snapshot.get('films', []):
+        path = os.path.join(config.media_base, entry['film']['file'])
+        if _stamp(path) == entry.get('stamp'):
+            films.append(filmdb.Film.from_dict(entry['film']))
+        else:
+            debug("Snapshot film %s has changed, not using it" % entry['film']['file'])
+    return films
+
+
+def save_snapshot(catalog, filename=None):
+    """Remember a few films from the loaded catalog to start with next
+    time: enabled, on disk, and probed without trouble"""
+    filename = filename or config.startup_snapshot
+    if not filename:
+        return
+    entries = []
+    saved = []
+    for tag in config.startup_tags:
+        for film in catalog.films(tag):
+            if len(entries) >= SNAPSHOT_FILMS:
+                break
+            path = os.path.join(config.media_base, film['file'])
+            info = ffprobe.info(path)
+            if not info or not info.get('duration') or film in saved:
+                continue
+            saved.append(film)
+            entries.append({'film': film.as_dict(), 'stamp': _stamp(path)})
+    text = json.dumps({'time': time(), 'films': entries})
+    try:
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filename + '.tmp', 'w') as fp:
+            fp.write(text)
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as e:
+        debug("Couldn't write startup snapshot %s: %s" % (filename, str(e)))
+        return
+    debug("Startup snapshot: %s" % ", ".join(e['film']['file'] for e in entries))
+
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+"""sync.py: keep several exhibit players switching clips together
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# One node, the coordinator, runs the recipe as usual. For every clip it
+# multicasts a schedule: which film, and the time it goes on screen, in
+# the coordinator's clock, config.sync_lead seconds ahead. Followers
+# don't run a recipe; they play what they're told, pre-rolled to go on
+# screen at that moment. A follower plays the same file if it has it,
+# otherwise a film with the same tag of its own, cut to the length the
+# coordinator's clip plays for, so the next clip finds it gone.
+#
+# Clocks: each follower asks the coordinator the time every
+# sync_ping_interval seconds, NTP style, and keeps the answer from the
+# quickest round trip of the last few as its estimate of the offset.
+# The coordinator says hello on the group at the same interval, so
+# followers know where to ask before the first clip.
+#
+# Skew: every node tells the coordinator when each clip actually went
+# on screen, in the coordinator's clock. The coordinator logs the
+# spread for each clip, feeds it to the metrics, and reports a summary
+# every sync_report_interval seconds.
+#
+# Messages are small JSON objects in UDP datagrams:
+#
+#   hello  coordinator -> group         {reply: port}
+#   clip   coordinator -> group         {seq, at, film, length, reply: port}
+#   bye    coordinator -> group         the coordinator is stopping
+#   ping   follower -> coordinator      {t0}, answered with pong {t0, t1}
+#   shown  any node -> coordinator      {node, seq, at}
+#
+
+import os
+import json
+import errno
+import select
+import socket
+import struct
+import threading
+from collections import deque
+from time import time
+
+# local modules
+from common import *
+import config
+import ffprobe
+import metrics
+import videothread
+from timing import Latch
+
+#
+# Constants
+#
+
+# clock samples kept; we use the one with the quickest round trip
+OFFSET_SAMPLES = 8
+# clips we keep collecting skew reports for
+OPEN_CLIPS = 4
+# skews kept for the summary
+SKEW_SAMPLES = 1000
+MAX_DATAGRAM = 8192
+
+
+def node_name():
+    return config.sync_node or socket.gethostname()
+
+
+def _send(sock, message, address):
+    try:
+        sock.sendto(json.dumps(message).encode('utf-8'), address)
+    except socket.error as e:
+        debug("Couldn't send %s to %s: %s" % (message.get('type'), address, str(e)))
+
+
+def _receive(sock):
+    """(message, address) from a socket that's ready, or (None, None)"""
+    try:
+        data, address = sock.recvfrom(MAX_DATAGRAM)
+        return json.loads(data.decode('utf-8')), address
+    except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+            debug("Sync receive failed: %s" % str(e))
+    except ValueError:
+        debug("Sync message that isn't JSON ignored")
+    return None, None
+
+
+def _select(files, timeout):
+    try:
+        return select.select(files, [], [], max(timeout, 0))[0]
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
+
+
+def group_sender():
+    """A socket for sending to the multicast group (and receiving
+    unicast replies)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.sync_ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    if config.sync_interface != '0.0.0.0':
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                        socket.inet_aton(config.sync_interface))
+        sock.bind((config.sync_interface, 0))
+    else:
+        sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+
+def group_listener():
+    """A socket that receives what's sent to the multicast group. Any
+    number of them can share the port on one machine."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', config.sync_port))
+    membership = struct.pack('4s4s', socket.inet_aton(config.sync_group),
+                             socket.inet_aton(config.sync_interface))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    sock.setblocking(False)
+    return sock
+
+
+class ClockOffset(object):
+    """Estimates what to add to our clock to get the coordinator's"""
+
+    def __init__(self):
+        # (round trip, offset)
+        self._samples = deque(maxlen=OFFSET_SAMPLES)
+
+    def add(self, t0, t1, t2):
+        """We asked at t0, the coordinator said t1, we heard at t2"""
+        self._samples.append((t2 - t0, t1 - (t0 + t2) / 2.0))
+
+    def __len__(self):
+        return len(self._samples)
+
+    def known(self):
+        return bool(self._samples)
+
+    def best(self):
+        return min(self._samples) if self._samples else (None, 0.0)
+
+    @property
+    def offset(self):
+        return self.best()[1]
+
+    @property
+    def rtt(self):
+        return self.best()[0]
+
+
+class SkewStats(object):
+    """Collects when each node showed each clip, and the spread"""
+
+    def __init__(self):
+        # seq -> {node: time shown}
+        self._open = {}
+        self.skews = deque(maxlen=SKEW_SAMPLES)
+        self.nodes = set()
+        self._lock = threading.Lock()
+
+    def shown(self, seq, node, at):
+        with self._lock:
+            self.nodes.add(node)
+            self._open.setdefault(seq, {})[node] = at
+            # followers report soon after showing, so once a clip is a
+            # few behind, everyone who will report has
+            for old in sorted(self._open):
+                if old <= seq - OPEN_CLIPS:
+                    self._close(old)
+
+    def close_all(self):
+        with self._lock:
+            for seq in sorted(self._open):
+                self._close(seq)
+
+    def _close(self, seq):
+        shown = self._open.pop(seq)
+        if len(shown) < 2:
+            return
+        skew = max(shown.values()) - min(shown.values())
+        self.skews.append(skew)
+        metrics.sync_skew(skew)
+        latest = max(shown, key=shown.get)
+        debug("Clip %i skew %.1fms across %i nodes (last: %s)" %
+              (seq, skew * 1000, len(shown), latest))
+
+    def summary(self):
+        with self._lock:
+            skews = sorted(self.skews)
+        if not skews:
+            return {'clips': 0, 'nodes': len(self.nodes)}
+        count = len(skews)
+        return {
+            'clips': count,
+            'nodes': len(self.nodes),
+            'p50_ms': 1000 * skews[count // 2],
+            'p95_ms': 1000 * skews[min(int(count * 0.95), count - 1)],
+            'max_ms': 1000 * skews[-1],
+        }
+
+
+def slot_length(film):
+    """How long the coordinator's clip of a film plays for (from the
+    media cache, which the catalog has warmed)"""
+    filename = os.path.join(config.media_base, film['file'])
+    filelength = ffprobe.duration(filename) or 0
+    return videothread.clip_span(film, filename, filelength)[1]
+
+
+class Coordinator(threading.Thread):
+    """Announces the schedule and answers followers' clock questions"""
+
+    def __init__(self):
+        super(Coordinator, self).__init__(name='sync-coordinator')
+        self.daemon = True
+        self.node = node_name()
+        self.stats = SkewStats()
+        self._sock = group_sender()
+        self._group = (config.sync_group, config.sync_port)
+        self._port = self._sock.getsockname()[1]
+        self._stop = Latch()
+        self._seq = 0
+        self._last_report = time()
+
+    def schedule(self, film, start_at=None):
+        """Announce a clip. It goes on screen at start_at, or as soon as
+        the followers can be ready. Returns (seq, start time)."""
+        at = max(start_at or 0, time() + config.sync_lead)
+        self._seq += 1
+        _send(self._sock, {'type': 'clip', 'seq': self._seq, 'at': at,
+                           'film': film.as_dict(), 'length': slot_length(film),
+                           'reply': self._port}, self._group)
+        return self._seq, at
+
+    def shown_callback(self, seq):
+        """Something for VideoThread.on_shown, for our own screen"""
+        return lambda at: self.stats.shown(seq, self.node, at)
+
+    def stop(self):
+        _send(self._sock, {'type': 'bye'}, self._group)
+        self._stop.set()
+        self.stats.close_all()
+        self.report()
+
+    def report(self):
+        self._last_report = time()
+        s = self.stats.summary()
+        if s['clips']:
+            update("Sync skew over %i clips, %i nodes: p50 %.1fms p95 %.1fms max %.1fms" %
+                   (s['clips'], s['nodes'], s['p50_ms'], s['p95_ms'], s['max_ms']))
+
+    def run(self):
+        next_hello = 0
+        while not self._stop.is_set():
+            now = time()
+            if now >= next_hello:
+                _send(self._sock, {'type': 'hello', 'reply': self._port}, self._group)
+                next_hello = now + config.sync_ping_interval
+            if now - self._last_report >= config.sync_report_interval:
+                self.report()
+            if self._sock in _select([self._sock, self._stop], next_hello - now):
+                self._handle(*_receive(self._sock))
+        self._sock.close()
+
+    def _handle(self, message, address):
+        if not message:
+            return
+        kind = message.get('type')
+        if kind == 'ping':
+            _send(self._sock, {'type': 'pong', 't0': message.get('t0'), 't1': time()},
+                  address)
+        elif kind == 'shown':
+            self.stats.shown(message['seq'], message['node'], message['at'])
+
+
+class Follower(object):
+    """Plays what the coordinator announces, when it says"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.node = node_name()
+        self.clock = ClockOffset()
+        self._group = group_listener()
+        self._sock = group_sender()
+        self._coordinator = None
+        self._threads = []
+        self._stop = Latch()
+
+    def stop(self):
+        """Stop following, and cut the clip showing short"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.stop()
+
+    def run(self, steps=None):
+        """Follow until the coordinator says bye, or for steps clips"""
+        report("Following on %s:%i as %s" % (config.sync_group, config.sync_port, self.node))
+        played = 0
+        next_ping = 0
+        try:
+            while (steps is None or played < steps) and not self._stop.is_set():
+                now = time()
+                if self._coordinator and now >= next_ping:
+                    _send(self._sock, {'type': 'ping', 't0': now}, self._coordinator)
+                    # ask more often until we have a few answers
+                    quick = len(self.clock) < OFFSET_SAMPLES
+                    next_ping = now + config.sync_ping_interval / (4.0 if quick else 1.0)
+                timeout = next_ping - now if self._coordinator else config.sync_ping_interval
+                for sock in _select([self._group, self._sock, self._stop], timeout):
+                    if sock is self._stop:
+                        break
+                    message, address = _receive(sock)
+                    if not message:
+                        continue
+                    kind = message.get('type')
+                    if kind in ('hello', 'clip') and self._coordinator is None:
+                        self._coordinator = (address[0], message['reply'])
+                        next_ping = 0
+                    if kind == 'pong':
+                        self.clock.add(message['t0'], message['t1'], time())
+                    elif kind == 'clip':
+                        self._play(message)
+                        played += 1
+                    elif kind == 'bye':
+                        report("Coordinator said bye")
+                        return
+        finally:
+            for thread in self._threads:
+                thread.wait_for_end()
+            self._group.close()
+            self._sock.close()
+
+    def _play(self, message):
+        wanted = message['film']
+        film = self.catalog.film(wanted['file'])
+        if film is None:
+            # not on our card: something else with the same tag, for
+            # as long as the coordinator's clip plays
+            for tag in wanted.get('tags', []):
+                film = self.catalog.choice(tag)
+                if film is not None:
+                    break
+            if film is not None and message.get('length'):
+                film = film.override(length=message['length'])
+        elif wanted.get('length'):
+            film = film.override(length=wanted['length'])
+        if film is None:
+            debug("Nothing to play for clip %i (%s)" % (message['seq'], wanted['file']))
+            return
+        if not self.clock.known():
+            debug("Playing clip %i before we know the clock offset" % message['seq'])
+        offset = self.clock.offset
+        start_at = message['at'] - offset
+        seq = message['seq']
+        thread = videothread.VideoThread(film, config.media_base, debug=config.debug,
+                                         start_at=start_at)
+
+        def shown(at):
+            _send(self._sock, {'type': 'shown', 'node': self.node, 'seq': seq,
+                               'at': at + offset}, self._coordinator)
+
+        thread.on_shown = shown
+        thread.start()
+        self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+        debug("Clip %i: %s in %.3fs (offset %.2fms, rtt %.2fms)" %
+              (seq, film['file'], start_at - time(), offset * 1000,
+               (self.clock.rtt or 0) * 1000))
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""synctest.py: run a coordinator and followers on one machine, and report skew
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Starts one coordinator and a few followers as separate processes, each
+# with its own generated catalog and fakeplayer.py standing in for
+# omxplayer (set up as benchmark.py does), all multicasting over the
+# loopback interface. The coordinator runs --steps clips; when it's done
+# the skew between screens, from its metrics, is printed as JSON.
+#
+# The stand-in player has no D-Bus here, so dbus-send is replaced by a
+# command that always answers; pre-roll timing is then down to us.
+#
+# e.g.  python synctest.py --followers 3 --steps 30 --clip-length 0.5
+#
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# nothing else yet: the other modules open the log file when imported
+import config
+import benchmark
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Try synced playback on one machine")
+    parser.add_argument('--followers', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20, help="clips the coordinator plays")
+    parser.add_argument('--clip-length', type=float, default=0.5)
+    parser.add_argument('--player-startup', type=float, default=0.0)
+    parser.add_argument('--lead', type=float, default=0.5,
+                        help="how far ahead clips are announced")
+    parser.add_argument('--port', type=int, default=0, help="default: a random one")
+    parser.add_argument('--debug', type=int, default=0)
+    # set for the child processes
+    parser.add_argument('--node', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def node_main(args):
+    """One player: set up like the benchmark, then play or follow"""
+    bench_args = benchmark.parse_args(['--films', '20', '--clip-length', str(args.clip_length),
+                                       '--player-startup', str(args.player_startup),
+                                       '--debug', str(args.debug), '--preroll'])
+    benchmark.setup(bench_args, args.workdir)
+    config.sync_role = 'coordinator' if args.node == 'coordinator' else 'follower'
+    config.sync_node = args.node
+    config.sync_interface = '127.0.0.1'
+    config.sync_port = args.port
+    config.sync_lead = args.lead
+    config.sync_ping_interval = 0.5
+    config.sync_report_interval = 3600
+    config.watch_media = False
+    config.dbus_native = False
+    config.dbus_send_cmd = ['sh', '-c', 'echo int64 0', 'dbus-send']
+    import exhibitvideo
+    import metrics
+    if config.sync_role == 'coordinator':
+        exhibitvideo.main(steps=args.steps)
+        print json.dumps(metrics.get_metrics().as_dict()['exhibitvideo_sync_skew_seconds'])
+    else:
+        exhibitvideo.main()
+    return 0
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.node:
+        return node_main(args)
+    port = args.port or random.randint(20000, 60000)
+    workdir = tempfile.mkdtemp(prefix='exhibitvideo-sync-')
+    common = [sys.executable, os.path.abspath(__file__), '--port', str(port),
+              '--clip-length', str(args.clip_length), '--lead', str(args.lead),
+              '--player-startup', str(args.player_startup), '--debug', str(args.debug)]
+    followers = []
+    try:
+        for i in range(args.followers):
+            name = 'follower%i' % (i + 1)
+            followers.append(subprocess.Popen(
+                common + ['--node', name, '--workdir', os.path.join(workdir, name)]))
+        coordinator = subprocess.Popen(
+            common + ['--node', 'coordinator', '--steps', str(args.steps),
+                      '--workdir', os.path.join(workdir, 'coordinator')],
+            stdout=subprocess.PIPE)
+        out = coordinator.communicate()[0]
+        for follower in followers:
+            follower.wait()
+    finally:
+        for follower in followers:
+            if follower.poll() is None:
+                follower.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    skew = json.loads(out.strip().splitlines()[-1])
+    summary = {'followers': args.followers, 'clips': skew['count']}
+    for key in ('p50', 'p95', 'p99', 'max'):
+        summary['skew_%s_ms' % key] = skew[key] * 1000 if skew[key] is not None else None
+    print json.dumps(summary, indent=2, sort_keys=True)
+    return 0 if skew['count'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
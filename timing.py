@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""timing.py: waitable primitives for clip timing
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import errno
+import select
+import threading
+
+# local modules
+import clock
+from clock import time
+
+
+class Latch(object):
+    """A one-shot flag that threads can block on.
+
+    Unlike threading.Event under python 2, waiting with a timeout does
+    not poll: the flag is backed by a pipe, and waiters sit in select()
+    until the flag is set or the timeout runs out. Because it has a
+    fileno(), a latch can be waited on together with other files, like
+    a player's stdout, in a single wait_until() call."""
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._lock = threading.Lock()
+        self._set = False
+
+    def fileno(self):
+        return self._read_fd
+
+    def set(self):
+        with self._lock:
+            if self._set or self._write_fd is None:
+                return
+            self._set = True
+            os.write(self._write_fd, b'x')
+
+    def is_set(self):
+        return self._set
+
+    def wait(self, timeout=None):
+        """Wait until set, or for timeout seconds. Returns is_set()."""
+        if self._set:
+            return True
+        deadline = None if timeout is None else time() + timeout
+        wait_until(deadline, [self])
+        return self._set
+
+    def close(self):
+        with self._lock:
+            for fd in (self._read_fd, self._write_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._read_fd = self._write_fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def wait_until(deadline, files=()):
+    """Block until the clock's time() reaches deadline, or until any of
+    files is readable, whichever comes first. A deadline of None waits
+    on the files alone. Returns the list of readable files, which is
+    empty if the deadline passed.
+
+    This is a single select() with a timeout, so a waiting thread wakes
+    exactly once, when there is something to do."""
+    files = [f for f in files if f is not None]
+    while True:
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = deadline - time()
+            if timeout <= 0:
+                return []
+        try:
+            ready, _, _ = select.select(files, [], [], clock.timeout(timeout))
+        except (select.error, OSError) as e:
+            # interrupted by a signal, go round again with what's left
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if ready:
+            return ready
@@ -10,12 +10,18 @@ from random import choice
 import threading
 import os
 from subprocess import call
-import json
+from multiprocessing.pool import ThreadPool
+from time import time
 
 # local modules
 import videothread
+import channel
 from common import *
+import config
 import ffprobe
+import filmdb
+import mediacache
+import segments
 
 #
 # Constants
@@ -41,49 +47,15 @@ import ffprobe
 #
 
 def read_film_file(filename):
-    """Get JSON film file. File """
-    with open(filename, 'r') as fp:
-        return json_load_byteified(fp)
-
-# json returns unicode objects, but for our purposes byte format is fine
-# http://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-ones-from-json-in-python
-
-
-def json_load_byteified(file_handle):
-    return _byteify(
-        json.load(file_handle, object_hook=_byteify),
-        ignore_dicts=True
-    )
-
-
-def json_loads_byteified(json_text):
-    return _byteify(
-        json.loads(json_text, object_hook=_byteify),
-        ignore_dicts=True
-    )
-
-
-def _byteify(data, ignore_dicts = False):
-    # if this is a unicode string, return its string representation
-    if isinstance(data, unicode):
-        return data.encode('utf-8')
-    # if this is a list of values, return list of byteified values
-    if isinstance(data, list):
-        return [ _byteify(item, ignore_dicts=True) for item in data ]
-    # if this is a dictionary, return dictionary of byteified keys and values
-    # but only if we haven't already byteified it
-    if isinstance(data, dict) and not ignore_dicts:
-        return {
-            _byteify(key, ignore_dicts=True): _byteify(value, ignore_dicts=True)
-            for key, value in data.iteritems()
-        }
-    # if it's anything else, return it in its original form
-    return data
+    """Get JSON film file, as a list of Film records"""
+    return filmdb.read(filename)
 
 
 def create_film_lists_dict(film_list):
     """Iterate through imported database and sort list by type"""
     film_dict = {}
+    # probe everything we need up front, in parallel
+    probed = probe_films(film_list)
     for film in film_list:
         filename = config.media_base + '/' + film['file']
         if 'name' in film:
@@ -97,7 +69,8 @@ def create_film_lists_dict(film_list):
         else:
             # first let's fill in necessary but missing fields
             if ('length' not in film or film['length'] == 0):
-                film['length'] = get_duration(filename)
+                info = probed.get(filename)
+                film = film.override(length=(info and info['duration']) or 0)
                 debug("Getting duration for %s: %f" % (name, film['length']))
             # make lists of film types
             # Note, that this means a film can be in several lists
@@ -133,6 +106,80 @@ def create_content_dict(content_list):
 # file stuff
 #
 
+def probe_films(film_list, workers=None):
+    """Probe duration and stream info for every enabled film that lacks
+    a length, running up to workers ffprobes at once. Films already in
+    the media cache cost only a lookup. Returns a dict of info dicts
+    keyed by full filename."""
+    if workers is None:
+        workers = config.probe_workers
+    filenames = []
+    seen = set()
+    for film in film_list:
+        if 'disabled' in film and film['disabled']:
+            continue
+        if ('length' in film and film['length']):
+            continue
+        filename = config.media_base + '/' + film['file']
+        if filename not in seen and os.path.isfile(filename):
+            seen.add(filename)
+            filenames.append(filename)
+    if not filenames:
+        return {}
+    start_time = time()
+    pool = ThreadPool(max(1, min(workers, len(filenames))))
+    try:
+        infos = pool.map(_probe_one, filenames)
+    finally:
+        pool.close()
+        pool.join()
+    cache = mediacache.get_cache()
+    if cache is not None:
+        cache.save()
+    elapsed = time() - start_time
+    report("Probed %i films in %.2fs (%.1f/s, %i workers)" %
+           (len(filenames), elapsed, len(filenames) / max(elapsed, 1e-6), workers))
+    return dict(zip(filenames, infos))
+
+
+def precut_films(film_list):
+    """Ask for pre-cut segments of every enabled film that the recipe
+    plays from partway in or cuts short"""
+    if not config.segment_dir:
+        return
+    # recipe lengths for each tag (0 meaning the film's own length),
+    # over every channel's recipe
+    lengths = {}
+    for spec in channel.configured():
+        for tag, length in spec['recipe']:
+            lengths.setdefault(tag, set()).add(length or 0)
+    for film in film_list:
+        if 'disabled' in film and film['disabled']:
+            continue
+        if 'loop' in film.get('tags', []):
+            continue
+        filename = config.media_base + '/' + film['file']
+        info = ffprobe.info(filename)
+        if not info or not info['duration']:
+            continue
+        overrides = set()
+        for tag in film.get('tags', []):
+            overrides |= lengths.get(tag, set())
+        for length in overrides:
+            clip = film.override(length=length) if length else film
+            start, length = videothread.clip_span(clip, filename, info['duration'])
+            if segments.worth_cutting(start, length, info['duration']):
+                segments.request(filename, start, length)
+
+
+def _probe_one(filename):
+    try:
+        return ffprobe.info(filename, save=False)
+    except Exception as e:
+        debug("Couldn't probe %s: %s" % (filename, str(e)))
+        return None
+
+
 def get_duration(filename):
     debug("Getting duration of %s" % filename)
     length = ffprobe.duration(filename)
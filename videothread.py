@@ -1,40 +1,100 @@
 #!/usr/bin/python
-"""videothread.py: Threaded, stopable video player class
+"""videothread.py: stopable video player clips, run on the event loop
 Author: Wes Modes (wmodes@gmail.com)
 Copyright: 2017, MIT """
 
 # -*- coding: iso-8859-15 -*-
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
-import threading
-import subprocess
 import sys
 import signal
 import os
-from time import sleep, time
 
 # local imports
+import clock
+from clock import time
 import ffprobe
 from common import *
 import config
+from timing import Latch, wait_until
+import dbuscontrol
+import engine
+import playerpool
+import playeroutput
+import reaper
+import spawn
+import metrics
+import filmdb
+import keyframes
+import segments
 
 nullin = open(os.devnull, 'r')
-nullout = open(os.devnull, 'w')
 
 #
 # globals
 #
 
-omx_layer_content = 1
-omx_layer_loop = 3
-omx_layer_transition = 5
-omx_player = 1
+# layers and players for clips that aren't on a channel of their own:
+# they alternate between layers 1 and 2, as players 1 and 2
+default_slots = spawn.Slots([1, 2], [1, 2])
 
+# measured time from spawning a player to it answering on D-Bus,
+# smoothed over recent clips. None until we have measured one.
+startup_latency = None
+# weight of the newest measurement in startup_latency
+startup_latency_weight = 0.3
 
 
-class VideoThread(threading.Thread):
-    """Thread class with a stop() method. The thread itself checks
-    regularly for the stopped() condition."""
+def preroll_lead():
+    """How many seconds before a clip boundary to start the next player.
+    Learned from measured startup latency, within the configured bounds."""
+    if startup_latency is None:
+        return config.preroll_max_lead
+    lead = startup_latency * config.preroll_margin
+    return min(max(lead, config.preroll_min_lead), config.preroll_max_lead)
+
+
+def _learn_startup_latency(latency):
+    global startup_latency
+    if startup_latency is None:
+        startup_latency = latency
+    else:
+        startup_latency += startup_latency_weight * (latency - startup_latency)
+
+
+def clip_span(video, filename, filelength):
+    """The (start, length) a film record will actually play for: the
+    length defaults to the whole file, a start past the end goes back to
+    0, the start is moved onto a nearby keyframe, and the length is cut
+    back to what's left of the file, unless the clip loops."""
+    if ('length' not in video or video['length'] == 0.0):
+        length = filelength
+    else:
+        length = video['length']
+    # get start
+    if 'start' in video:
+        start = video['start']
+    else:
+        start = 0.0
+    # if start is too large, set it to 0
+    if (start >= filelength):
+        start = 0.0
+    # move the start onto a nearby keyframe, so the player can seek fast
+    if start and config.keyframe_snap:
+        times = keyframes.lookup(filename)
+        if times:
+            start = keyframes.snap(times, start)
+    # if length is too large, scale it back, unless loop
+    if (('loop' not in video['tags']) and (start + length >= filelength)):
+        length = filelength - start
+    return start, length
+
+
+class Playback(object):
+    """One clip on the event loop: its player, its deadline, and, with
+    pre-roll, its reveal. Everything here runs as callbacks on the loop
+    (or on its executor, for the blocking parts), so there is no thread
+    per clip. Other threads use start(), stop() and the waits."""
     _example = """
         The class takes a a dictionary containing
         data about the videos to be played:
@@ -47,66 +107,123 @@ class VideoThread(threading.Thread):
              }
         """
 
-    def __init__(self, video=None, media_dir=".", debug=0):
-        super(VideoThread, self).__init__()
-        self._stop = threading.Event()
+    def __init__(self, video=None, media_dir=".", debug=0, start_at=None,
+                 slots=None, pool=None, loop=None):
+        self.loop = loop or engine.get_loop()
+        self._stopped = False
+        # set when the clip's time is up, however it came about
+        self._ended = Latch()
+        # set once _end_time is known (or we know it never will be)
+        self._timed = Latch()
+        # set once we are all done, player reaped
+        self._finished = Latch()
         # passed parameters
         self.video = video
         self.media_dir = media_dir
+        # if given, pre-roll: start the player hidden and paused right
+        # away, and reveal it at this time()
+        self.start_at = start_at
+        # where the clip is shown: the layers and player numbers to take
+        # turns on, or the pool of players to take one from
+        self.slots = slots or default_slots
+        self.pool = pool
         # internal flags and vars
         self._debug_flag = debug
         self._last_debug_caller = None
-        self._current_video = None
-        self._player_pgid = None
+        self._name = None
+        self._length = 0
+        self._process = None
+        self._player = None
+        self._player_id = None
+        self._deadline = None
+        self._reveal = None
+        # the (filename, start, layer) the player was launched with, and
+        # a count of players launched, so callbacks meant for one we've
+        # given up on can tell (see _for_launch)
+        self._clip = None
+        self._launches = 0
+        # set once _end() has run
+        self._over = False
+        # watchdog: when the player last showed progress, the last
+        # position it told us, whether it has ever answered on D-Bus
+        self._control = None
+        self._watchdog = None
+        self._spawned_at = None
+        self._progress_at = None
+        self._position = None
+        self._answered = False
+        # if the player hung: how ('startup', 'stalled' or 'exited'),
+        # and when we noticed
+        self.hung = None
+        self.hung_at = None
         self._end_time = 0
+        # the player's output, read as it comes, and whether it has
+        # said anything since this clip started
+        self._out = None
+        self._heard = False
+        # timing events for metrics
+        self._timeline = metrics.NULL_TIMELINE
+        # when the clip went on screen, and who wants to know
+        self.shown_at = None
+        self.on_shown = None
 
-    def set_sequence(self, video=None):
-        self.video = video
+    def start(self):
+        self.loop.call_soon_threadsafe(self._begin)
 
     def stop(self):
         self._debug("Stop flag set")
-        self._stop.set()
+        self._stopped = True
+        self._ended.set()
+        self.loop.call_soon_threadsafe(self._end, False)
 
     def stopped(self):
-        return self._stop.isSet()
+        return self._stopped
+
+    def finished(self):
+        return self._finished.is_set()
 
     def debug(self, debug_flag):
         self._debug_flag = debug_flag
 
     def _debug(self, *args, **kwargs):
-        """Produce debug message, indenting if from same calling function"""
-        level = 1
-        if ("level" in kwargs):
-            level = kwargs["level"]
-        elif("l" in kwargs):
-            level = kwargs["l"]
-        if (self._debug_flag >= level):
-            text = " ".join(list(map(str, args)))
-            # get name of calling function
-            caller = sys._getframe(1).f_code.co_name
-            if (caller == self._last_debug_caller):
-                #print "  debug: %s: %s" % (caller, text)
-                logger.info("  debug: %s: %s" % (caller, text))
-            else:
-                #print "debug: %s: %s" % (caller, text)
-                logger.info("debug: %s: %s" % (caller, text))
-            # save last calling function
-            self._last_debug_caller = caller
-
-    def run(self):
-        if not isinstance(self.video, dict):
-            raise ValueError(self._example)
-        if not self.stopped():
-            self._start_video(self.video)
-
-    def _start_video(self, video):
-        """Starts a video. Takes a video object """
+        """Produce debug message if level is within our debug flag. Nothing
+        is formatted unless the message is going to be logged."""
+        level = kwargs.get("level", kwargs.get("l", 1))
+        if (self._debug_flag < level):
+            return
+        text = format_args(args)
+        if not config.debug_callers:
+            logger.info("debug: " + text)
+            return
+        # get name of calling function, and indent if it's the same as last time
+        caller = sys._getframe(1).f_code.co_name
+        if (caller == self._last_debug_caller):
+            #print "  debug: %s: %s" % (caller, text)
+            logger.info("  debug: %s: %s" % (caller, text))
+        else:
+            #print "debug: %s: %s" % (caller, text)
+            logger.info("debug: %s: %s" % (caller, text))
+        # save last calling function
+        self._last_debug_caller = caller
+
+    #
+    # Starting: find out what to play (on the executor, since it may
+    # mean running ffprobe), then spawn a player or load a pooled one
+    #
+
+    def _begin(self):
+        if not isinstance(self.video, (dict, filmdb.Record)):
+            self._debug("Not played:", Lazy(repr, self.video), self._example)
+            return self._done()
+        if self.stopped():
+            return self._done()
+        self.loop.run_in_executor(self._prepare, (self.video,), self._prepared)
+
+    def _prepare(self, video):
+        """Work out the file, start and length to play. Returns None if
+        the clip isn't to be played."""
         # add media_dir to filename
-        global omx_layer_content, omx_layer_loop, omx_layer_transition, omx_player
         filename = self.media_dir + '/' + video['file']
-        # check to make sure we've passed the right thing
-        if not isinstance(video, dict):
-            raise ValueError(self._example)
         # set video name if we have it
         if 'name' in video:
             name = video['name']
@@ -115,134 +232,503 @@ class VideoThread(threading.Thread):
         # skip this video if disabled in db
         if 'disabled' in video and video['disabled']:
             self._debug("Not played:", name, "disabled")
-            return
+            return None
+        # a channel is told apart by where its clips go
+        self._timeline = metrics.clip(
+            name, (self.slots.display, tuple(self.slots.layers)))
+        self._timeline.mark('scheduled', self.start_at)
         #debug messages
-        self._debug("Starting %s in %s" % (name, self.media_dir))
+        self._debug("Starting", name, "in", self.media_dir)
         self._debug("Video data:", video)
-        # get length
+        # get length and start
         filelength = self._get_length(filename)
-        if ('length' not in video or video['length'] == 0.0):
-            length = filelength
-        else:
-            length = video['length']
-        # get start
-        if 'start' in video:
-            start = video['start']
-        else:
-            start = 0.0
-        # if start is too large, set it to 0
-        if (start >= filelength):
-            start = 0.0
-        # if length is too large, scale it back, unless loop
-        if (('loop' not in video['tags']) and (start + length >= filelength)):
-            length = filelength - start
-        # store this for later
-        self._current_video = video
+        start, length = clip_span(video, filename, filelength)
+        if start and start != video.get('start', 0.0):
+            self._debug(lazy_format("Start of %s moved to keyframe at %.2fs", name, start))
         # debugging output
-        self._debug("name: %s (%s)" % (name, filename))
-        self._debug("tags: %s" % video['tags'])
-        self._debug("start: %.1fs, end: %.1fs, len: %.1fs" %
-                    (start, start+length, length))
-        # each time we switch to a new video, we switch the layer
-        # this will effectively toggle the 3 layer variables between (1,2), (3,4), and (5,6)
-        omx_layer_content = 1 if (omx_layer_content != 1) else 2
-        omx_layer_loop = 3 if (omx_layer_loop != 3) else 4
-        omx_layer_transition = 5 if (omx_layer_transition != 5) else 6
-        # we also toggle the virtual player
-        omx_player = 1 if (omx_player != 1) else 2
-        # build omxplayer command
-        if ('loop' in video['tags']):
-            my_cmd = " ".join(config.loop_cmd) % \
-                    (omx_layer_content, omx_player)
-            my_cmd += " '" + filename + "'"
-        elif ('transition' in video['tags']):
-            my_cmd = " ".join(config.transition_cmd + ['--pos', str(start)]) % \
-                    (omx_layer_content, omx_player)
-            my_cmd += " '" + filename + "'"
-        else: 
-            my_cmd = " ".join(config.content_cmd + ['--pos', str(start)]) % \
-                    (omx_layer_content, omx_player)
-            my_cmd += " '" + filename + "'"
-        self._debug("cmd:", my_cmd, l=2)
+        self._debug(lazy_format("name: %s (%s)", name, filename))
+        self._debug("tags:", video['tags'])
+        self._debug(lazy_format("start: %.1fs, end: %.1fs, len: %.1fs",
+                                start, start+length, length))
+        # play a pre-cut segment of the film if we have one, or ask for one
+        if (config.segment_dir and 'loop' not in video['tags'] and
+                segments.worth_cutting(start, length, filelength)):
+            segment = segments.lookup(filename, start, length)
+            if segment is None:
+                segments.request(filename, start, length)
+            else:
+                self._debug(lazy_format("Playing pre-cut segment %s from %.2fs", *segment))
+                filename, start = segment
+        # the card may have changed under us; never start a player on nothing
+        if not os.path.isfile(filename):
+            self._debug("Not played:", name, "file is gone")
+            return None
+        return filename, start, length, name
+
+    def _prepared(self, clip, error):
+        if clip is None or self.stopped():
+            return self._done()
+        filename, start, self._length, self._name = clip
+        # long-lived players take care of their own layers
+        if config.player_pool:
+            self.loop.run_in_executor(self._load_pooled, (filename, start), self._loaded)
+        else:
+            self._spawn(filename, start)
+
+    def _spawn(self, filename, start):
+        video, name = self.video, self._name
+        # each time we switch to a new video, we switch the layer (and
+        # the virtual player), so it goes over or under the last one
+        layer, self._player_id = self.slots.take()
+        # never stack a player on one of ours still on the layer
+        reaper.get_reaper().when_free(layer, self.slots.display,
+                                      lambda: self._launch(filename, start, layer))
+
+    def _launch(self, filename, start, layer):
+        video, name = self.video, self._name
+        if self.stopped():
+            return self._done()
+        self._clip = (filename, start, layer)
+        self._launches += 1
+        # build omxplayer command (a pre-rolled player starts out invisible)
+        argv = spawn.player_argv(video['tags'], filename, start, layer, self._player_id,
+                                 hidden=self.start_at is not None,
+                                 display=self.slots.display)
+        self._debug("cmd:", argv, l=2)
         # launch the player, saving the process handle
-        # TODO: after debugging, replace 'if True' with 'try' and enable 'except'
-        #if True:
         try:
-            process = None
-            process = subprocess.Popen(my_cmd, shell=True, preexec_fn=os.setsid, stdin=nullin, 
-                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-           # save this process group id
-            pgid = os.getpgid(process.pid)
-            self._player_pgid = pgid
-            self._debug("Starting process: %i (%s)" % (pgid, name))
-            # If we have a loop
-            if ('loop' in video['tags']):
-                self._debug("Looping %.2fs for %s (pid %i)" %
-                            (length - config.inter_video_delay, name, pgid))
-            # otherwise
-            else:
-                self._debug("Waiting %.2fs for %s (pid %i)" %
-                            (length - config.inter_video_delay, name, pgid))
-            # generate expected _end_time (now + length)
-            start_time = time()
-            self._end_time = start_time + length
-            # wait until the end times (but also allowing that the stop flag is triggered)
-            while ((time() <= self._end_time) and
-                    not self.stopped()):
-                sleep(0.1)
-            # emerging from this loop, either
-            #   1) player ended gracefully
-            #   2) the video is looped, and so needs to be stopped
-            #   3) the thread received a stop order, and so video needs to be killed
-            #   4) something else, like player hung
-            # In any case, we kill the process group of the video, if we can
-            if process.poll() is None:
-                self._stop_video(pgid, name)    
-            # Now that we have ended one way or the other, we should be able to get stdout/stderr
-            # Report if we had any problems starting omxplayer
-            stdoutdata, stderrdata = process.communicate()
-            returncode = process.returncode
-            # if the process failed, let's log the output
-            if (returncode != 0):
-                self._debug("Error starting omxplayer for %s\n%s\n%s" % \
-                            (name, str(stdoutdata), str(stderrdata)))
+            self._timeline.mark('spawn')
+            self._process = spawn.launch(argv)
         except Exception as e:
-             self._debug("Error starting omxplayer for %s\n%s" % (name, str(e)))
+            self._debug(lazy_format("Error starting omxplayer for %s\n%s", name, e))
+            return self._done()
+        reaper.get_reaper().track(self._process, name, layer, self.slots.display)
+        pid = self._process.pid
+        self._debug(lazy_format("Starting process: %i (%s)", pid, name))
+        self._control = dbuscontrol.PlayerControl(config.dbus_name % self._player_id)
+        self._watch()
+        # If we have a loop
+        if ('loop' in video['tags']):
+            self._debug(lazy_format("Looping %.2fs for %s (pid %i)",
+                                    self._length - config.inter_video_delay, name, pid))
+        # otherwise
+        else:
+            self._debug(lazy_format("Waiting %.2fs for %s (pid %i)",
+                                    self._length - config.inter_video_delay, name, pid))
+        self._listen(playeroutput.PlayerOutput(self._process.stdout, name))
+        self._out.start()
+        # hold a pre-rolled player until its moment comes
+        if self.start_at is not None:
+            self.loop.run_in_executor(self._preroll, (start,), self._for_launch(self._prerolled))
+        else:
+            self._begin_clip()
+
+    def _preroll(self, start):
+        """Wait for a hidden player to come up, and pause it at its
+        start position. Returns True if it did all that. Runs on the
+        executor."""
+        spawn_time = time()
+        control = self._control
+        # by the boundary, it's quicker to start again visible than to
+        # go on waiting with nothing on screen
+        timeout = max(self.start_at - spawn_time, config.preroll_min_lead)
+        # D-Bus keeps real time
+        if control.wait_ready(clock.timeout(timeout)):
+            self._answered = True
+            latency = time() - spawn_time
+            self._timeline.first('running')
+            _learn_startup_latency(latency)
+            self._debug(lazy_format("Player up in %.3fs, pre-roll lead now %.3fs",
+                                    latency, preroll_lead()))
+            return control.pause() and control.set_position(start)
+        self._debug("Player for", self._name, "never answered on D-Bus")
+        return False
+
+    def _prerolled(self, held, error):
+        if self._ending():
+            return
+        if not held:
+            return self._unhold("pre-roll")
+        # reveal at the boundary (or straight away, if we're late)
+        self._reveal = self.loop.call_at(self.start_at, self._for_launch(self._show),
+                                         self._control)
+
+    def _show(self, control):
+        """Reveal the held player. The D-Bus calls go to the executor;
+        the clip's time starts once they are done."""
+        self._reveal = None
+        if self._ending():
+            return
+
+        def reveal():
+            return control.set_alpha(255) and control.play()
 
-    def wait_for_end(self):
-        """Wait for end of video in tight loop. This provides a synchronous mechanism to wait
-        for the end of a video."""
+        self.loop.run_in_executor(reveal, (), self._for_launch(self._revealed))
+
+    def _revealed(self, shown, error):
+        if self._ending():
+            return
+        if not shown:
+            return self._unhold("reveal")
+        self._shown()
+        late = time() - self.start_at
+        self._debug(lazy_format("Revealed %s %.3fs after the boundary", self._name, late), l=2)
+        self._begin_clip()
+
+    def _unhold(self, what):
+        """Pre-roll or the reveal failed, so the hidden player is no use:
+        playing unseen (and heard), or held where nobody can see it. Kill
+        it, and at the boundary, start the clip on the same layer again
+        without pre-roll, visible from the start."""
+        report("%s of %s failed; playing it without pre-roll" % (what.capitalize(), self._name))
+        # anything still on its way for this player is for a dead one
+        self._launches += 1
+        self._timeline.forget('spawn', 'running')
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        self._out.on_data = self._out.on_closed = None
+        reaper.get_reaper().stop(self._process, signal.SIGKILL, done=self._out.close)
+        self._process = self._control = None
+        self._heard = self._answered = False
+        self._position = None
+        filename, start, layer = self._clip
+        self.start_at, boundary = None, self.start_at
+
+        def relaunch():
+            self._reveal = None
+            reaper.get_reaper().when_free(layer, self.slots.display,
+                                          lambda: self._launch(filename, start, layer))
+
+        self._reveal = self.loop.call_at(boundary, relaunch)
+
+    def _for_launch(self, fn):
+        """fn, as a callback that does nothing once the player it was
+        meant for has been given up on (by _unhold)"""
+        launch = self._launches
+
+        def callback(*args):
+            if launch == self._launches:
+                return fn(*args)
+
+        return callback
+
+    def _load_pooled(self, filename, start):
+        """Load the clip on the next player from the pool, rather than
+        spawning one. Runs on the executor."""
+        player = (self.pool or playerpool.get_pool()).acquire()
+        self._debug(lazy_format("Loading %s on %r", self._name, player))
+        if not player.load(filename, start):
+            self._debug(lazy_format("Couldn't load %s on %r", self._name, player))
+            return None
+        return player
+
+    def _loaded(self, player, error):
+        if player is None:
+            return self._done()
+        if self._ending():
+            self.loop.run_in_executor(player.hide, (), lambda result, error: self._done())
+            return
+        self._player = player
+        self._control = player.control
+        # it answered when it was loaded
+        self._answered = True
+        # the pool keeps reading its players' output between clips
+        self._listen(player.output)
+        self._watch()
+        # with pre-roll, hold it hidden until its moment comes
+        if self.start_at is not None:
+            self._reveal = self.loop.call_at(self.start_at, self._show_pooled)
+        else:
+            self._show_pooled()
+
+    def _show_pooled(self):
+        self._reveal = None
+        if self._ending():
+            return
+        asked = time()
+        self.loop.run_in_executor(self._player.show, (),
+                                  lambda shown, error: self._pooled_shown(shown, asked))
+
+    def _pooled_shown(self, shown, asked):
+        if self._ending():
+            return
+        if not shown:
+            # the pool has killed it, like a player that failed to load
+            return self._hang('reveal', asked)
+        self._shown()
+        self._debug(lazy_format("Waiting %.2fs for %s on %r",
+                                self._length, self._name, self._player))
+        self._begin_clip()
+
+    #
+    # Playing
+    #
+
+    def _begin_clip(self):
+        """The clip's time starts now"""
+        self._end_time = time() + self._length
+        self._timeline.mark('deadline', self._end_time)
+        self._timed.set()
+        self._deadline = self.loop.call_at(self._end_time, self._end, True)
+
+    def _listen(self, out):
+        self._out = out
+        out.on_data = self._output_seen
+        out.on_closed = self._output_closed
+
+    def _output_seen(self, out):
+        """The player wrote something. That it said anything at all only
+        tells us it's up; progress is its position moving (see _checked)."""
+        if not self._heard:
+            self._heard = True
+            # the player's first words: it's up, and unless it is
+            # being held hidden, on screen
+            self._timeline.first('running')
+            if self.start_at is None and not self._player:
+                self._shown()
+
+    def _output_closed(self, out):
+        """The player closed its output, which it does when it exits"""
+        if not self._ending():
+            self._debug("Player exited early")
+            # well short of its time (or before it even started) is
+            # a failure, not just a film a little shorter than we thought
+            if not self._end_time or self._end_time - time() > config.watchdog_stall:
+                self._hang('exited', time())
+            self._end(False)
+
+    def _shown(self):
+        """The clip has just gone on screen"""
+        self.shown_at = time()
+        self._timeline.mark('shown', self.shown_at)
+        if self.on_shown is not None:
+            self.on_shown(self.shown_at)
+
+    def _ending(self):
+        """Is the clip over, or on its way out?"""
+        return self._stopped or self._over
+
+    #
+    # Watchdog: a player that shows no sign of life (output or a D-Bus
+    # answer) within watchdog_startup seconds of starting, or whose
+    # position stops moving for watchdog_stall seconds once on screen,
+    # is hung: we kill it, and the clip ends there, so the next one
+    # starts. Other output only shows the player is up.
+    #
+    # The player's output and its exit come to us as they happen, so we
+    # don't poll: we look only when it could be hung by now, and then
+    # it's usually its --stats lines that say it isn't. Only if those
+    # have gone quiet do we ask it over D-Bus where it is. A player with
+    # neither D-Bus nor --stats can only be judged by its output at
+    # startup and by exiting.
+    #
+
+    def _watch(self):
+        self._spawned_at = self._progress_at = time()
+        if config.watchdog_interval:
+            self._watch_at(self._spawned_at + config.watchdog_startup)
+
+    def _watch_at(self, when):
+        # never sooner than watchdog_interval from now
+        when = max(when, time() + config.watchdog_interval)
+        self._watchdog = self.loop.call_at(when, self._for_launch(self._check))
+
+    def _moved(self):
+        """Take progress from the position in its --stats lines. Other
+        output doesn't count: a frozen player may go on printing."""
+        if self._out.progress_at is not None and self._out.progress_at > self._progress_at:
+            self._progress_at = self._out.progress_at
+
+    def _due(self):
+        """When the player could next be found hung, if it shows no
+        more progress"""
+        if not self._answered and not self._heard:
+            return self._spawned_at + config.watchdog_startup
+        if not self._end_time:
+            # held for pre-roll: nothing to judge until it's shown
+            return time() + config.watchdog_stall
+        return max(self._progress_at, self._end_time - self._length) + config.watchdog_stall
+
+    def _check(self):
+        self._watchdog = None
+        if self._ending() or self._control is None:
+            return
+        self._moved()
+        if self._due() > time():
+            # its --stats lines say it's fine
+            return self._watch_at(self._due())
+        self.loop.run_in_executor(self._control.position, (), self._for_launch(self._checked))
+
+    def _checked(self, position, error):
+        if self._ending():
+            return
+        now = time()
+        if position is not None:
+            self._answered = True
+            if position != self._position:
+                self._progress_at = now
+            self._position = position
+        self._moved()
+        if not self._answered and not self._heard:
+            if now - self._spawned_at >= config.watchdog_startup:
+                return self._hang('startup', self._spawned_at)
+        elif self._end_time and (self._position is not None or
+                                 self._out.position is not None):
+            if now >= self._due():
+                return self._hang('stalled', self._progress_at)
+        self._watch_at(self._due())
+
+    def _hang(self, kind, since):
+        """The player is hung (or died), as of since: record it, and end
+        the clip, so the next one can start"""
+        self.hung = kind
+        self.hung_at = time()
+        report("Player for %s hung (%s), noticed after %.2fs" %
+               (self._name, kind, self.hung_at - since))
+        metrics.hang(self.hung_at - since)
+        self._end(False)
+
+    #
+    # Ending: when the deadline comes, the player exits, or stop()
+    #
+
+    def _end(self, on_time):
+        if self._finished.is_set() or self._over:
+            return
+        if self._process is None and self._player is None:
+            # nothing started yet; whatever is under way will see we
+            # are stopped
+            self._ended.set()
+            return
+        self._over = True
+        if self._deadline is not None:
+            self._deadline.cancel()
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self._reveal is not None:
+            self._reveal.cancel()
+            self._reveal = None
+        if not on_time and self._end_time:
+            self._end_time = min(self._end_time, time())
+        self._timeline.mark('ended')
+        self._ended.set()
+        if self._player is not None:
+            self._out.on_data = self._out.on_closed = None
+            # a hung player is no use to the pool; it's respawned when next needed
+            finish = self._player.kill if self.hung else self._player.hide
+            self.loop.run_in_executor(finish, (), lambda result, error: self._done())
+            return
+        # we got here from one of
+        #   1) the deadline: the clip's time is up (it may loop, or
+        #      run on past it)
+        #   2) _output_closed: the player exited on its own
+        #   3) stop(), from another thread
+        #   4) _hang: the watchdog found it hung, or it died early
+        # In any case, we stop the process group of the video, and the
+        # reaper sees it gone (a hung player may not listen to SIGTERM)
+        self._debug(lazy_format("Stopping process %i (%s)", self._process.pid, self._name))
+        reaper.get_reaper().stop(self._process, signal.SIGKILL if self.hung else signal.SIGTERM,
+                                 done=self._reaped)
+
+    def _reaped(self):
+        """The player and its children are gone (or won't go)"""
+        self._timeline.mark('reaped')
+        # whatever it said last
+        self._out.read()
+        self._out.close()
+        # Report if we had any problems starting omxplayer
+        if (self._process.returncode != 0):
+            self._debug(lazy_format("Error starting omxplayer for %s\n%s",
+                                    self._name, Lazy(self._out.tail)))
+        self._done()
+
+    def _done(self):
+        """Nothing is playing; don't keep anyone waiting"""
+        self._timed.set()
+        self._ended.set()
+        # let go of the callbacks that point back at us, so we (and our
+        # latches' pipes) go as soon as the caller lets go of us, rather
+        # than at the next garbage collection
+        if self._out is not None:
+            self._out.on_data = self._out.on_closed = None
+        self._deadline = self._watchdog = self._reveal = None
+        if not self._finished.is_set():
+            metrics.finish(self._timeline)
+            self._finished.set()
+
+    #
+    # For other threads
+    #
+
+    def wait_for_end(self, lead=0):
+        """Wait for end of video. This provides a synchronous mechanism to wait
+        for the end of a video. With a lead, return that many seconds
+        before the end, so the caller can pre-roll the next one."""
         #
-        # The run() method is called asynchronously, so it is possible to call this 
-        # method before run() has recorded the expected _end_time. 
-        # thus we wait until the end times (but also allowing that the stop flag is triggered)
-        while (not self._end_time and
-                not self.stopped()):
-            sleep(0.1)
-        #self._debug("Waiting for end of video")
-        # now wait until time expires (or we are interrupted because stop flag is triggered)
-        while ((time() <= self._end_time) and
-                not self.stopped()):
-            sleep(0.1)
-
-    def _stop_video(self, pgid, name):
-        self._debug("Sending SIGTERM to process %i (%s)" % (pgid, name))
-        try:
-            os.killpg(pgid, signal.SIGTERM)
-            self._player_pgid = None
-            self._current_video = None
-        except OSError, e:
-            self._debug("Couldn't terminate %s (pid %i)\n%s" % (name, pgid, str(e)))
-            pass
+        # The loop runs the clip asynchronously, so it is possible to call this
+        # method before it has recorded the expected _end_time. That's fine:
+        # _ended is only set once the clip is over (or we are stopped).
+        if lead and self._end_time == 0:
+            self._timed.wait()
+        if lead and self._end_time:
+            wait_until(self._end_time - lead, [self._ended])
+        else:
+            self._ended.wait()
+
+    def wait_finished(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def end_time(self):
+        """When this clip ends (or ended), or None if it never played"""
+        return self._end_time or None
 
     def _get_length(self, filename):
-        self._debug("Getting duration of %s" % filename)
+        self._debug("Getting duration of", filename)
         length = ffprobe.duration(filename)
         if length is None:
             length = 0
         return length
 
 
+class VideoThread(object):
+    """What clips used to be: a thread per clip, with a stop() method.
+    Now a front for a Playback on the shared event loop, with the same
+    methods, for code that still starts and waits on clips this way."""
+
+    def __init__(self, video=None, media_dir=".", debug=0, start_at=None,
+                 slots=None, pool=None):
+        self.playback = Playback(video, media_dir, debug=debug, start_at=start_at,
+                                 slots=slots, pool=pool)
+        self._started = False
+
+    def __getattr__(self, name):
+        # stop(), stopped(), wait_for_end(), end_time(), shown_at, ...
+        return getattr(self.playback, name)
+
+    def __setattr__(self, name, value):
+        if name == 'on_shown':
+            self.playback.on_shown = value
+        else:
+            object.__setattr__(self, name, value)
+
+    def set_sequence(self, video=None):
+        self.playback.video = video
+
+    def start(self):
+        if self._started:
+            raise RuntimeError("threads can only be started once")
+        self._started = True
+        self.playback.start()
+
+    def is_alive(self):
+        return self._started and not self.playback.finished()
+
+    def join(self, timeout=None):
+        if self._started:
+            self.playback.wait_finished(timeout)
+
 
 def main():
     media_dir = "media"
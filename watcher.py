@@ -0,0 +1,299 @@
+#!/usr/bin/python
+"""watcher.py: watch the media directory for files coming and going
+Author: Wes Modes (wmodes@gmail.com)
+Copyright: 2017, MIT """
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+#
+# A thread that tells a callback when media files in a directory are
+# added, removed or modified: callback(event, name), with event one of
+# 'added', 'removed' or 'modified' and name relative to the directory.
+# The film database file is reported too, as 'modified'.
+#
+# Under Linux we use inotify, through ctypes, and the thread sleeps in
+# select() until the kernel has something for us, so a quiet directory
+# costs nothing. Files are reported when they are closed after writing
+# or moved in, so a clip still being copied isn't reported half done.
+#
+# If inotify isn't available, or the directory goes away (a USB stick
+# pulled out), we fall back to polling: a stat of the directory every
+# watch_poll_interval seconds, a full listing when its mtime changes,
+# and a full rescan every watch_rescan_interval seconds to catch files
+# rewritten in place. New or changed files are only reported once they
+# have stopped changing between two polls. While polling we keep trying
+# to get inotify back.
+#
+
+import os
+import stat
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from time import time
+
+# local modules
+from common import *
+import config
+from timing import Latch
+
+#
+# inotify constants, from <sys/inotify.h>
+#
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# the watch is gone: the directory was removed, moved or unmounted
+LOST_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT | IN_IGNORED
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class InotifyError(Exception):
+    pass
+
+
+class Inotify(object):
+    """An inotify instance watching one directory"""
+
+    _libc = None
+
+    def __init__(self, directory):
+        libc = Inotify.libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError(os.strerror(ctypes.get_errno()))
+        path = directory.encode('utf-8') if not isinstance(directory, bytes) else directory
+        if libc.inotify_add_watch(self.fd, path, WATCH_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), directory)
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                   use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                                   ctypes.c_uint32]
+            except (OSError, AttributeError) as e:
+                raise InotifyError(str(e))
+            cls._libc = libc
+        return cls._libc
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """List of (mask, name) for the events waiting"""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher(threading.Thread):
+    """Reports media files added to, removed from and modified in a
+    directory"""
+
+    def __init__(self, directory, callback):
+        super(Watcher, self).__init__(name='watcher')
+        self.daemon = True
+        self.directory = directory
+        self.callback = callback
+        self._stop = Latch()
+        # name -> (size, mtime) of the files we have reported
+        self._files = {}
+        # name -> (size, mtime) of files seen changing while polling
+        self._unsettled = {}
+        self._dir_mtime = None
+        self._last_rescan = 0
+        # False once we know inotify can't work here at all
+        self._inotify_ok = config.watch_inotify
+        self.mode = None
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.is_set()
+
+    def run(self):
+        # what's there now is what the catalog was loaded with
+        self._files = self._scan()
+        while not self.stopped():
+            inotify = self._open_inotify()
+            if inotify is not None:
+                self.mode = 'inotify'
+                try:
+                    # catch up on anything that happened while unwatched
+                    self._rescan(settle=False)
+                    self._watch(inotify)
+                finally:
+                    inotify.close()
+            else:
+                self.mode = 'poll'
+                self._stop.wait(config.watch_poll_interval)
+                if not self.stopped():
+                    self._poll()
+
+    def _open_inotify(self):
+        if not self._inotify_ok:
+            return None
+        try:
+            return Inotify(self.directory)
+        except InotifyError as e:
+            report("No inotify (%s), polling %s instead" % (str(e), self.directory))
+            self._inotify_ok = False
+        except OSError:
+            # the directory isn't there (yet); keep polling and trying
+            pass
+        return None
+
+    def _watch(self, inotify):
+        """Handle events until told to stop or the watch is lost"""
+        while not self.stopped():
+            try:
+                ready = select.select([inotify, self._stop], [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._stop in ready:
+                return
+            names = set()
+            for mask, name in inotify.read():
+                if mask & LOST_MASK:
+                    debug("Lost the watch on %s, polling" % self.directory)
+                    self._rescan(settle=False)
+                    return
+                if mask & IN_Q_OVERFLOW:
+                    self._rescan(settle=False)
+                elif name and not mask & IN_ISDIR:
+                    names.add(name)
+            for name in names:
+                self._check(name)
+
+    def _poll(self):
+        """One polling round: a stat, and a listing only if needed"""
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            dir_mtime = None
+        due = time() - self._last_rescan >= config.watch_rescan_interval
+        if dir_mtime != self._dir_mtime or self._unsettled or due:
+            self._dir_mtime = dir_mtime
+            self._rescan(settle=True)
+
+    def _rescan(self, settle):
+        self._last_rescan = time()
+        files = self._scan()
+        for name in list(self._files):
+            if name not in files:
+                self._emit('removed', name, None)
+        for name, stamp in files.items():
+            if stamp == self._files.get(name):
+                self._unsettled.pop(name, None)
+            elif settle and self._unsettled.get(name) != stamp:
+                # still changing, or just appeared; look again next time
+                self._unsettled[name] = stamp
+            else:
+                self._unsettled.pop(name, None)
+                self._emit('modified' if name in self._files else 'added', name, stamp)
+
+    def _check(self, name):
+        """Compare one file with what we last knew of it"""
+        if not self._wanted(name):
+            return
+        stamp = self._stamp(name)
+        if stamp is None:
+            if name in self._files:
+                self._emit('removed', name, None)
+        elif stamp != self._files.get(name):
+            self._emit('modified' if name in self._files else 'added', name, stamp)
+
+    def _emit(self, event, name, stamp):
+        if stamp is None:
+            self._files.pop(name, None)
+        else:
+            self._files[name] = stamp
+        debug("Media %s: %s" % (event, name))
+        try:
+            self.callback(event, name)
+        except Exception as e:
+            report("Error handling %s of %s: %s" % (event, name, str(e)))
+
+    def _scan(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return {}
+        files = {}
+        for name in names:
+            if self._wanted(name):
+                stamp = self._stamp(name)
+                if stamp is not None:
+                    files[name] = stamp
+        return files
+
+    def _wanted(self, name):
+        if name.startswith('.') or _partial(name):
+            return False
+        if name == config.filmdb:
+            return True
+        return os.path.splitext(name)[1].lower() in config.media_extensions
+
+    def _stamp(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return (st.st_size, st.st_mtime)
+
+
+def _partial(name):
+    """Is this one of ingest's files still being written? run_ffmpeg()
+    writes clip.mp4 as clip.mp4.part.mp4, and renames it when ffmpeg is
+    done; my.party.mp4 or clip.part.mp4 are media like any other."""
+    ext = os.path.splitext(name)[1]
+    suffix = ext + '.part' + ext
+    return bool(ext) and name.endswith(suffix) and len(name) > len(suffix)